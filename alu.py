@@ -0,0 +1,347 @@
+# Lookup tables for the CPU's arithmetic and bit twiddling. Each entry packs
+# the result byte in the low 8 bits and the F register it produces in the high
+# 8 bits, so an instruction is one indexed load plus a couple of shifts and
+# masks.
+#
+# Tables are indexed as follows:
+#   ADD, SUB            (carry << 16) | (A << 8) | operand
+#   AND, XOR, OR        (A << 8) | operand
+#   RLC, RRC, RL, RR    (carry << 8) | value
+#   SLA, SRA, SRL, SWAP value
+#   INC, DEC            value (C is left alone, so it's never set here)
+#   DAA                 (F << 4) | A
+#
+# Tables are only built the first time they're asked for, and the big ones are
+# cached on disk since building them takes a noticeable fraction of a second.
+
+import os
+import array
+
+FLAG_Z = 0b10000000
+FLAG_N = 0b01000000
+FLAG_H = 0b00100000
+FLAG_C = 0b00010000
+
+# Bump this whenever an entry function changes, so stale caches get ignored
+TABLE_VERSION = 1
+
+# Set to None to disable the on-disk cache
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "pygb")
+
+# Tables at least this big are cached on disk
+CACHE_MIN_SIZE = 0x10000
+
+
+def pack(result, flags):
+    return (flags << 8) | result
+
+
+def zc_flags(result, carry):
+    return (FLAG_Z if result == 0 else 0) | (FLAG_C if carry else 0)
+
+
+def add_entry(idx):
+    carry = idx >> 16
+    a = (idx >> 8) & 0xFF
+    val = idx & 0xFF
+    result = a + val + carry
+    return pack(result & 0xFF,
+        (FLAG_Z if (result & 0xFF) == 0 else 0) |
+        (FLAG_H if (a & 0x0F) + (val & 0x0F) + carry > 0x0F else 0) |
+        (FLAG_C if result > 0xFF else 0))
+
+
+def sub_entry(idx):
+    carry = idx >> 16
+    a = (idx >> 8) & 0xFF
+    val = idx & 0xFF
+    result = (a - val - carry) & 0xFF
+    return pack(result, FLAG_N |
+        (FLAG_Z if result == 0 else 0) |
+        (FLAG_H if (val & 0x0F) + carry > (a & 0x0F) else 0) |
+        (FLAG_C if val + carry > a else 0))
+
+
+def and_entry(idx):
+    result = (idx >> 8) & idx & 0xFF
+    return pack(result, FLAG_H | (FLAG_Z if result == 0 else 0))
+
+
+def xor_entry(idx):
+    result = ((idx >> 8) ^ idx) & 0xFF
+    return pack(result, FLAG_Z if result == 0 else 0)
+
+
+def or_entry(idx):
+    result = ((idx >> 8) | idx) & 0xFF
+    return pack(result, FLAG_Z if result == 0 else 0)
+
+
+def inc_entry(val):
+    result = (val + 1) & 0xFF
+    return pack(result,
+        (FLAG_Z if result == 0 else 0) |
+        (FLAG_H if (result & 0x0F) == 0 else 0))
+
+
+def dec_entry(val):
+    result = (val - 1) & 0xFF
+    return pack(result, FLAG_N |
+        (FLAG_Z if result == 0 else 0) |
+        (FLAG_H if (result & 0x0F) == 0x0F else 0))
+
+
+def daa_entry(idx):
+    # More or less copied from http://forums.nesdev.com/viewtopic.php?t=9088
+    flags = (idx >> 4) & 0xF0
+    a = idx & 0xFF
+    if (flags & FLAG_N) == 0:
+        if (flags & FLAG_H) != 0 or (a & 0xF) > 9:
+            a += 0x06
+        if (flags & FLAG_C) != 0 or a > 0x9F:
+            a += 0x60
+    else:
+        if (flags & FLAG_H) != 0:
+            a = (a-0x06) & 0xFF
+        if (flags & FLAG_C) != 0:
+            a = (a-0x60) & 0x1FF
+
+    # NB: C is only ever set here, never cleared
+    return pack(a & 0xFF, (flags & (FLAG_N | FLAG_C)) |
+        (FLAG_C if (a & 0x100) != 0 else 0) |
+        (FLAG_Z if (a & 0xFF) == 0 else 0))
+
+
+def rot_entry(idx, left, include_carry):
+    carry = idx >> 8
+    val = idx & 0xFF
+    if left:
+        out_bit = val >> 7
+        in_bit = carry if include_carry else out_bit
+        result = ((val << 1) & 0xFF) | in_bit
+    else:
+        out_bit = val & 1
+        in_bit = carry if include_carry else out_bit
+        result = (val >> 1) | (in_bit << 7)
+    return pack(result, zc_flags(result, out_bit))
+
+
+def shift_entry(val, left, arithmetic):
+    if left:
+        result = (val << 1) & 0xFF
+        out_bit = val >> 7
+    else:
+        result = (val >> 1) | (val & 0x80 if arithmetic else 0)
+        out_bit = val & 1
+    return pack(result, zc_flags(result, out_bit))
+
+
+def swap_entry(val):
+    result = ((val & 0x0F) << 4) | (val >> 4)
+    return pack(result, zc_flags(result, False))
+
+
+# name: (number of entries, entry function)
+# The rotate flags are the CB prefixed versions; RLCA/RRCA/RLA/RRA always
+# clear Z so the CPU only keeps C from them
+BUILDERS = {
+    "ADD": (0x20000, add_entry),
+    "SUB": (0x20000, sub_entry),
+    "AND": (0x10000, and_entry),
+    "XOR": (0x10000, xor_entry),
+    "OR": (0x10000, or_entry),
+    "INC": (0x100, inc_entry),
+    "DEC": (0x100, dec_entry),
+    "DAA": (0x1000, daa_entry),
+    "RLC": (0x200, lambda idx: rot_entry(idx, True, False)),
+    "RRC": (0x200, lambda idx: rot_entry(idx, False, False)),
+    "RL": (0x200, lambda idx: rot_entry(idx, True, True)),
+    "RR": (0x200, lambda idx: rot_entry(idx, False, True)),
+    "SLA": (0x100, lambda val: shift_entry(val, True, True)),
+    "SRA": (0x100, lambda val: shift_entry(val, False, True)),
+    "SRL": (0x100, lambda val: shift_entry(val, False, False)),
+    "SWAP": (0x100, swap_entry),
+}
+
+tables = {}
+
+
+def build_table(name):
+    size, entry = BUILDERS[name]
+    return array.array("H", [entry(idx) for idx in xrange(size)])
+
+
+def cache_path(name):
+    return os.path.join(CACHE_DIR, "alu-%d-%s.bin" % (TABLE_VERSION, name))
+
+
+def load_table(name):
+    size, _ = BUILDERS[name]
+    table = array.array("H")
+    with open(cache_path(name), "rb") as f:
+        table.fromfile(f, size)
+    return table
+
+
+def save_table(name, table):
+    path = cache_path(name)
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    if not os.path.isdir(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+    with open(tmp_path, "wb") as f:
+        table.tofile(f)
+    os.rename(tmp_path, path)
+
+
+def table(name):
+    if name not in tables:
+        size, _ = BUILDERS[name]
+        cached = CACHE_DIR is not None and size >= CACHE_MIN_SIZE
+        tables[name] = None
+        if cached:
+            try:
+                tables[name] = load_table(name)
+            except (IOError, OSError, EOFError):
+                # Missing or truncated, just rebuild it
+                pass
+        if tables[name] is None:
+            tables[name] = build_table(name)
+            if cached:
+                try:
+                    save_table(name, tables[name])
+                except (IOError, OSError):
+                    print("WARNING: Couldn't cache ALU table %s in %s" % (name, CACHE_DIR))
+    return tables[name]
+
+
+if __name__ == "__main__":
+    # Exhaustive check of every table against the original REG based
+    # implementations of op_add, op_bitwise, op_compare, op_inc_8, op_daa,
+    # op_rot, op_shift and op_swap, for every input value and carry state.
+    # Tables are built from scratch, not loaded from the cache.
+    import sys
+    import operator
+
+    CACHE_DIR = None
+
+    def flagged_incr(value, delta, mask=0xFF, half_mask=0x0F):
+        # REG.flagged_incr
+        decr = delta < 0
+        if decr:
+            carry = -delta > value
+            half_carry = ((-delta) & half_mask) > (value & half_mask)
+        delta &= mask
+        full = value + delta
+        half = (value & half_mask) + (delta & half_mask)
+        value = full & mask
+        if not decr:
+            carry = full > mask
+            half_carry = half > half_mask
+        return value, carry, half_carry
+
+    def flag_bits(Z=False, N=False, H=False, C=False):
+        return ((FLAG_Z if Z else 0) | (FLAG_N if N else 0) |
+            (FLAG_H if H else 0) | (FLAG_C if C else 0))
+
+    def ref_add(a, val, carry_in, with_carry, negative):
+        a, carry, half_carry = flagged_incr(a, val if not negative else -val)
+        if with_carry and carry_in:
+            a, second_carry, second_half_carry = flagged_incr(a, 1 if not negative else -1)
+            carry |= second_carry
+            half_carry |= second_half_carry
+        return a, flag_bits(a == 0, negative, half_carry, carry)
+
+    def ref_bitwise(a, val, operation):
+        a = operation(a, val) & 0xFF
+        return a, flag_bits(Z=a == 0, H=operation == operator.and_)
+
+    def ref_inc(val, delta):
+        val, _, half_carry = flagged_incr(val, delta)
+        return val, flag_bits(val == 0, delta < 0, half_carry)
+
+    def ref_daa(a, flags):
+        if (flags & FLAG_N) == 0:
+            if (flags & FLAG_H) != 0 or (a & 0xF) > 9:
+                a += 0x06
+            if (flags & FLAG_C) != 0 or a > 0x9F:
+                a += 0x60
+        else:
+            if (flags & FLAG_H) != 0:
+                a = (a-0x06) & 0xFF
+            if (flags & FLAG_C) != 0:
+                a = (a-0x60) & 0x1FF
+        flags &= ~FLAG_H
+        flags |= FLAG_C if (a & 0x100) != 0 else 0x00
+        a &= 0xFF
+        flags = (flags & ~FLAG_Z) | (FLAG_Z if a == 0 else 0)
+        return a, flags
+
+    def ref_rot(val, carry, left, include_carry):
+        val = map(lambda bit: bit=='1', bin(val)[2:].rjust(8))
+        if include_carry:
+            val.insert(0, carry)
+        if left:
+            rot_bit = val[0]
+            val = val[1:] + [rot_bit]
+        else:
+            rot_bit = val[-1]
+            val = [rot_bit] + val[:-1]
+        new_carry = val[0] if include_carry else rot_bit
+        val = reduce(lambda x,y:y|(x<<1),val) & 0xFF
+        return val, flag_bits(Z=val == 0, C=new_carry)
+
+    def ref_shift(val, left, arithmetic):
+        drop_bit_idx = 7 if left else 0
+        carry = (val & (1 << drop_bit_idx)) != 0
+        if left:
+            val = val << 1
+        else:
+            val = val >> 1
+            if arithmetic and (val & 0x40) != 0:
+                    val |= 0x80
+        val &= 0xFF
+        return val, flag_bits(Z=val == 0, C=carry)
+
+    def ref_swap(val):
+        val = ((val & 0x0F) << 4) | (val >> 4)
+        return val, flag_bits(Z=val == 0)
+
+    failures = [0]
+    def check(name, idx, expected, flag_mask=0xFF):
+        entry = table(name)[idx]
+        got = (entry & 0xFF, (entry >> 8) & flag_mask)
+        expected = (expected[0], expected[1] & flag_mask)
+        if got != expected:
+            failures[0] += 1
+            if failures[0] <= 20:
+                print("%s[0x%05X]: got %r, expected %r" % (name, idx, got, expected))
+
+    for a in range(0x100):
+        for val in range(0x100):
+            idx = (a << 8) | val
+            for carry in (0, 1):
+                carry_idx = (carry << 16) | idx
+                check("ADD", carry_idx, ref_add(a, val, carry, True, False))
+                check("SUB", carry_idx, ref_add(a, val, carry, True, True))
+            check("AND", idx, ref_bitwise(a, val, operator.and_))
+            check("XOR", idx, ref_bitwise(a, val, operator.xor))
+            check("OR", idx, ref_bitwise(a, val, operator.or_))
+        for flags in range(0, 0x100, 0x10):
+            check("DAA", (flags << 4) | a, ref_daa(a, flags))
+        # INC/DEC leave C to the CPU
+        check("INC", a, ref_inc(a, 1), ~FLAG_C)
+        check("DEC", a, ref_inc(a, -1), ~FLAG_C)
+        for carry in (0, 1):
+            rot_idx = (carry << 8) | a
+            check("RLC", rot_idx, ref_rot(a, carry, True, False))
+            check("RRC", rot_idx, ref_rot(a, carry, False, False))
+            check("RL", rot_idx, ref_rot(a, carry, True, True))
+            check("RR", rot_idx, ref_rot(a, carry, False, True))
+        check("SLA", a, ref_shift(a, True, True))
+        check("SRA", a, ref_shift(a, False, True))
+        check("SRL", a, ref_shift(a, False, False))
+        check("SWAP", a, ref_swap(a))
+
+    print("%d failures" % failures[0])
+    sys.exit(1 if failures[0] else 0)
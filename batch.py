@@ -0,0 +1,251 @@
+#!/usr/bin/pypy
+# Runs lots of ROMs (or one ROM under lots of input scripts) headless across
+# a pool of processes, and reports what each one did as JSON: what it sent
+# over the serial port (which is how blargg's test ROMs print their results),
+# a hash of the last frame drawn and the state the CPU was left in.
+#
+# Jobs are every ROMFILE on the command line, with the same --frames and
+# --input, plus any in a --jobs file holding a JSON list of
+#   {"rom": FILE, "frames": N, "input": SCRIPT}
+# objects, where frames and input are optional.
+#
+# Every ROM is loaded once, before the pool starts. On Linux the workers
+# are forked from this process and use those same ROM objects; elsewhere,
+# each worker loads the ROMs it needs itself. Either way ROMs are mapped
+# rather than read in (see memory.ROM), so the workers all share the page
+# cache's copy of each one.
+#
+# --selftest (make batchtest) checks that scripted input actually reaches a
+# ROM run through the pool, and that tests/timer_int.asm passes.
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+
+import bench as gb_bench
+import frontend as gb_frontend
+import main as gb_main
+import memory as gb_memory
+
+# filename: memory.ROM
+ROMS = {}
+
+
+def load_rom(filename):
+    rom = ROMS.get(filename)
+    if rom is None:
+        with open(filename, "rb") as f:
+            rom = ROMS[filename] = gb_memory.ROM(f)
+    return rom
+
+
+def run_job(job):
+    # Runs in a worker, and returns the job with its results added. Never
+    # raises, so one broken ROM doesn't take the rest of the batch with it.
+    result = dict(job)
+    system = None
+    T_start = time.time()
+    try:
+        script = None
+        if job.get("input") is not None:
+            with open(job["input"], "r") as f:
+                script = gb_frontend.load_input_script(f)
+        system = gb_main.GAMEBOY(load_rom(job["rom"]), recompile=job["recompile"],
+                                 renderer=job["renderer"],
+                                 frontend=gb_frontend.SCRIPTED_FRONTEND(script))
+        system.serial.echo = False
+        n_instr, n_cycles = system.run(job["frames"] * gb_main.CYCLES_PER_FRAME)
+        result["exit"] = "ok"
+        result["instructions"] = n_instr
+        result["cycles"] = n_cycles
+    except Exception:
+        result["exit"] = "error"
+        result["error"] = traceback.format_exc()
+    result["seconds"] = time.time() - T_start
+
+    if system is not None:
+        cpu = system.cpu
+        result["serial"] = system.serial.output.decode("latin-1")
+        result["framebuffer_md5"] = hashlib.md5(system.ppu.framebuffer).hexdigest()
+        result["cpu"] = {
+            "pc": cpu.pc,
+            "sp": cpu.sp,
+            "halted": cpu._halted,
+            "stopped": cpu._stopped,
+        }
+    return result
+
+
+def run_indexed(item):
+    idx, job = item
+    return idx, run_job(job)
+
+
+def run_batch(jobs, processes=None, progress=None):
+    # Returns the results in the same order as the jobs. progress(result) is
+    # called as each one finishes, in whatever order they do.
+    for job in jobs:
+        try:
+            load_rom(job["rom"])
+        except IOError:
+            # The job will fail (and say why) when it gets run
+            pass
+
+    results = [None] * len(jobs)
+    pool = multiprocessing.Pool(processes)
+    try:
+        # One job at a time, so a worker that gets a quick job goes straight
+        # on to the next rather than sitting idle behind a chunk
+        for idx, result in pool.imap_unordered(run_indexed, enumerate(jobs), chunksize=1):
+            results[idx] = result
+            if progress is not None:
+                progress(result)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+def joypad_echo_rom():
+    # Sends the action buttons' half of the joypad register over serial once
+    # a frame, as the PPU reaches vblank
+    asm = gb_bench.ROM_ASSEMBLER()
+    asm.emit(0x21, 0x00, 0xFF)                  # LD HL,$FF00
+    asm.label("frame")
+    asm.emit(0xF0, 0x44, 0xFE, 0x90)            # LDH A,(LY); CP 144
+    asm.jr(0x20, "frame")                       # JR NZ,frame
+    asm.emit(0x36, 0x10, 0x7E, 0xE6, 0x0F,      # LD (HL),$10; LD A,(HL); AND $0F
+             0xE0, 0x01, 0x3E, 0x81, 0xE0, 0x02) # LDH (SB),A; LD A,$81; LDH (SC),A
+    asm.label("vblank")
+    asm.emit(0xF0, 0x44, 0xFE, 0x90)            # LDH A,(LY); CP 144
+    asm.jr(0x28, "vblank")                      # JR Z,vblank
+    asm.jr(0x18, "frame")                       # JR frame
+    return asm.build()
+
+
+# name: (ROM builder, input script, frames to run, exactly what it should
+# send over serial). The joypad echo has A held from the fourth input poll to
+# the seventh; input is polled at the end of each frame and it echoes partway
+# through the next one.
+SELFTESTS = {
+    "joypad_echo": (joypad_echo_rom, "3 a down\n6 a up\n", 10,
+                    "\x0f" * 4 + "\x0e" * 3 + "\x0f" * 3),
+    "timer_int": (gb_bench.timer_int_rom, None, 5, "...."),
+}
+
+
+def selftest(processes=None):
+    # Runs each of SELFTESTS through the pool, interpreted and recompiled,
+    # and returns the results that didn't send exactly what they should have
+    jobs = []
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for name in sorted(SELFTESTS):
+            build_rom, script, n_frames, expected = SELFTESTS[name]
+            rom_file = os.path.join(tmp_dir, name + ".gb")
+            with open(rom_file, "wb") as f:
+                f.write(build_rom())
+            script_file = None
+            if script is not None:
+                script_file = os.path.join(tmp_dir, name + ".txt")
+                with open(script_file, "w") as f:
+                    f.write(script)
+            for recompile in (False, True):
+                jobs.append({"rom": rom_file, "frames": n_frames, "input": script_file,
+                             "renderer": "python", "recompile": recompile,
+                             "expected": expected})
+        results = run_batch(jobs, processes)
+    finally:
+        shutil.rmtree(tmp_dir)
+    return [result for result in results
+            if result["exit"] != "ok" or result["serial"] != result["expected"]]
+
+
+def summary(result):
+    if result["exit"] == "error":
+        detail = result["error"].strip().splitlines()[-1]
+    else:
+        lines = result["serial"].strip().splitlines()
+        detail = lines[-1] if lines else ""
+    return "%-32s %-5s %7.2fs  %s" % (result["rom"], result["exit"], result["seconds"], detail)
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description='Run ROMs headless in parallel and report the results as JSON')
+    parser.add_argument('romfiles', metavar='ROMFILE', type=str, nargs='*',
+                        help='Gameboy ROMs to run')
+    parser.add_argument('--jobs', metavar='FILE', type=str,
+                        help='Also run the jobs in FILE, a JSON list of {"rom": ..., "frames": ..., "input": ...}')
+    parser.add_argument('--frames', '-f', metavar='N', type=int, default=600,
+                        help='Frames\' worth of cycles to run each job for, unless it says otherwise (default 600)')
+    parser.add_argument('--input', metavar='SCRIPT', type=str,
+                        help='Play joypad input from a script of "FRAME BUTTON down|up" lines into each ROMFILE')
+    parser.add_argument('--processes', '-j', metavar='N', type=int,
+                        help='Worker processes to run (default one per core)')
+    parser.add_argument('--renderer', choices=['python', 'numpy'], default='python',
+                        help='How to draw the frames that get hashed')
+    parser.add_argument('--recompile', action='store_true',
+                        help='Use the recompiler')
+    parser.add_argument('--json', metavar='FILE', type=str,
+                        help='Write the results here, and a line per job to stdout, instead of the results to stdout')
+    parser.add_argument('--selftest', action='store_true',
+                        help='Check that scripted input reaches a ROM through the pool and the timer test passes, then exit')
+    args = parser.parse_args()
+
+    if args.selftest:
+        failures = selftest(args.processes)
+        for result in failures:
+            print("%s%s: serial %r, expected %r" % (
+                os.path.basename(result["rom"]), " (recompiled)" if result["recompile"] else "",
+                result.get("serial"), result["expected"]))
+            if result["exit"] == "error":
+                print(result["error"])
+        print("Self test %s" % ("failed" if failures else "passed"))
+        sys.exit(1 if failures else 0)
+
+    jobs = [{"rom": romfile, "input": args.input} for romfile in args.romfiles]
+    if args.jobs is not None:
+        with open(args.jobs, "r") as f:
+            jobs += json.load(f)
+    if len(jobs) == 0:
+        parser.error("No ROMFILEs or --jobs to run")
+    for job in jobs:
+        job.setdefault("frames", args.frames)
+        job.setdefault("input", None)
+        job.setdefault("renderer", args.renderer)
+        job.setdefault("recompile", args.recompile)
+
+    processes = args.processes or multiprocessing.cpu_count()
+    if args.json is not None:
+        def progress(result):
+            print(summary(result))
+            sys.stdout.flush()
+    else:
+        progress = None
+
+    T_start = time.time()
+    results = run_batch(jobs, processes, progress)
+    report = {
+        "python": platform.python_implementation(),
+        "python_version": platform.python_version(),
+        "platform": platform.platform(),
+        "processes": processes,
+        "seconds": time.time() - T_start,
+        "results": results,
+    }
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+
+    # Non-zero if anything broke, for scripts running test suites
+    sys.exit(1 if any(result["exit"] == "error" for result in results) else 0)
@@ -0,0 +1,698 @@
+#!/usr/bin/pypy
+# Micro-benchmarks for the emulator core, and a suite of whole-system
+# benchmarks (--suite) that reports JSON for catching regressions
+
+import sys
+import io
+import os
+import json
+import hashlib
+import platform
+import subprocess
+import time
+import argparse
+import random
+
+try:
+    import resource
+except ImportError:
+    # Not on Windows
+    resource = None
+
+import bus as gb_bus
+import cpu as gb_cpu
+import memory as gb_memory
+import video as gb_video
+import main as gb_main
+import opcodes as gb_opcodes
+import recompiler as gb_recompiler
+import scheduler as gb_scheduler
+import snapshot as gb_snapshot
+
+# What the original interpreter did with opcode_trials(), see verify_cpu()
+OPCODE_DIGESTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tests", "cpu_opcodes.md5")
+
+
+class LINEAR_BUS(gb_bus.BUS):
+    # The original bus decoder, which scans the whole device list on every
+    # access. Kept around so the flat decode table has something to be
+    # compared against.
+    def read(self, addr, force=False):
+        for device, addr_lo, addr_hi in self.devices:
+            if addr_lo <= addr <= addr_hi:
+                if device.bus_enabled or force:
+                    return device.bus_read(addr - addr_lo)
+                else:
+                    return 0xFF
+        print("WARNING: Read from HiZ address 0x%04lX" % addr)
+        return 0xFF
+
+    def write(self, addr, value, force=False):
+        for device, addr_lo, addr_hi in self.devices:
+            if addr_lo <= addr <= addr_hi:
+                if device.bus_enabled or force:
+                    device.bus_write(addr - addr_lo, value)
+                return
+        print("WARNING: Write to HiZ address 0x%04lX" % addr)
+
+
+class IDLE_VIDEO_REGS(gb_video.VIDEO_REGS):
+    # Just the register file. There's no PPU behind it to catch up before
+    # LCDC/LYC/DMA writes.
+    def __init__(self):
+        super(IDLE_VIDEO_REGS, self).__init__(None)
+
+    def bus_write(self, addr, value):
+        self.write_register(addr, value)
+
+
+class CORE_SYSTEM(object):
+    # Just the CPU and the memory map, without any of the peripherals that
+    # need to be stepped (PPU, APU, timer), so the numbers reflect the cost of
+    # instruction dispatch and bus accesses
+    def __init__(self, rom_bin, bus_type):
+        self.bus = bus_type()
+        # Never advanced, so the timer stays idle
+        self.scheduler = gb_scheduler.SCHEDULER()
+        self.cart = gb_memory.CARTRIDGE(self.bus, rom_bin)
+
+        self.ram = [gb_memory.RAM(4096), gb_memory.RAM(4096)]
+        self.bus.attach(self.ram[0], 0xC000, 0xCFFF)
+        self.bus.attach(self.ram[1], 0xD000, 0xDFFF)
+        self.hram = gb_memory.RAM(127)
+        self.bus.attach(self.hram, 0xFF80, 0xFFFE)
+
+        self.bus.attach(gb_main.JOYPAD(), 0xFF00, 0xFF00)
+        self.bus.attach(gb_main.SERIAL(), 0xFF01, 0xFF02)
+        self.bus.attach(gb_main.TIMER(self.scheduler), 0xFF04, 0xFF07)
+        self.bus.attach(gb_cpu.REG("IF", 8), 0xFF0F, 0xFF0F)
+        self.bus.attach(IDLE_VIDEO_REGS(), 0xFF40, 0xFF4B)
+        self.bus.attach(gb_cpu.REG("IE", 8), 0xFFFF, 0xFFFF)
+
+        self.cpu = gb_cpu.CPU(self.bus)
+
+    def advance(self):
+        if not self.cpu._halted and not self.cpu._stopped:
+            self.cpu.step()
+        self.cpu.service_interrupts()
+
+
+def bench_bus(romfile, bus_type, n_instr):
+    with open(romfile, "rb") as f:
+        system = CORE_SYSTEM(f, bus_type)
+    T_start = time.time()
+    for _ in range(n_instr):
+        system.advance()
+    T_end = time.time()
+    return n_instr / (T_end - T_start)
+
+
+class VIDEO_SYSTEM(object):
+    # Just the PPU, over some made up tiles, maps and sprites with the
+    # background, window and sprites all on
+    def __init__(self, renderer):
+        self.bus = gb_bus.BUS()
+        self.scheduler = gb_scheduler.SCHEDULER()
+        self.video = gb_video.VIDEO(self.bus, self.scheduler, renderer=renderer)
+        self.bus.attach(gb_cpu.REG("IF", 8), 0xFF0F, 0xFF0F)
+
+        rng = random.Random(0)
+        for addr in range(0x8000, 0xA000):
+            self.bus.write(addr, rng.randrange(0x100), force=True)
+        for addr in range(0xFE00, 0xFEA0):
+            self.bus.write(addr, rng.randrange(0x100), force=True)
+        self.bus.write(0xFF40, 0xF3)
+        self.bus.write(0xFF4A, 72)
+        self.bus.write(0xFF4B, 87)
+
+    def draw_frames(self, n_frames, effect=None):
+        # Draws frames line by line, the way the PPU does. There's no
+        # frontend, so this is just the cost of drawing into the framebuffer.
+        # The "scroll" effect writes SCX before every line like a wavy
+        # background would, and "fade" rewrites the palettes before every
+        # frame.
+        video = self.video
+        for frame in range(n_frames):
+            if effect == "fade":
+                palette = [0xE4, 0x90, 0x40, 0x00][frame % 4]
+                for addr in (0xFF47, 0xFF48, 0xFF49):
+                    self.bus.write(addr, palette)
+            video.window_line = 0
+            for ly in range(video.height):
+                if effect == "scroll":
+                    self.bus.write(0xFF43, ly)
+                video.renderer.render_line(ly)
+                if video.window_visible(ly):
+                    video.window_line += 1
+            video.present()
+
+
+def bench_video(renderer, n_frames, effect):
+    # Returns None if the renderer isn't available
+    system = VIDEO_SYSTEM(renderer)
+    if system.video.renderer.name != renderer:
+        return None
+    T_start = time.time()
+    system.draw_frames(n_frames, effect)
+    T_end = time.time()
+    return n_frames / (T_end - T_start)
+
+
+class ROM_ASSEMBLER(object):
+    # Just enough of an assembler to build the suite's ROMs: raw bytes, with
+    # labels for absolute (JP/CALL) and relative (JR) addresses
+    def __init__(self, org=0x150):
+        self.org = org
+        self.code = bytearray()
+        self.labels = {}
+        self.fixups = []
+
+    def label(self, name):
+        self.labels[name] = self.org + len(self.code)
+
+    def emit(self, *values):
+        # Strings are labels, and take up a 16-bit address
+        for value in values:
+            if isinstance(value, str):
+                self.fixups.append((len(self.code), value, False))
+                self.code += bytearray(2)
+            else:
+                self.code.append(value & 0xFF)
+
+    def jr(self, opcode, name):
+        self.code.append(opcode)
+        self.fixups.append((len(self.code), name, True))
+        self.code.append(0)
+
+    def build(self, vectors=None):
+        # Returns a 32KB ROM with the code at org, entered from 0x100, and
+        # any {address: bytes} (e.g. interrupt vectors) filled in. The second
+        # 16KB is random, for tile data.
+        for offset, name, relative in self.fixups:
+            addr = self.labels[name]
+            if relative:
+                self.code[offset] = (addr - (self.org + offset + 1)) & 0xFF
+            else:
+                self.code[offset] = addr & 0xFF
+                self.code[offset+1] = addr >> 8
+
+        rng = random.Random(0)
+        rom = bytearray(0x4000) + bytearray(rng.randrange(0x100) for _ in range(0x4000))
+        rom[0x100:0x104] = bytearray([0x00, 0xC3, 0x50, 0x01]) # NOP; JP $0150
+        rom[0x134:0x143] = bytearray(b"PYGB BENCH".ljust(15, b"\0"))
+        rom[0x147] = 0x01 # MBC1
+        for addr, values in (vectors or {}).items():
+            rom[addr:addr+len(values)] = bytearray(values)
+        rom[self.org:self.org+len(self.code)] = self.code
+        return bytes(rom)
+
+
+def alu_rom():
+    # CPU bound: arithmetic, rotates, stack and (HL) traffic with the LCD off
+    asm = ROM_ASSEMBLER()
+    asm.emit(0x31, 0xFE, 0xDF,             # LD SP,$DFFE
+             0xAF, 0xE0, 0x40)             # XOR A; LDH (LCDC),A
+    asm.label("outer")
+    asm.emit(0x21, 0x00, 0xC0, 0x06, 0x00) # LD HL,$C000; LD B,0
+    asm.label("inner")
+    asm.emit(0x78, 0x87, 0x88, 0x90, 0x98, 0xA1, 0xA8, 0xB2, 0xBB,
+             0x27, 0x2F, 0x37, 0x3F, 0x07, 0x0F, 0x17, 0x1F,
+             0xCB, 0x11, 0xCB, 0x2A, 0xCB, 0x33, 0xCB, 0x06, 0xCB, 0x7E,
+             0x22, 0x2B, 0x34, 0x35, 0x77,
+             0xC5, 0xD5, 0xE5, 0xF5, 0xF1, 0xE1, 0xD1, 0xC1,
+             0x09, 0x19, 0xE8, 0x02, 0xE8, 0xFE,
+             0x21, 0x00, 0xC0,             # LD HL,$C000
+             0xCD, "sub", 0x05)            # CALL sub; DEC B
+    asm.jr(0x20, "inner")                  # JR NZ,inner
+    asm.emit(0x0C, 0x14, 0x1C, 0xC3, "outer")
+    asm.label("sub")
+    asm.emit(0xC6, 0x11, 0xCE, 0x22, 0xD6, 0x33, 0xDE, 0x44,
+             0xE6, 0x55, 0xEE, 0x66, 0xF6, 0x77, 0xFE, 0x88, 0xC9)
+    return asm.build()
+
+
+def vram_rom():
+    # Copies 6KB of tile data into VRAM over and over (from a different
+    # place in the ROM's random half each time), with the background showing
+    # all of it
+    asm = ROM_ASSEMBLER()
+    asm.emit(0x31, 0xFE, 0xDF,             # LD SP,$DFFE
+             0x21, 0x00, 0x98)             # LD HL,$9800
+    asm.label("map")
+    asm.emit(0x7D, 0x22, 0x7C, 0xFE, 0x9C) # LD A,L; LD (HL+),A; LD A,H; CP $9C
+    asm.jr(0x20, "map")
+    asm.label("outer")
+    asm.emit(0xF0, 0x80, 0x3C, 0xE6, 0x1F, 0xE0, 0x80, # HRAM counter, 0-31
+             0xF6, 0x40, 0x57, 0x1E, 0x00, # LD DE,$4000 + counter*256
+             0x21, 0x00, 0x80,             # LD HL,$8000
+             0x01, 0x00, 0x18)             # LD BC,$1800
+    asm.label("copy")
+    asm.emit(0x1A, 0x13, 0x22, 0x0B, 0x78, 0xB1) # LD A,(DE); INC DE; LD (HL+),A; DEC BC; LD A,B; OR C
+    asm.jr(0x20, "copy")
+    asm.emit(0xC3, "outer")
+    return asm.build()
+
+
+def timer_rom():
+    # A timer interrupt every 64 cycles, with the CPU halted in between,
+    # like tests/timer_int.asm at its fastest
+    asm = ROM_ASSEMBLER()
+    asm.emit(0x31, 0xFE, 0xDF,             # LD SP,$DFFE
+             0x3E, 0x04, 0xE0, 0xFF,       # IE = timer
+             0x3E, 0xFC, 0xE0, 0x06,       # TMA = $FC
+             0x3E, 0x05, 0xE0, 0x07,       # TAC = on, 16 cycles
+             0xFB)                         # EI
+    asm.label("loop")
+    asm.emit(0x76, 0x00, 0x0C)             # HALT; NOP; INC C
+    asm.jr(0x18, "loop")
+    return asm.build({0x50: [0xD9]})       # RETI
+
+
+def timer_int_rom():
+    # tests/timer_int.asm: runs the timer at each TAC speed until TIMA
+    # overflows, then sends "." over serial if DIV shows it took as long as
+    # it should have, or "F" if not. Not a workload, it stops once it's done.
+    asm = ROM_ASSEMBLER()
+    asm.emit(0x31, 0xFE, 0xDF,             # LD SP,$DFFE
+             0x21, 0xFF, 0xFF, 0x36, 0x04) # IE = timer
+    for tac, tima, div in ((0x04, 0xFC, 16), (0x05, 0xC0, 4), (0x06, 0xF0, 4), (0x07, 0xFC, 4)):
+        asm.emit(0x06, tac, 0x0E, tima,    # LD B,TAC; LD C,TIMA
+                 0x16, div,                # LD D,DIV expected
+                 0xCD, "run_speed")        # CALL run_speed
+    asm.emit(0x10, 0x00)                   # STOP
+    asm.label("run_speed")
+    asm.emit(0x21, 0x07, 0xFF, 0x36, 0x00, # TAC = 0
+             0x21, 0x0F, 0xFF, 0x36, 0x00, # IF = 0
+             0x21, 0x05, 0xFF, 0x71,       # TIMA = C
+             0x21, 0x06, 0xFF, 0x71,       # TMA = C
+             0x21, 0x04, 0xFF, 0x36, 0x00, # DIV = 0
+             0x2E, 0x07, 0x70,             # TAC = B
+             0xFB, 0x76, 0x00,             # EI; HALT; NOP
+             0x2E, 0x04, 0x7E,             # LD A,(DIV)
+             0x21, 0x01, 0xFF, 0xBA)       # LD HL,SB; CP D
+    asm.jr(0x28, "passed")                 # JR Z,passed
+    asm.emit(0x36, 0x46)                   # LD (HL),"F"
+    asm.jr(0x18, "send")                   # JR send
+    asm.label("passed")
+    asm.emit(0x36, 0x2E)                   # LD (HL),"."
+    asm.label("send")
+    asm.emit(0x2E, 0x02, 0x36, 0x81,       # SC = $81
+             0xC9)                         # RET
+    return asm.build({0x50: [0xC9]})       # RET, leaving interrupts off
+
+
+def sprites_rom():
+    # All 40 sprites (8 on some lines) moving right every frame, copied in
+    # with OAM DMA at V-Blank, over a tiled background
+    asm = ROM_ASSEMBLER()
+    asm.emit(0x31, 0xFE, 0xDF)             # LD SP,$DFFE
+    # Random tiles
+    asm.emit(0x11, 0x00, 0x40, 0x21, 0x00, 0x80, 0x01, 0x00, 0x10)
+    asm.label("tiles")
+    asm.emit(0x1A, 0x13, 0x22, 0x0B, 0x78, 0xB1)
+    asm.jr(0x20, "tiles")
+    # Sprite table at $C000 from the one in ROM, and the DMA routine into
+    # HRAM, which is where the CPU has to wait out the DMA
+    asm.emit(0x11, "sprite_table", 0x21, 0x00, 0xC0, 0x0E, 160)
+    asm.label("table")
+    asm.emit(0x1A, 0x13, 0x22, 0x0D)
+    asm.jr(0x20, "table")
+    asm.emit(0x11, "dma_routine", 0x21, 0x80, 0xFF, 0x0E, 8)
+    asm.label("routine")
+    asm.emit(0x1A, 0x13, 0x22, 0x0D)
+    asm.jr(0x20, "routine")
+    asm.emit(0x3E, 0x93, 0xE0, 0x40,       # LCDC = on, sprites, background
+             0x3E, 0x01, 0xE0, 0xFF,       # IE = V-Blank
+             0xFB)                         # EI
+    asm.label("frame")
+    asm.emit(0x76, 0x00,                   # HALT until V-Blank
+             0x3E, 0xC0, 0xCD, 0x80, 0xFF, # DMA from $C000
+             0x21, 0x01, 0xC0, 0x0E, 40)   # X of each sprite
+    asm.label("move")
+    asm.emit(0x34, 0x23, 0x23, 0x23, 0x23, 0x0D) # INC (HL); HL += 4; DEC C
+    asm.jr(0x20, "move")
+    asm.emit(0xC3, "frame")
+    asm.label("dma_routine")
+    asm.emit(0xE0, 0x46, 0x3E, 0x28, 0x3D, 0x20, 0xFD, 0xC9)
+    asm.label("sprite_table")
+    for idx in range(40):
+        asm.emit(16 + (idx * 29) % 144, (idx * 37) % 168, idx, (idx & 3) << 5)
+    return asm.build({0x40: [0xD9]})       # RETI
+
+
+WORKLOADS = {
+    "alu": alu_rom,
+    "vram": vram_rom,
+    "timer": timer_rom,
+    "sprites": sprites_rom,
+}
+
+
+class SUBSYSTEM_TIMER(object):
+    # Wraps methods on a running system to add up the time spent in them
+    def __init__(self):
+        self.seconds = {}
+
+    def wrap(self, name, obj, method):
+        inner = getattr(obj, method)
+        seconds = self.seconds
+        seconds[name] = 0.0
+        clock = time.time
+        def timed(*args):
+            T_start = clock()
+            try:
+                return inner(*args)
+            finally:
+                seconds[name] += clock() - T_start
+        setattr(obj, method, timed)
+
+
+def bench_system(name, n_frames, renderer, recompile):
+    # Runs a workload (or ROM file) headless for n_frames worth of cycles,
+    # and returns its numbers as a dict
+    if name in WORKLOADS:
+        rom_bin = io.BytesIO(WORKLOADS[name]())
+        rom_bin.name = name
+    else:
+        rom_bin = open(name, "rb")
+    with rom_bin:
+        system = gb_main.GAMEBOY(rom_bin, recompile=recompile, renderer=renderer)
+
+    subsystems = SUBSYSTEM_TIMER()
+    subsystems.wrap("video", system.ppu, "catch_up")
+    subsystems.wrap("render", system.ppu.renderer, "render_line")
+    subsystems.wrap("timer", system.timer, "catch_up")
+
+    cycles = n_frames * gb_main.CYCLES_PER_FRAME
+    T_start = time.time()
+    n_instr, n_cycles = system.run(cycles)
+    T_total = time.time() - T_start
+
+    seconds = subsystems.seconds
+    # Rendering happens within the PPU's catch up, and everything else is
+    # the CPU (and bus)
+    seconds["video"] -= seconds["render"]
+    seconds["cpu"] = T_total - sum(seconds.values())
+
+    if resource is not None:
+        # Kilobytes on Linux, but bytes on macOS
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    else:
+        peak_rss = None
+
+    return {
+        "workload": name,
+        "renderer": system.ppu.renderer.name,
+        "recompile": recompile,
+        "frames": float(n_cycles) / gb_main.CYCLES_PER_FRAME,
+        "instructions": n_instr,
+        "cycles": n_cycles,
+        "seconds": T_total,
+        "instructions_per_second": n_instr / T_total,
+        "cycles_per_second": n_cycles / T_total,
+        "frames_per_second": float(n_cycles) / gb_main.CYCLES_PER_FRAME / T_total,
+        "subsystem_seconds": seconds,
+        "peak_rss": peak_rss,
+    }
+
+
+def lockstep(name, n_frames, renderer):
+    # Runs a workload (or ROM file) recompiled for n_frames, then an
+    # interpreted system up to exactly the same cycle, and returns the tags
+    # of the snapshot sections that came out different (None if the two
+    # never lined up on the same cycle). Everything in the system is
+    # compared, so this catches blocks that get the peripherals' view of
+    # things wrong as well as the CPU's.
+    systems = []
+    for recompile in (True, False):
+        if name in WORKLOADS:
+            rom_bin = io.BytesIO(WORKLOADS[name]())
+            rom_bin.name = name
+        else:
+            rom_bin = open(name, "rb")
+        with rom_bin:
+            systems.append(gb_main.GAMEBOY(rom_bin, recompile=recompile, renderer=renderer))
+    compiled, interpreted = systems
+
+    compiled.run(n_frames * gb_main.CYCLES_PER_FRAME)
+    target = compiled.scheduler.clock
+    # Blocks end on instruction boundaries, so stepping the interpreter
+    # through the last stretch one instruction at a time lands right on it
+    interpreted.run(target - interpreted.scheduler.clock - 128)
+    while interpreted.scheduler.clock < target:
+        interpreted.run(1)
+    if interpreted.scheduler.clock != target:
+        return None
+
+    for system in systems:
+        # The PPU and timer only catch up when something looks at them, so
+        # bring both up to the clock to compare where they've got to rather
+        # than when they were last asked
+        system.ppu.catch_up()
+        system.timer.catch_up()
+    compiled_sections = gb_snapshot.unpack(compiled.snapshot())
+    interpreted_sections = gb_snapshot.unpack(interpreted.snapshot())
+    return sorted(tag.decode().strip() for tag in compiled_sections
+                  if compiled_sections[tag] != interpreted_sections[tag])
+
+
+def opcode_trials(n_trials=40, seed=1234):
+    # Yields (name, trials) for every valid opcode, CB-prefixed ones as
+    # "CBxx", where each trial is a (memory, regs, sp, pc, IME) machine state
+    # to run the instruction from. Memory is one of a few random images with
+    # the instruction at PC, and every fifth trial has A on a value DAA and
+    # the carries care about. The sequence is fixed by the seed, and has to
+    # stay the same for the recorded digests to mean anything.
+    rng = random.Random(seed)
+    images = [bytearray(rng.getrandbits(8) for _ in range(0x10000)) for _ in range(4)]
+    for opcode in range(0x100):
+        if gb_opcodes.ops[opcode].func == "op_invalid":
+            continue
+        for cb_opcode in (range(0x100) if opcode == 0xCB else [None]):
+            trials = []
+            for trial in range(n_trials):
+                memory = bytearray(images[trial % len(images)])
+                regs = [rng.getrandbits(8) for _ in range(8)]
+                regs[gb_cpu.R_F] &= 0xF0
+                if trial % 5 == 0:
+                    regs[gb_cpu.R_A] = rng.choice([0x00, 0xFF, 0x0F, 0x10, 0x99, 0x9A])
+                pc = rng.choice([0x0100, 0x4000, rng.getrandbits(16) & 0xFFF0])
+                sp = rng.choice([0xFFFE, rng.getrandbits(16) & 0xFFF0 | 8])
+                ime = rng.random() < 0.5
+                memory[pc] = opcode
+                if cb_opcode is not None:
+                    memory[pc+1] = cb_opcode
+                trials.append((memory, regs, sp, pc, ime))
+            if cb_opcode is None:
+                yield "%02X" % opcode, trials
+            else:
+                yield "CB%02X" % cb_opcode, trials
+
+
+def memory_changes(before, after):
+    # (address, value) for every byte of after that's different, a page at a
+    # time since almost all of them aren't
+    changes = []
+    for page in range(0, len(before), 0x100):
+        if before[page:page+0x100] != after[page:page+0x100]:
+            changes.extend((addr, after[addr]) for addr in range(page, page+0x100)
+                           if before[addr] != after[addr])
+    return tuple(changes)
+
+
+def cpu_state(cpu, cycles):
+    return (tuple(int(value) for value in cpu.regs), int(cpu.sp), int(cpu.pc),
+            bool(cpu._IME), bool(cpu._halted), bool(cpu._stopped), int(cycles))
+
+
+def ram_cpu():
+    # A CPU with nothing but RAM over the whole address space
+    bus = gb_bus.BUS()
+    ram = gb_memory.RAM(0x10000)
+    bus.attach(ram, 0x0000, 0xFFFF)
+    return gb_cpu.CPU(bus), ram
+
+
+def set_cpu_state(cpu, ram, memory, regs, sp, pc, ime):
+    ram.ram_bytes[:] = memory
+    cpu.regs[:] = regs
+    cpu.sp = sp
+    cpu.pc = pc
+    cpu._IME = ime
+    cpu._halted = False
+    cpu._stopped = False
+
+
+def verify_cpu():
+    # Runs every trial from opcode_trials() on a CPU with RAM over the whole
+    # address space, and returns {name: digest} of the registers, flags,
+    # cycle counts and memory changes each opcode produced. The same digests
+    # from the original interpreter are in OPCODE_DIGESTS.
+    cpu, ram = ram_cpu()
+    digests = {}
+    for name, trials in opcode_trials():
+        digest = hashlib.md5()
+        for memory, regs, sp, pc, ime in trials:
+            set_cpu_state(cpu, ram, memory, regs, sp, pc, ime)
+            cycles = cpu.step()
+            digest.update(repr(cpu_state(cpu, cycles) + (memory_changes(memory, ram.ram_bytes),)).encode())
+        digests[name] = digest.hexdigest()
+    return digests
+
+
+def verify_blocks():
+    # Compiles every trial from opcode_trials() with a HALT after the
+    # instruction, which ends the block there, and checks that running it
+    # does exactly what the interpreter does. Returns ({name: trials that
+    # compiled}, [names of opcodes whose blocks came out different]).
+    compiled_cpu, compiled_ram = ram_cpu()
+    interpreted_cpu, interpreted_ram = ram_cpu()
+    compiled = {}
+    mismatched = []
+    for name, trials in opcode_trials():
+        compiled[name] = 0
+        for memory, regs, sp, pc, ime in trials:
+            memory[(pc + gb_opcodes.ops[memory[pc]].length) & 0xFFFF] = 0x76
+            set_cpu_state(compiled_cpu, compiled_ram, memory, regs, sp, pc, ime)
+            set_cpu_state(interpreted_cpu, interpreted_ram, memory, regs, sp, pc, ime)
+            builder = gb_recompiler.BLOCK_BUILDER(compiled_cpu, pc)
+            block = builder.build()
+            if block is None:
+                continue
+            compiled[name] += 1
+            func, end = block
+            compiled_cycles = func(compiled_cpu)
+            interpreted_cycles = 0
+            for _ in range(builder.n_instrs):
+                interpreted_cycles += interpreted_cpu.step()
+            if (cpu_state(compiled_cpu, compiled_cycles) != cpu_state(interpreted_cpu, interpreted_cycles) or
+                    compiled_ram.ram_bytes != interpreted_ram.ram_bytes):
+                mismatched.append(name)
+                break
+    return compiled, mismatched
+
+
+def load_opcode_digests():
+    digests = {}
+    with open(OPCODE_DIGESTS, "r") as f:
+        for line in f:
+            fields = line.split("#", 1)[0].split()
+            if len(fields) == 2:
+                digests[fields[0]] = fields[1]
+    return digests
+
+
+def run_suite(workloads, n_frames, renderer, recompile):
+    # Every workload gets a fresh interpreter, so that the peak memory is
+    # its own and a JIT starts cold each time
+    results = []
+    for name in workloads:
+        command = [sys.executable, os.path.abspath(__file__), "--case", name,
+                   "--frames", str(n_frames), "--renderer", renderer]
+        if recompile:
+            command.append("--recompile")
+        output = subprocess.check_output(command)
+        results.append(json.loads(output.splitlines()[-1]))
+    return {
+        "python": platform.python_implementation(),
+        "python_version": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description='Measure emulator core throughput')
+    parser.add_argument('romfiles', metavar='ROMFILE', type=str, nargs='*',
+                        help='Gameboy ROMs to run (e.g. tests/test.gb)')
+    parser.add_argument('--instructions', '-n', metavar='N', type=int, default=200000,
+                        help='Number of instructions to execute per ROM')
+    parser.add_argument('--frames', '-f', metavar='N', type=int, default=60,
+                        help='Number of frames to draw per renderer, or to emulate per workload with --suite')
+    parser.add_argument('--suite', action='store_true',
+                        help='Run the whole system headless over the generated workloads (%s) and any ROMFILEs, and report JSON' % ", ".join(sorted(WORKLOADS)))
+    parser.add_argument('--workload', '-w', metavar='NAME', action='append',
+                        help='With --suite or --lockstep, only run this workload (can be given more than once)')
+    parser.add_argument('--renderer', choices=['python', 'numpy'], default='python',
+                        help='Renderer for --suite')
+    parser.add_argument('--recompile', action='store_true',
+                        help='Use the recompiler for --suite')
+    parser.add_argument('--json', metavar='FILE', type=str,
+                        help='Write the --suite results here instead of stdout')
+    parser.add_argument('--lockstep', action='store_true',
+                        help='Check that recompiled and interpreted runs of the workloads (and any ROMFILEs) end up in exactly the same state')
+    parser.add_argument('--verify', action='store_true',
+                        help='Check that every opcode does exactly what it did in the original interpreter, and the same compiled')
+    parser.add_argument('--case', metavar='NAME', type=str,
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case is not None:
+        # One workload of a suite, run in its own process
+        print(json.dumps(bench_system(args.case, args.frames, args.renderer, args.recompile)))
+        sys.exit(0)
+
+    if args.suite:
+        workloads = (args.workload or sorted(WORKLOADS)) + args.romfiles
+        results = run_suite(workloads, args.frames, args.renderer, args.recompile)
+        if args.json is not None:
+            with open(args.json, "w") as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        else:
+            print(json.dumps(results, indent=2, sort_keys=True))
+        sys.exit(0)
+
+    if args.lockstep:
+        workloads = (args.workload or sorted(WORKLOADS)) + args.romfiles
+        mismatched = False
+        for name in workloads:
+            differences = lockstep(name, args.frames, args.renderer)
+            if differences is None:
+                print("%-24s never reached the same cycle" % name)
+                mismatched = True
+            elif differences:
+                print("%-24s differs in %s" % (name, ", ".join(differences)))
+                mismatched = True
+            else:
+                print("%-24s matches" % name)
+            sys.stdout.flush()
+        sys.exit(1 if mismatched else 0)
+
+    if args.verify:
+        expected = load_opcode_digests()
+        digests = verify_cpu()
+        mismatched = sorted(name for name in set(expected) | set(digests)
+                            if digests.get(name) != expected.get(name))
+        for name in mismatched:
+            print("Opcode %-4s differs from the original interpreter (now %s)" % (name, digests.get(name)))
+        print("CPU: %d of %d opcodes match the original interpreter" % (
+            len(expected) - len(mismatched), len(expected)))
+        sys.stdout.flush()
+
+        compiled, block_mismatched = verify_blocks()
+        for name in block_mismatched:
+            print("Opcode %-4s compiles to something different from the interpreter" % name)
+        n_compiled = len([name for name in compiled if compiled[name]])
+        print("Recompiler: %d of %d compilable opcodes (%d trials) match the interpreter" % (
+            n_compiled - len(block_mismatched), n_compiled, sum(compiled.values())))
+        sys.exit(1 if mismatched or block_mismatched else 0)
+
+    if len(args.romfiles) == 0:
+        parser.error("ROMFILEs are needed unless running --suite, --lockstep or --verify")
+
+    print("%-24s %14s %14s %8s" % ("ROM", "linear instr/s", "table instr/s", "speedup"))
+    for romfile in args.romfiles:
+        linear_ips = bench_bus(romfile, LINEAR_BUS, args.instructions)
+        table_ips = bench_bus(romfile, gb_bus.BUS, args.instructions)
+        print("%-24s %14.0f %14.0f %7.2fx" % (romfile, linear_ips, table_ips, table_ips / linear_ips))
+    sys.stdout.flush()
+
+    print("")
+    print("%-8s %11s %11s %11s" % ("renderer", "static fps", "scroll fps", "fade fps"))
+    for renderer in ("python", "numpy"):
+        results = [bench_video(renderer, args.frames, effect) for effect in (None, "scroll", "fade")]
+        if None in results:
+            print("%-8s %11s %11s %11s" % (renderer, "-", "-", "-"))
+        else:
+            print("%-8s %11.1f %11.1f %11.1f" % ((renderer,) + tuple(results)))
+        sys.stdout.flush()
@@ -2,80 +2,182 @@
 class BUS(object):
     def __init__(self):
         self.devices = []
-        # TODO: remove profiling code:
-        # self.reads = {}
-
-        # Hard-code access to these because they're
-        # read a LOT
-        #
-        # TODO: maybe should just redesign 
-        # the BUS to be entirely hardcoded?
-        self.ie_reg = None
-        self.if_reg = None
+        # Flat decode table with one entry per address, so an access is a
+        # single index instead of a scan over the device list. Only
+        # rebuilt when a device gets attached.
+        self.device_map = [None] * 0x10000
+
+        # Fast path for devices that are plain memory: one entry per 256 byte
+        # page, holding a (buffer, base) pair such that the byte at addr is
+        # buffer[addr - base]. These skip bus_read/bus_write entirely, and
+        # are refreshed through remap() whenever a device is enabled or
+        # disabled or (for cartridge ROM) switches banks.
+        self.read_pages = [None] * 0x100
+        self.write_pages = [None] * 0x100
+
+        # HRAM shares its page with the IO registers so it can't go in the
+        # page tables. Hard-code access to it because it's read a LOT
+        self.hram = None
+        self.hram_page = None
+
+        # Pages whose writes get reported to a watcher (see watch_writes)
+        self.write_watchers = {}
 
     def attach(self, device, addr_lo, addr_hi):
         if not isinstance(device, BUS_OBJECT):
             raise TypeError()
         if device.bus is not None:
             raise Exception("Bus object already attached")
+        if self.device_map[addr_lo:addr_hi+1].count(None) != addr_hi - addr_lo + 1:
+            for addr in range(addr_lo, addr_hi+1):
+                if self.device_map[addr] is not None:
+                    raise Exception("Bus object overlaps %s at address 0x%04X" %
+                        (type(self.device_map[addr]).__name__, addr))
 
-        if addr_lo == 0xffff:
-            self.ie_reg = device
-        if addr_lo == 0xff0f:
-            self.if_reg = device
+        if addr_lo == 0xff80:
+            self.hram = device
 
         device.bus_addr_lo = addr_lo
         device.bus_addr_hi = addr_hi
         self.devices.append((device, addr_lo, addr_hi))
         self.devices.sort(key=lambda d: d[0].bus_addr_lo)
         device.bus = self
-        # TODO: ensure no overlap
+
+        self.device_map[addr_lo:addr_hi+1] = [device] * (addr_hi - addr_lo + 1)
+        self.remap(device)
+
+    def remap(self, device):
+        addr_lo = device.bus_addr_lo
+        addr_hi = device.bus_addr_hi
+
+        page = None
+        if device._bus_enabled:
+            buf = device.bus_buffer()
+            if buf is not None:
+                page = (buf[0], addr_lo - buf[1])
+
+        if device is self.hram:
+            self.hram_page = page
+        elif (addr_lo & 0xFF) == 0x00 and (addr_hi & 0xFF) == 0xFF:
+            page_lo = addr_lo >> 8
+            page_hi = addr_hi >> 8
+            n_pages = page_hi - page_lo + 1
+            self.read_pages[page_lo:page_hi+1] = [page] * n_pages
+            if not device.bus_buffer_writable:
+                page = None
+            pages = [page] * n_pages
+            if page is not None:
+                for page_idx in range(page_lo, page_hi+1):
+                    watcher = self.write_watchers.get(page_idx)
+                    if watcher is not None:
+                        pages[page_idx - page_lo] = (WATCHED_BUFFER(page[0], page[1], watcher), page[1])
+            self.write_pages[page_lo:page_hi+1] = pages
+
+    def watch_writes(self, page_idx, watcher):
+        # Report every write into the given 256 byte page to
+        # watcher.bus_write_watch(addr), after it has happened. Only works for
+        # pages on the write fast path.
+        self.write_watchers[page_idx] = watcher
+        device = self.device_map[page_idx << 8]
+        if device is not None:
+            self.remap(device)
+
+    def unwatch_writes(self, page_idx):
+        if self.write_watchers.pop(page_idx, None) is not None:
+            device = self.device_map[page_idx << 8]
+            if device is not None:
+                self.remap(device)
 
     def read(self, addr, force=False):
-        if addr == 0xffff:
-            return self.ie_reg.bus_read(0)
-        if addr == 0xff0f:
-            return self.if_reg.bus_read(0)
-
-        for device, addr_lo, addr_hi in self.devices:
-            if addr_lo <= addr <= addr_hi:
-                # TODO: remove profiling code:
-                #self.reads[addr_lo] = self.reads.get(addr_lo, 0)+1
-                if device.bus_enabled or force:
-                    return device.bus_read(addr - addr_lo)
-                else:
-                    return 0xFF
-        print("WARNING: Read from HiZ address 0x%04lX" % addr)
-        return 0xFF
+        page = self.read_pages[addr >> 8]
+        if page is not None:
+            return page[0][addr - page[1]]
+        if 0xFF80 <= addr < 0xFFFF:
+            page = self.hram_page
+            if page is not None:
+                return page[0][addr - page[1]]
+
+        device = self.device_map[addr]
+        if device is None:
+            print("WARNING: Read from HiZ address 0x%04lX" % addr)
+            return 0xFF
+        if device._bus_enabled or force:
+            return device.bus_read(addr - device.bus_addr_lo)
+        else:
+            return 0xFF
 
     def write(self, addr, value, force=False):
-        for device, addr_lo, addr_hi in self.devices:
-            if addr_lo <= addr <= addr_hi:
-                if device.bus_enabled or force:
-                    device.bus_write(addr - addr_lo, value)
+        page = self.write_pages[addr >> 8]
+        if page is not None:
+            page[0][addr - page[1]] = value
+            return
+        if 0xFF80 <= addr < 0xFFFF:
+            page = self.hram_page
+            if page is not None:
+                page[0][addr - page[1]] = value
                 return
-        print("WARNING: Write to HiZ address 0x%04lX" % addr)
+
+        device = self.device_map[addr]
+        if device is None:
+            print("WARNING: Write to HiZ address 0x%04lX" % addr)
+            return
+        if device._bus_enabled or force:
+            device.bus_write(addr - device.bus_addr_lo, value)
 
     def read_16(self, addr):
-        return self.read(addr) | (self.read(addr+1) << 8)
+        return self.read(addr) | (self.read((addr+1) & 0xFFFF) << 8)
 
     def write_16(self, addr, value):
         self.write(addr, value & 0xFF)
-        self.write(addr+1, value >> 8)
+        self.write((addr+1) & 0xFFFF, value >> 8)
+
+
+class WATCHED_BUFFER(object):
+    # Stands in for a page's buffer in the write fast path, passing writes
+    # through and then telling the watcher about them
+    def __init__(self, buffer, base, watcher):
+        self.buffer = buffer
+        self.base = base
+        self.watcher = watcher
+
+    def __setitem__(self, idx, value):
+        self.buffer[idx] = value
+        self.watcher.bus_write_watch(self.base + idx)
 
 
 class BUS_OBJECT(object):
+    # Set on devices whose bus_buffer() may also be written through directly
+    bus_buffer_writable = False
+
     def __init__(self):
         self.bus_addr_lo = None
         self.bus_addr_hi = None
-        self.bus_enabled = True
         self.bus = None
+        self.bus_enabled = True
 
+    @property
+    def bus_enabled(self):
+        return self._bus_enabled
+
+    @bus_enabled.setter
+    def bus_enabled(self, en):
+        # The PPU sets these on every mode change, mostly to what they
+        # already are, and remapping isn't free
+        if en == getattr(self, "_bus_enabled", None):
+            return
+        self._bus_enabled = en
+        if self.bus is not None:
+            self.bus.remap(self)
+
+    def bus_buffer(self):
+        # Devices that are just a block of memory can return a
+        # (buffer, offset) pair here, where buffer[offset+addr] is the value
+        # bus_read(addr) would return. The bus will then index the buffer
+        # directly instead of calling bus_read.
+        return None
 
     def bus_read(self, addr):
         raise Exception("Unimplemented method %s.bus_read" % str(type(self)))
 
     def bus_write(self, addr, value):
         raise Exception("Unimplemented method %s.bus_write" % str(type(self)))
-
-
@@ -6,6 +6,8 @@ import imp
 import traceback
 import os
 
+import opcodes
+
 class Tee(object):
     def __init__(self, name, mode):
         self.file = open(name, mode)
@@ -61,6 +63,16 @@ class DEBUGGER(object):
                 addr = self.system.cpu.PC.read() + addr
             return self.system.bus.read(addr)
 
+        def dis(addr=None, count=8):
+            if addr is None:
+                addr = self.system.cpu.PC.read()
+            for _ in range(count):
+                mnemonic, length = opcodes.disassemble(self.system.bus, addr)
+                raw = " ".join("%02X" % self.system.bus.read((addr+idx) & 0xFFFF)
+                    for idx in range(length))
+                print("0x%04X  %-9s %s" % (addr, raw, mnemonic))
+                addr = (addr + length) & 0xFFFF
+
         def new(trigger):
             name = "B%d" % len(self.breakpoints)
             self.breakpoints[name] = trigger
@@ -86,15 +98,35 @@ class DEBUGGER(object):
                 self.verbose = en
             return self.verbose
 
+        def stats(json_file=None):
+            if self.system.instruments is None:
+                print("Instrumentation is off (run with --instrument)")
+            elif json_file is not None:
+                self.system.instruments.dump_json(json_file)
+            else:
+                print(self.system.instruments.report())
+
+        def profile(folded_file=None):
+            if self.system.guest_profiler is None:
+                print("Guest profiling is off (run with --guest-profile)")
+            elif folded_file is not None:
+                with open(folded_file, "w") as f:
+                    self.system.guest_profiler.write_folded(f)
+            else:
+                print(self.system.guest_profiler.report())
+
         self.debug_locals = {}
         self.debug_locals["breakpoints"] = self.breakpoints
         self.debug_locals["watch"] = watch
         self.debug_locals["new"] = new
         self.debug_locals["instr"] = instr
+        self.debug_locals["dis"] = dis
         self.debug_locals["step"] = step
         self.debug_locals["set_trace"] = set_trace
         self.debug_locals["verbose"] = en_verbose
         self.debug_locals["load"] = load
+        self.debug_locals["stats"] = stats
+        self.debug_locals["profile"] = profile
         self.debug_locals.update(self.system.__dict__)
 
         # TODO: the scope for tab completions isn't right
@@ -0,0 +1,181 @@
+# Frontends connect a GAMEBOY to the outside world: they're handed the
+# framebuffer at every V-Blank, feed the joypad, and play the sound. The
+# system itself runs fine without one (see GAMEBOY(rom, frontend=None)), in
+# which case the picture is only ever in VIDEO.framebuffer and nobody pulls
+# any samples out of the APU.
+#
+# Only PYGAME_FRONTEND needs pygame, and it only imports it once it's
+# actually built, so headless runs work on machines without it (or without
+# a display).
+
+import time
+
+pygame = None
+
+SCREEN_SIZE = (160, 144)
+
+BUTTONS = ("right", "left", "up", "down", "a", "b", "select", "start")
+# Not joypad buttons, but can be held down in input scripts just the same
+CONTROLS = ("rewind",)
+
+
+def load_input_script(f):
+    # Reads a script of joypad changes, one per line:
+    #   FRAME BUTTON down|up
+    # where FRAME counts input polls (one per frame's worth of cycles) from
+    # the start of the run, and BUTTON is a joypad button or one of CONTROLS.
+    # Blank lines and anything after a # are ignored.
+    script = []
+    for line_no, line in enumerate(f, 1):
+        fields = line.split("#", 1)[0].split()
+        if len(fields) == 0:
+            continue
+        if (len(fields) != 3 or fields[1] not in BUTTONS + CONTROLS or
+                fields[2] not in ("down", "up")):
+            raise Exception("Bad input script line %i: %s" % (line_no, line.strip()))
+        script.append((int(fields[0], 0), fields[1], fields[2] == "down"))
+    return script
+
+
+class SCRIPTED_FRONTEND(object):
+    # No screen or speakers, just joypad input played back from a script of
+    # (frame, button, pressed) entries
+    def __init__(self, script=None):
+        self.script = sorted(script or [], key=lambda entry: entry[0])
+        self.script_idx = 0
+        self.frame = 0
+
+    def attach(self, system):
+        pass
+
+    def present(self, video):
+        pass
+
+    def poll_input(self, system):
+        keys = {}
+        while (self.script_idx < len(self.script) and
+                self.script[self.script_idx][0] <= self.frame):
+            frame, button, pressed = self.script[self.script_idx]
+            keys[button] = pressed
+            self.script_idx += 1
+        self.frame += 1
+        if "rewind" in keys:
+            system.rewinding = keys.pop("rewind")
+        if len(keys) > 0:
+            system.joypad.update(keys)
+
+
+class PYGAME_FRONTEND(object):
+    def __init__(self, scale=4, sample_rate=44100):
+        global pygame
+        import pygame
+
+        pygame.mixer.pre_init(sample_rate, -16, 1, 1024)
+        pygame.init()
+        pygame.display.set_caption("pygb")
+        pygame.key.set_repeat(10, 10)
+
+        # TODO: allow for configurable keybindings
+        self.key_bindings = {
+            pygame.K_LEFT: "left",
+            pygame.K_RIGHT: "right",
+            pygame.K_UP: "up",
+            pygame.K_DOWN: "down",
+            pygame.K_z: "a",
+            pygame.K_x: "b",
+            pygame.K_RETURN: "start",
+            pygame.K_TAB: "select",
+        }
+
+        self.window = pygame.display.set_mode((SCREEN_SIZE[0]*scale, SCREEN_SIZE[1]*scale))
+        self.colors = [
+            pygame.Color(0xFC, 0xFC, 0xFC, 0xFF),
+            pygame.Color(0xBC, 0xBC, 0xBC, 0xFF),
+            pygame.Color(0x74, 0x74, 0x74, 0xFF),
+            pygame.Color(0x00, 0x00, 0x00, 0xFF),
+        ]
+        self.window.fill(self.colors[3])
+
+        self.framebuffer = None
+        self.pcm_stream = None
+
+        # For showing the emulated frame rate in the title bar
+        self.fps_time = time.time()
+        self.fps_frame = 0
+
+        # Key repeat is on, so the fast-forward key only toggles again once
+        # it's been let go
+        self.fast_forward_held = False
+
+    def attach(self, system):
+        # Called once the system is built
+        if self.pcm_stream is not None:
+            self.pcm_stream.disconnect()
+        self.pcm_stream = system.apu.pcm_stream
+        self.pcm_stream.connect()
+        self.present(system.ppu)
+
+    def make_surfaces(self, video):
+        # The framebuffer as an 8-bit surface (sharing its memory) whose
+        # palette turns shades into colours, and a surface in the window's
+        # format to convert it into before scaling. Both get reused for every
+        # frame.
+        size = (video.width, video.height)
+        self.framebuffer = video.framebuffer
+        self.frame_surface = pygame.image.frombuffer(self.framebuffer, size, "P")
+        self.frame_surface.set_palette(self.colors)
+        self.screen_surface = pygame.Surface(size, 0, self.window)
+
+    def present(self, video):
+        if video.framebuffer is not self.framebuffer:
+            self.make_surfaces(video)
+        self.screen_surface.blit(self.frame_surface, (0, 0))
+        pygame.transform.scale(self.screen_surface, self.window.get_size(), self.window)
+        pygame.display.flip()
+
+        now = time.time()
+        if now - self.fps_time >= 1:
+            fps = (video.frame - self.fps_frame) / (now - self.fps_time)
+            if video.frameskip > 1:
+                pygame.display.set_caption("pygb - %.1f fps (fast-forward)" % fps)
+            else:
+                pygame.display.set_caption("pygb - %.1f fps" % fps)
+            self.fps_time = now
+            self.fps_frame = video.frame
+
+    def poll_input(self, system):
+        keys = {}
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                system.exit_trigger = True
+            elif event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_ESCAPE:
+                    system.exit_trigger = True
+                elif event.key in (pygame.K_F5, pygame.K_F7):
+                    if system.cart.filename is None:
+                        # The ROM didn't come from a file, so there's
+                        # nowhere to put its state
+                        print("WARNING: No ROM filename to save state next to")
+                    elif event.key == pygame.K_F5:
+                        system.save_state(system.cart.filename+".pygb.sav")
+                    else:
+                        system.load_state(system.cart.filename+".pygb.sav")
+                elif event.key == pygame.K_PAUSE:
+                    system.debug_trigger = True
+                elif event.key == pygame.K_SPACE:
+                    if not self.fast_forward_held:
+                        system.set_fast_forward(not system.fast_forward)
+                    self.fast_forward_held = True
+                elif event.key == pygame.K_BACKSPACE:
+                    system.rewinding = True
+                elif event.key in self.key_bindings:
+                    keys[self.key_bindings[event.key]] = True
+            elif event.type == pygame.KEYUP:
+                if event.key == pygame.K_SPACE:
+                    self.fast_forward_held = False
+                elif event.key == pygame.K_BACKSPACE:
+                    system.rewinding = False
+                elif event.key in self.key_bindings:
+                    keys[self.key_bindings[event.key]] = False
+        if len(keys) > 0:
+            system.joypad.update(keys)
@@ -0,0 +1,249 @@
+# Optional counters for seeing where the emulator spends its time: bus
+# accesses per device and page, instructions per mnemonic, time and cycles
+# per subsystem, interrupts serviced and ROM bank switches.
+#
+# Nothing in the emulator knows about these. install() swaps counting
+# versions of the hot methods in as instance attributes on one system's
+# objects, and uninstall() takes them out again, so a system that isn't
+# being instrumented runs exactly the code it always does.
+#
+# Instructions run from recompiled blocks don't go through the CPU's
+# dispatch table, so only interpreted ones get counted (the recompiler keeps
+# its own statistics).
+
+import json
+import time
+
+import opcodes
+
+INTERRUPT_NAMES = {
+    0x40: "v_blank",
+    0x48: "lcd_stat",
+    0x50: "timer",
+    0x58: "serial",
+    0x60: "joypad",
+}
+
+class PATCHER(object):
+    # Keeps track of what's been swapped into a system so it can be put back.
+    # Patchers that share a system have to come out in the reverse order
+    # they went in.
+    def __init__(self):
+        self.patched = []
+
+    def patch(self, obj, name, value):
+        # Remembers what to put back: nothing if it's a method that was only
+        # on the class, otherwise the old value (CPU has __slots__, so
+        # anything set on it must have been there already)
+        from_class = (hasattr(obj, "__dict__") and name != "__class__"
+                      and name not in obj.__dict__)
+        self.patched.append((obj, name, None if from_class else getattr(obj, name)))
+        setattr(obj, name, value)
+
+    def uninstall(self):
+        # Puts back whatever was there before (which for methods is nothing,
+        # so the class's own gets used again)
+        for obj, name, old_value in reversed(self.patched):
+            if old_value is None:
+                delattr(obj, name)
+            else:
+                setattr(obj, name, old_value)
+        self.patched = []
+
+class INSTRUMENTS(PATCHER):
+    def __init__(self):
+        super(INSTRUMENTS, self).__init__()
+        self.reset()
+
+    def reset(self):
+        # Per address, so they can be totalled per device and per page
+        self.reads = [0] * 0x10000
+        self.writes = [0] * 0x10000
+
+        # Per opcode, with CB-prefixed ones separate
+        self.op_counts = [0] * 0x100
+        self.cb_op_counts = [0] * 0x100
+
+        # subsystem: [calls, cycles, seconds]. Cycles are the ones executed
+        # for the CPU, caught up over for the PPU and timer, and samples
+        # generated for the APU. Timing every instruction would cost more
+        # than the instruction, so the CPU's time isn't measured.
+        self.subsystems = {
+            "cpu": [0, 0, None],
+            "ppu": [0, 0, 0.0],
+            "timer": [0, 0, 0.0],
+            "apu": [0, 0, 0.0],
+        }
+
+        self.interrupts = dict((name, 0) for name in INTERRUPT_NAMES.values())
+        self.bank_switches = 0
+
+    def install(self, system):
+        # Called once the system is built
+        self.uninstall()
+        self.system = system
+        self.install_bus(system.bus)
+        self.install_cpu(system.cpu)
+        self.install_timed("ppu", system.ppu, "advance")
+        self.install_timed("timer", system.timer, "advance")
+        self.install_apu(system.apu.pcm_stream)
+        self.install_mbc(system.cart.mbc)
+
+    def install_bus(self, bus):
+        reads = self.reads
+        writes = self.writes
+        read = bus.read
+        write = bus.write
+        def counting_read(addr, force=False):
+            reads[addr] += 1
+            return read(addr, force)
+        def counting_write(addr, value, force=False):
+            writes[addr] += 1
+            write(addr, value, force)
+        # read_16/write_16 go through these too
+        self.patch(bus, "read", counting_read)
+        self.patch(bus, "write", counting_write)
+
+    def install_cpu(self, cpu):
+        cpu_stats = self.subsystems["cpu"]
+        def counted(counts, opcode, op):
+            def counting_op():
+                counts[opcode] += 1
+                cycles = op()
+                cpu_stats[0] += 1
+                cpu_stats[1] += cycles
+                return cycles
+            return counting_op
+        ops = [counted(self.op_counts, opcode, op) for opcode, op in enumerate(cpu.ops)]
+        cb_ops = [counted(self.cb_op_counts, opcode, op) for opcode, op in enumerate(cpu.cb_ops)]
+        # The CB prefix hands over to cb_ops, which counts it
+        ops[0xCB] = cpu.ops[0xCB]
+        self.patch(cpu, "ops", ops)
+        self.patch(cpu, "cb_ops", cb_ops)
+
+        # No instance attributes to hide service_interrupts behind, so the
+        # CPU becomes a subclass that counts for as long as it's installed
+        interrupts = self.interrupts
+        base = type(cpu)
+        class COUNTING_CPU(base):
+            __slots__ = ()
+            def service_interrupts(self):
+                pc = self.pc
+                cycles = base.service_interrupts(self)
+                if self.pc != pc:
+                    interrupts[INTERRUPT_NAMES[self.pc]] += 1
+                return cycles
+        self.patch(cpu, "__class__", COUNTING_CPU)
+
+    def install_timed(self, name, device, method):
+        # For advance(delta) methods
+        stats = self.subsystems[name]
+        inner = getattr(device, method)
+        clock = time.time
+        def timed(delta):
+            T_start = clock()
+            inner(delta)
+            stats[0] += 1
+            stats[1] += delta
+            stats[2] += clock() - T_start
+        self.patch(device, method, timed)
+
+    def install_apu(self, pcm_stream):
+        stats = self.subsystems["apu"]
+        fill_data = pcm_stream.fill_data
+        clock = time.time
+        def timed_fill_data(n_words):
+            T_start = clock()
+            fill_data(n_words)
+            stats[0] += 1
+            stats[1] += n_words // pcm_stream.n_channels
+            stats[2] += clock() - T_start
+        self.patch(pcm_stream, "fill_data", timed_fill_data)
+
+    def install_mbc(self, mbc):
+        if not hasattr(mbc, "switch_bank"):
+            return
+        switch_bank = mbc.switch_bank
+        def counting_switch_bank(rom_bank):
+            if rom_bank != mbc.rom_bank:
+                self.bank_switches += 1
+            switch_bank(rom_bank)
+        self.patch(mbc, "switch_bank", counting_switch_bank)
+
+    def device_name(self, addr):
+        device = self.system.bus.device_map[addr]
+        if device is None:
+            return "HiZ"
+        return "%s@0x%04X" % (type(device).__name__, device.bus_addr_lo)
+
+    def by_device(self, counts):
+        totals = {}
+        for addr, count in enumerate(counts):
+            if count:
+                name = self.device_name(addr)
+                totals[name] = totals.get(name, 0) + count
+        return totals
+
+    def by_page(self, counts):
+        totals = {}
+        for page_idx in range(0x100):
+            count = sum(counts[page_idx << 8:(page_idx + 1) << 8])
+            if count:
+                totals["0x%02X" % page_idx] = count
+        return totals
+
+    def by_mnemonic(self):
+        totals = {}
+        for opcode, count in enumerate(self.op_counts):
+            if count:
+                totals[opcodes.ops[opcode].name] = count
+        for opcode, count in enumerate(self.cb_op_counts):
+            if count:
+                totals[opcodes.cb_ops[opcode].name] = count
+        return totals
+
+    def to_dict(self):
+        return {
+            "subsystems": dict((name, {"calls": stats[0], "cycles": stats[1], "seconds": stats[2]})
+                               for name, stats in self.subsystems.items()),
+            "interrupts": self.interrupts,
+            "bank_switches": self.bank_switches,
+            "reads_by_device": self.by_device(self.reads),
+            "writes_by_device": self.by_device(self.writes),
+            "reads_by_page": self.by_page(self.reads),
+            "writes_by_page": self.by_page(self.writes),
+            "instructions": self.by_mnemonic(),
+        }
+
+    def dump_json(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+
+    def report(self, top=10):
+        def ranked(totals):
+            return sorted(totals.items(), key=lambda item: -item[1])[:top]
+
+        out = ["Instrumentation:"]
+        out.append("  %-6s %10s %12s %9s" % ("", "calls", "cycles", "seconds"))
+        for name in ("cpu", "ppu", "timer", "apu"):
+            calls, cycles, seconds = self.subsystems[name]
+            if seconds is None:
+                out.append("  %-6s %10d %12d %9s" % (name, calls, cycles, "-"))
+            else:
+                out.append("  %-6s %10d %12d %9.3f" % (name, calls, cycles, seconds))
+        out.append("  (APU cycles are samples generated)")
+        out.append("  Interrupts: " + ", ".join("%s %d" % item for item in sorted(self.interrupts.items())))
+        out.append("  ROM bank switches: %d" % self.bank_switches)
+
+        reads = self.by_device(self.reads)
+        writes = self.by_device(self.writes)
+        out.append("  %-24s %10s %10s" % ("Device", "reads", "writes"))
+        for name in sorted(set(reads) | set(writes), key=lambda name: -(reads.get(name, 0) + writes.get(name, 0))):
+            out.append("  %-24s %10d %10d" % (name, reads.get(name, 0), writes.get(name, 0)))
+
+        out.append("  Busiest pages: " + ", ".join("%s %d" % item for item in ranked(
+            self.by_page([r + w for r, w in zip(self.reads, self.writes)]))))
+        out.append("  Most run instructions:")
+        for mnemonic, count in ranked(self.by_mnemonic()):
+            out.append("    %-16s %10d" % (mnemonic, count))
+        return "\n".join(out)
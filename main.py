@@ -3,8 +3,6 @@
 
 # For the frontend
 import sys
-import pygame
-import pickle
 import time
 import traceback
 import argparse
@@ -16,22 +14,45 @@ import video as gb_video
 import sound as gb_sound
 import bus as gb_bus
 import cpu as gb_cpu
+import recompiler as gb_recompiler
+import scheduler as gb_scheduler
+import snapshot as gb_snapshot
+import frontend as gb_frontend
+import pacer as gb_pacer
+import instrument as gb_instrument
+import profiler as gb_profiler
+import rewind as gb_rewind
+
+# Host input is only looked at once per frame's worth of cycles
+CYCLES_PER_FRAME = 70224
+
+# While fast-forwarding, only one frame in this many gets drawn
+FAST_FORWARD_SPEED = 8
 
 # TODO: move TIMER to sound, JOYPAD to uh, somewhere else...
 
+TIMER_STATE = gb_snapshot.FIELDS([
+    ("clock", "i"), ("div_clock", "i"), ("cycle", "q"), ("enabled", "?"),
+    ("speed_select", "B"), ("reload_tick", "B"), ("load_value", "B"),
+])
+SERIAL_STATE = gb_snapshot.FIELDS([("data", "B"), ("control", "B")])
+JOYPAD_STATE = gb_snapshot.FIELDS([
+    ("direction_select", "?"), ("button_select", "?"),
+    ("directions", "B"), ("buttons", "B"),
+])
+SYSTEM_STATE = gb_snapshot.FIELDS([("dma_blockade", "?"), ("input_clock", "q")])
+
 class TIMER(gb_bus.BUS_OBJECT):
-    def __init__(self):
+    def __init__(self, scheduler):
         super(TIMER, self).__init__()
         self.clock = 0
 
-
-        self.div_tick = 0.0
         self.div_clock = 0
 
-        # TODO: these numbers are in the CPU class too, pull them out
-        # somewhere:
-        self.f = 4.194304e6
-        self.div_T = 1 / self.f # 2.384185791015625e-07
+        # DIV counts master clock cycles, and this is the cycle it's been
+        # counted up to
+        self.scheduler = scheduler
+        self.cycle = scheduler.clock
 
         self.enabled = 0
         self.speed_select = 0
@@ -50,43 +71,101 @@ class TIMER(gb_bus.BUS_OBJECT):
         self.speed_select = 0
 
     def advance(self, delta):
-        # Note that delta is **SIMULATED** time
-        self.div_tick += delta
+        # Note that delta is in master clock cycles
+        while delta > 0:
+            if self.reload_tick > 0:
+                # At most a few ticks, so just run them one by one
+                self.tick()
+                delta -= 1
+                continue
 
-        while self.div_tick >= self.div_T:
-            self.div_tick -= self.div_T
+            if self.enabled == 1:
+                # TIMA counts falling edges of a DIV bit, which happen every
+                # period cycles
+                period = self.periods[self.speed_select] * 2
+                overflow = period - (self.div_clock % period)
+                overflow += (255 - self.clock) * period
+                if overflow <= delta:
+                    # Skip to just before the overflow and let tick() handle
+                    # that one, then carry on with the reload
+                    self.div_clock = (self.div_clock + overflow - 1) & 0xFFFF
+                    self.clock = 255
+                    self.tick()
+                    delta -= overflow
+                    continue
+                self.clock += ((self.div_clock % period) + delta) // period
+
+            self.div_clock = (self.div_clock + delta) & 0xFFFF
+            break
+
+    def tick(self):
+        old_div_clock = self.div_clock
+        self.div_clock += 1
+        self.div_clock &= 0xFFFF
+
+        if self.enabled == 1:
+            bit_idx = self.periods[self.speed_select]
+            tick_bit = (self.div_clock & bit_idx) != 0
+            old_tick_bit = (old_div_clock & bit_idx) != 0
+
+            if old_tick_bit and not tick_bit:
+                self.clock += 1
+                if self.clock > 255:
+                    self.clock = 0
+                    self.reload_tick = 4
+
+        # TODO: implement the remaining timer oddities (such as TMA latching
+        # and TIMA write ignores)
+        if self.reload_tick > 0:
+            self.reload_tick -= 1
+            if self.reload_tick == 0:
+                self.clock = self.load_value
+                # Trigger an interrupt
+                # TODO: pull these magic numbers out somewhere
+                IF_state = self.bus.read(0xFF0F)
+                IF_state |= 0x4
+                self.bus.write(0xFF0F, IF_state)
+
+    def next_event(self):
+        # Cycles until the timer interrupt fires, or None if it's stopped
+        if self.reload_tick > 0:
+            ticks = self.reload_tick
+        elif self.enabled == 1:
+            period = self.periods[self.speed_select] * 2
+            # Falling edges of the selected DIV bit until TIMA overflows,
+            # then the rest of the reload delay (the overflowing tick counts
+            # as the first one)
+            ticks = period - (self.div_clock % period)
+            ticks += (255 - self.clock) * period
+            ticks += 3
+        else:
+            return None
+        return ticks
 
-            old_div_clock = self.div_clock
-            self.div_clock += 1
+    def catch_up(self):
+        now = self.scheduler.clock
+        self.advance(now - self.cycle)
+        self.cycle = now
 
-            # TODO: can probably pull this out of the while loop for performance gain:
-            self.div_clock &= 0xFFFF
+    def snapshot(self):
+        return TIMER_STATE.pack(self)
 
-            if self.enabled == 1:
-                bit_idx = self.periods[self.speed_select]
-                tick_bit = (self.div_clock & bit_idx) != 0
-                old_tick_bit = (old_div_clock & bit_idx) != 0
-
-                if old_tick_bit and not tick_bit:
-                    self.clock += 1
-                    if self.clock > 255:
-                        self.clock = 0
-                        self.reload_tick = 4
-
-            # TODO: implement the remaining timer oddities (such as TMA latching
-            # and TIMA write ignores)
-            if self.reload_tick > 0:
-                self.reload_tick -= 1
-                if self.reload_tick == 0:
-                    self.clock = self.load_value
-                    # Trigger an interrupt
-                    # TODO: pull these magic numbers out somewhere
-                    IF_state = self.bus.read(0xFF0F)
-                    IF_state |= 0x4
-                    self.bus.write(0xFF0F, IF_state)
+    def restore(self, data):
+        TIMER_STATE.unpack(self, data)
+
+    def reschedule(self):
+        ticks = self.next_event()
+        if ticks is None:
+            self.scheduler.cancel(self)
+        else:
+            self.scheduler.schedule(self, self.cycle + ticks)
 
+    def scheduled_event(self, cycle):
+        self.catch_up()
+        self.reschedule()
 
     def bus_read(self, addr):
+        self.catch_up()
         if addr == 0: # DIV
             return self.div_clock >> 8
         elif addr == 1: # TIMA
@@ -96,10 +175,12 @@ class TIMER(gb_bus.BUS_OBJECT):
         elif addr == 3: # TAC
             val = self.enabled << 2
             val |= self.speed_select
+            return val
         else:
             raise Exception("timer doesn't know WHAT the fuck to do")
 
     def bus_write(self, addr, value):
+        self.catch_up()
         if addr == 0: # DIV
             self.div_clock = 0
         elif addr == 1: # TIMA
@@ -112,14 +193,22 @@ class TIMER(gb_bus.BUS_OBJECT):
             self.speed_select = value & 0x3
         else:
             raise Exception("timer doesn't know WHAT the fuck to do")
+        self.reschedule()
 
 class SERIAL(gb_bus.BUS_OBJECT):
-    def __init__(self):
+    def __init__(self, echo=True):
         super(SERIAL, self).__init__()
         self.data = 0
         self.control = 0
         # TODO: implement actual serial behavior
 
+        # Whether to print bytes as they're written, which is how blargg's
+        # tests report
+        self.echo = echo
+        # Every byte sent so far, for whoever's running the system (e.g.
+        # batch.py). Not part of the system's state.
+        self.output = bytearray()
+
     def bus_read(self, addr):
         if addr == 0: # SB
             return self.data
@@ -130,15 +219,23 @@ class SERIAL(gb_bus.BUS_OBJECT):
 
     def bus_write(self, addr, value):
         if addr == 0: # SB
-            # TODO: this print is useful for blargg's tests, but parameterize
-            # it so it doesn't barf out on other roms:
-            print(chr(value)+"\n")
+            if self.echo:
+                print(chr(value)+"\n")
             self.data = value & 0xFF
         elif addr == 1: # SC
             self.control = value & 0xFF
+            if value & 0x81 == 0x81:
+                # Transfer started on the internal clock
+                self.output.append(self.data)
         else:
             raise Exception("serial doesn't know WHAT the fuck to do")
 
+    def snapshot(self):
+        return SERIAL_STATE.pack(self)
+
+    def restore(self, data):
+        SERIAL_STATE.unpack(self, data)
+
 class JOYPAD(gb_bus.BUS_OBJECT):
     def __init__(self):
         super(JOYPAD, self).__init__()
@@ -160,6 +257,12 @@ class JOYPAD(gb_bus.BUS_OBJECT):
             "start": 3,
         }
   
+    def snapshot(self):
+        return JOYPAD_STATE.pack(self)
+
+    def restore(self, data):
+        JOYPAD_STATE.unpack(self, data)
+
     def update(self, keys):
         changed = False
         for key, idx in self.direction_idx.items():
@@ -210,11 +313,13 @@ class JOYPAD(gb_bus.BUS_OBJECT):
 
 
 class GAMEBOY(object):
-    def __init__(self, rom_bin):
+    def __init__(self, rom_bin, recompile=False, renderer="python", frontend=None,
+                 pacer=None, instruments=None, guest_profiler=None, rewind=None):
         self.debug_trigger = False
         self.exit_trigger = False
 
         self.bus = gb_bus.BUS()
+        self.scheduler = gb_scheduler.SCHEDULER()
 
         self.cart = gb_memory.CARTRIDGE(self.bus, rom_bin)
 
@@ -225,7 +330,22 @@ class GAMEBOY(object):
         self.hram = gb_memory.RAM(127)
         self.bus.attach(self.hram, 0xFF80, 0xFFFE)
 
-        self.ppu = gb_video.VIDEO(self.bus)
+        # Shows the screen, plays the sound and provides input. Without one,
+        # the system runs headless
+        self.frontend = frontend
+        # Holds emulation to real time. Without one, it runs as fast as it can
+        self.pacer = pacer
+        # Counts what the system's up to, at some cost in speed. Without
+        # them, none of the counting code is even there
+        self.instruments = instruments
+        # Profiles the game being run, rather than the emulator
+        self.guest_profiler = guest_profiler
+        # Keeps recent states to wind back to while rewinding is set
+        self.rewind = rewind
+        self.rewinding = False
+
+        self.ppu = gb_video.VIDEO(self.bus, self.scheduler, renderer=renderer,
+                                  frontend=frontend, pacer=pacer)
         self.apu = gb_sound.SOUND(self.bus)
 
         self.joypad = JOYPAD()
@@ -237,7 +357,7 @@ class GAMEBOY(object):
         self.ie_reg = gb_cpu.REG("IE", 8)
         self.bus.attach(self.ie_reg, 0xFFFF, 0xFFFF)
 
-        self.timer = TIMER()
+        self.timer = TIMER(self.scheduler)
         self.bus.attach(self.timer, 0xFF04, 0xFF07)
 
         self.serial = SERIAL()
@@ -245,92 +365,252 @@ class GAMEBOY(object):
 
         self.cpu = gb_cpu.CPU(self.bus)
 
+        if recompile:
+            self.recompiler = gb_recompiler.RECOMPILER(self.cpu, self.cart, self.scheduler)
+        else:
+            self.recompiler = None
+
+        self.dma_blockade = False
+
+        self.input_clock = 0
+
+        self.fast_forward = False
+        self.speed = FAST_FORWARD_SPEED
+        self.throttled = True
+
+        if frontend is not None:
+            frontend.attach(self)
+        if pacer is not None:
+            pacer.attach(self)
+        for patcher in self.patchers():
+            patcher.install(self)
+
+    def patchers(self):
+        # Whatever's hooked into the system's objects, in the order they
+        # went in
+        return [patcher for patcher in (self.instruments, self.guest_profiler)
+                if patcher is not None]
+
+    def state_sections(self):
+        # (tag, component) for everything that goes into a snapshot, in the
+        # order it's saved and restored
+        return [
+            (b"CART", self.cart),
+            (b"WRM0", self.ram[0]),
+            (b"WRM1", self.ram[1]),
+            (b"HRAM", self.hram),
+            (b"CPU ", self.cpu),
+            (b"IF  ", self.if_reg),
+            (b"IE  ", self.ie_reg),
+            (b"PPU ", self.ppu),
+            (b"VREG", self.ppu.vregs),
+            (b"VRAM", self.ppu.vram_tile),
+            (b"MAP0", self.ppu.vram_map_0),
+            (b"MAP1", self.ppu.vram_map_1),
+            (b"OAM ", self.ppu.vram_oam),
+            (b"APU ", self.apu),
+            (b"TIMR", self.timer),
+            (b"SER ", self.serial),
+            (b"JOYP", self.joypad),
+            (b"SCHD", self.scheduler),
+        ]
+
+    def snapshot(self):
+        # The emulated machine's state as bytes (see snapshot.py). Nothing
+        # from the host side (frontend, pacer, fast-forward) is included.
+        sections = [(tag, component.snapshot()) for tag, component in self.state_sections()]
+        sections.append((b"SYS ", SYSTEM_STATE.pack(self)))
+        return gb_snapshot.pack(sections)
+
+    def restore(self, snapshot):
+        # Puts the system back to a snapshot() of it (or of another system
+        # running the same game)
+        sections = gb_snapshot.unpack(snapshot)
+        for tag, component in self.state_sections() + [(b"SYS ", None)]:
+            if tag not in sections:
+                raise Exception("Save state has no %s section" % tag.decode().strip())
+        for tag, component in self.state_sections():
+            component.restore(sections[tag])
+        SYSTEM_STATE.unpack(self, sections[b"SYS "])
+        self.set_dma_blockade(self.dma_blockade)
+
+        # The clock's moved, so everything scheduled needs working out again
+        self.ppu.reschedule()
+        self.timer.reschedule()
+        # Code compiled from RAM is for whatever was there before
+        if self.recompiler is not None:
+            self.recompiler.drop_ram_blocks()
+
+        if self.frontend is not None:
+            self.frontend.present(self.ppu)
+        if self.pacer is not None:
+            self.pacer.resync()
+
+    def fork(self, **kwargs):
+        # A new system carrying on from exactly where this one is, to run
+        # separately from it (e.g. to try out different inputs from the same
+        # point). The ROM and any compiled ROM code are shared rather than
+        # read and compiled again, which is most of the cost of building a
+        # system; the rest of the state comes over in a snapshot. It runs
+        # headless unless given a frontend etc. in kwargs, which are passed
+        # on to GAMEBOY().
+        kwargs.setdefault("recompile", self.recompiler is not None)
+        kwargs.setdefault("renderer", self.ppu.renderer.name)
+        system = GAMEBOY(self.cart.rom, **kwargs)
+        system.restore(self.snapshot())
+        if self.recompiler is not None and system.recompiler is not None:
+            system.recompiler.adopt_blocks(self.recompiler)
+        return system
+
     def save_state(self, filename):
         with open(filename,"wb") as f:
-            pickle.dump(self.__dict__, f)
+            f.write(self.snapshot())
 
     def load_state(self, filename):
         with open(filename,"rb") as f:
-            new_system = pickle.load(f)
-        self.__dict__.update(new_system)         
-
-    def advance(self):
+            self.restore(f.read())
+
+    def run(self, cycles):
+        # Runs for at least the given number of cycles, returning the number
+        # of instructions and cycles actually run
+        return self.run_until(None, cycles)
+
+    def run_until(self, event, cycles=None):
+        # Runs until event() returns true, or the given number of cycles have
+        # passed. Peripherals only get touched when they have something
+        # scheduled or get accessed, and event() is only checked after
+        # scheduled events, since nothing else can change in between.
         # TODO: implement the STOP instruction correctly
-
-        if not self.cpu._halted and not self.cpu._stopped:
-            opcode = self.bus.read(self.cpu.PC.read())
-            cycles = self.cpu.decode(opcode)
-        else:
-            # NOP if halted
-            cycles = 4
-
         # TODO: blank screen on STOP instr
+        cpu = self.cpu
+        if self.recompiler is not None:
+            step = self.recompiler.step
+        else:
+            step = cpu.step
+        service_interrupts = cpu.service_interrupts
+        scheduler = self.scheduler
+        input_clock = self.input_clock
+
+        n_instr = 0
+        n_cycles = 0
+        while cycles is None or n_cycles < cycles:
+            if not cpu._halted and not cpu._stopped:
+                instr_cycles = step()
+                # TODO: not sure where/when/how often to do this, putting it
+                # here for now so it's done once per instruction:
+                # TODO: also, should this be an add or a direct assign?
+                instr_cycles += service_interrupts()
+            else:
+                # NOP if halted
+                instr_cycles = 4 + service_interrupts()
+                if cpu._halted or cpu._stopped:
+                    # Interrupts only get raised by scheduled events, so
+                    # nothing can wake the CPU up before the next one. Skip
+                    # straight to it.
+                    # Input still gets polled once a frame, though.
+                    idle = scheduler.next_cycle - scheduler.clock - instr_cycles
+                    idle = min(idle, CYCLES_PER_FRAME - input_clock - instr_cycles)
+                    if cycles is not None:
+                        idle = min(idle, cycles - n_cycles - instr_cycles)
+                    if idle > 0:
+                        idle = (idle + 3) // 4
+                        instr_cycles += 4 * idle
+                        n_instr += idle
+            n_instr += 1
+            n_cycles += instr_cycles
+
+            scheduler.clock += instr_cycles
+            if scheduler.clock >= scheduler.next_cycle:
+                scheduler.run_due()
+                self.update_dma_blockade()
+                if event is not None and event():
+                    input_clock += instr_cycles
+                    break
+
+            input_clock += instr_cycles
+            if input_clock >= CYCLES_PER_FRAME:
+                # Once every frame, however many frames this call runs for.
+                # Rewinding restores input_clock along with everything else.
+                self.input_clock = input_clock - CYCLES_PER_FRAME
+                self.poll_input()
+                input_clock = self.input_clock
+
+        self.input_clock = input_clock
+        return n_instr, n_cycles
 
-        # TODO: not sure where/when/how often to do this, putting it here
-        # for now so we only have to call timer.advance() once:
-        # TODO: also, should this be an add or a direct assign?
-        cycles += self.cpu.service_interrupts()
-
-        T_op = self.cpu.T_cyc * cycles
-        self.timer.advance(T_op)
-
-        # TODO: decompose this and allow for configurable keybindings
-        keys = {}
-        key_bindings = {
-            pygame.K_LEFT: "left",
-            pygame.K_RIGHT: "right",
-            pygame.K_UP: "up",
-            pygame.K_DOWN: "down",
-            pygame.K_z: "a",
-            pygame.K_x: "b",
-            pygame.K_RETURN: "start",
-            pygame.K_TAB: "select",
-        }
-        for event in pygame.event.get(): 
-            if event.type == pygame.QUIT:
-                self.exit_trigger = True
-            elif event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_ESCAPE:
-                    self.exit_trigger = True
-                elif event.key == pygame.K_F5:
-                    self.save_state(self.cart.filename+".pygb.sav")
-                elif event.key == pygame.K_F7:
-                    self.load_state(self.cart.filename+".pygb.sav")
-                elif event.key == pygame.K_PAUSE:
-                    self.debug_trigger = True
-                elif event.key in key_bindings:
-                    keys[key_bindings[event.key]] = True
-            elif event.type == pygame.KEYUP:
-                if event.key in key_bindings:
-                    keys[key_bindings[event.key]] = False
-        if len(keys) > 0:
-            self.joypad.update(keys)
-
-        self.ppu.advance(T_op)
+    def advance(self):
+        # Runs a single instruction
+        self.run(1)
 
+    def update_dma_blockade(self):
         # TODO: this DMA blockade seems to break tetris, investigate more
         # closely what's going on
         # seems like it's lasting a *little bit* too long
-        if self.ppu.dma_active():
-            self.cart.allow_bus_access(False)
-            for ram_bank in self.ram:
-                ram_bank.bus_enabled = False
+        # Only touch the bus when the blockade actually changes, since
+        # toggling access remaps the bus fast path
+        dma_active = self.ppu.dma_active()
+        if dma_active != self.dma_blockade:
+            self.set_dma_blockade(dma_active)
+
+    def set_dma_blockade(self, blockade):
+        self.dma_blockade = blockade
+        self.cart.allow_bus_access(not blockade)
+        for ram_bank in self.ram:
+            ram_bank.bus_enabled = not blockade
+
+    def set_fast_forward(self, fast_forward, speed=None, throttled=None):
+        # Runs at speed times normal speed (or as fast as possible if not
+        # throttled), skipping drawing all but one frame in speed and muting
+        # the sound
+        if speed is not None:
+            self.speed = speed
+        if throttled is not None:
+            self.throttled = throttled
+        self.fast_forward = fast_forward
+        if fast_forward:
+            self.ppu.frameskip = self.speed
         else:
-            self.cart.allow_bus_access(True)
-            for ram_bank in self.ram:
-                ram_bank.bus_enabled = True
+            self.ppu.frameskip = 1
+        self.apu.pcm_stream.skip_samples = fast_forward
+        if self.pacer is not None:
+            if not fast_forward:
+                self.pacer.set_speed(1)
+            elif self.throttled:
+                self.pacer.set_speed(self.speed)
+            else:
+                self.pacer.set_speed(None)
+
+    def poll_input(self):
+        if self.frontend is not None:
+            self.frontend.poll_input(self)
+        if self.rewind is not None:
+            if self.rewinding:
+                self.rewind.step_back(self)
+            else:
+                self.rewind.frame(self)
 
 
-def main(system, debugger):
+def main(system, debugger, max_cycles=None):
+    # Runs until the frontend asks to exit, something breaks, or (if given)
+    # max_cycles have been run
     n_instr = 0
     n_cyc = 0
     running = True
     while running:
         try:
-            system.advance()
+            if debugger is not None:
+                # Single step so breakpoints get checked after every
+                # instruction
+                instrs, cycles = system.run(1)
+            else:
+                instrs, cycles = system.run(CYCLES_PER_FRAME)
+            n_instr += instrs
+            n_cyc += cycles
             # running = not system.cpu._stopped
             if system.exit_trigger == True:
                 running = False
+            if max_cycles is not None and n_cyc >= max_cycles:
+                running = False
             if debugger is not None:
                 debugger.scan()
         except gb_debug.DEBUGGER_TRIGGER as e:
@@ -350,8 +630,6 @@ def main(system, debugger):
                 print("------------")
             running = False
 
-        n_instr += 1
-        n_cyc += 1
     return n_instr, n_cyc
 
 if __name__=="__main__":
@@ -364,6 +642,38 @@ if __name__=="__main__":
                         help='Start emulation paused in the debugger')
     parser.add_argument('--profile', action='store_true',
                         help='Run emulator within cProfile')
+    parser.add_argument('--guest-profile', action='store_true',
+                        help='Profile the game\'s own code and print its hottest routines on exit (turns off --recompile)')
+    parser.add_argument('--guest-profile-interval', metavar='N', type=int, default=1024,
+                        help='Sample the game\'s PC every N cycles, or count every instruction with 0 (default 1024)')
+    parser.add_argument('--folded', metavar='FILE', type=str,
+                        help='Like --guest-profile, but write the game\'s call stacks to FILE in folded format for flame graphs')
+    parser.add_argument('--rewind', action='store_true',
+                        help='Keep recent states in memory so play can be wound back by holding backspace')
+    parser.add_argument('--rewind-interval', metavar='N', type=int, default=2,
+                        help='With --rewind, keep a state every N frames (default 2)')
+    parser.add_argument('--rewind-memory', metavar='MB', type=float, default=32,
+                        help='With --rewind, keep at most this many MiB of states (default 32)')
+    parser.add_argument('--recompile', action='store_true',
+                        help='Compile hot code into Python functions (ignored with --debug)')
+    parser.add_argument('--renderer', choices=['python', 'numpy'], default='python',
+                        help='How to draw the screen (numpy falls back to python if NumPy is missing)')
+    parser.add_argument('--headless', action='store_true',
+                        help='Run without a window, sound or pygame at all')
+    parser.add_argument('--input', metavar='SCRIPT', type=str,
+                        help='With --headless, play joypad input from a script of "FRAME BUTTON down|up" lines')
+    parser.add_argument('--speed', metavar='N', type=int,
+                        help='Start fast-forwarding at N times normal speed, drawing one frame in N (default %i)' % FAST_FORWARD_SPEED)
+    parser.add_argument('--unthrottled', action='store_true',
+                        help='Fast-forward as fast as the host allows, and start doing so')
+    parser.add_argument('--sync', choices=['clock', 'audio', 'none'],
+                        help='What to hold the frame rate to: the host clock, the sound card, or nothing (default clock, or none with --headless)')
+    parser.add_argument('--frames', metavar='N', type=int,
+                        help='Exit after N frames\' worth of cycles')
+    parser.add_argument('--instrument', action='store_true',
+                        help='Count bus accesses, instructions, interrupts and time per subsystem, and print them on exit')
+    parser.add_argument('--instrument-json', metavar='FILE', type=str,
+                        help='Like --instrument, but write the counts to FILE as JSON')
     parser.add_argument('--verbose', '-v', action='store_true',
                         help='Be verbose')
     parser.add_argument('--log', metavar='LOGFILE', type=str,
@@ -376,14 +686,58 @@ if __name__=="__main__":
         print("Logging to " + log_file)
         logger = gb_debug.Tee(log_file, "w")
 
-    pygame.mixer.pre_init(44100, -16, 1, 1024)
-    pygame.init()
-    pygame.display.set_caption("pygb")
-    pygame.key.set_repeat(10, 10)
+    if args.headless:
+        script = None
+        if args.input is not None:
+            with open(args.input, "r") as f:
+                script = gb_frontend.load_input_script(f)
+        frontend = gb_frontend.SCRIPTED_FRONTEND(script)
+    else:
+        if args.input is not None:
+            print("WARNING: --input only works with --headless")
+        frontend = gb_frontend.PYGAME_FRONTEND()
+
+    if args.sync is None:
+        args.sync = "none" if args.headless else "clock"
+    if args.sync == "none":
+        pacer = None
+    else:
+        pacer = gb_pacer.FRAME_PACER(sync=args.sync)
+
+    if args.instrument or args.instrument_json is not None:
+        instruments = gb_instrument.INSTRUMENTS()
+    else:
+        instruments = None
+
+    if args.guest_profile or args.folded is not None:
+        guest_profiler = gb_profiler.GUEST_PROFILER(interval=args.guest_profile_interval or None)
+        if args.recompile:
+            print("WARNING: --recompile doesn't work with guest profiling, turning it off")
+            args.recompile = False
+    else:
+        guest_profiler = None
+
+    if args.rewind:
+        rewind = gb_rewind.REWIND_BUFFER(interval=args.rewind_interval,
+                                         max_bytes=int(args.rewind_memory * (1 << 20)))
+    else:
+        rewind = None
+
+    if args.frames is not None:
+        max_cycles = args.frames * CYCLES_PER_FRAME
+    else:
+        max_cycles = None
 
     with open(args.romfile, "rb") as f:
         print("Building system")
-        system = GAMEBOY(f)
+        system = GAMEBOY(f, recompile=args.recompile and not args.debug,
+                         renderer=args.renderer, frontend=frontend,
+                         pacer=pacer, instruments=instruments,
+                         guest_profiler=guest_profiler, rewind=rewind)
+        if args.speed is not None or args.unthrottled:
+            if args.speed is not None and args.speed < 1:
+                raise Exception("Speed must be at least 1")
+            system.set_fast_forward(True, args.speed, throttled=not args.unthrottled)
         if args.debug:
             debugger = gb_debug.DEBUGGER(system, verbose=args.verbose)
             if args.paused:
@@ -393,15 +747,27 @@ if __name__=="__main__":
 
         if args.profile:
             import cProfile
-            cProfile.run('main(system, debugger)')
+            cProfile.run('main(system, debugger, max_cycles)')
         else:
             print("Starting execution")
             T_start = time.time()
-            n_instr, n_cyc = main(system, debugger)
+            n_instr, n_cyc = main(system, debugger, max_cycles)
             T_end = time.time()
             print("Executed %i instructions in %f seconds (%f simulated)" % (n_instr, T_end-T_start, n_cyc*system.cpu.T_cyc))
-
-        # TODO: remove profiling code:
-        # for addr, count in system.bus.reads.items():
-        #     if count > 1:
-        #         print hex(addr) + ": " + str(count)
+            print("%.1f emulated frames per second" % (float(n_cyc) / CYCLES_PER_FRAME / (T_end-T_start)))
+            if system.recompiler is not None:
+                print(system.recompiler.report())
+            if system.pacer is not None:
+                print(system.pacer.report())
+            if system.rewind is not None:
+                print(system.rewind.report())
+
+        if args.instrument:
+            print(instruments.report())
+        if args.instrument_json is not None:
+            instruments.dump_json(args.instrument_json)
+        if args.guest_profile:
+            print(guest_profiler.report())
+        if args.folded is not None:
+            with open(args.folded, "w") as f:
+                guest_profiler.write_folded(f)
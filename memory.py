@@ -1,16 +1,32 @@
+import ctypes
+import mmap
+import struct
+
 import debug
 import bus
+import snapshot
 
 class ROM(bus.BUS_OBJECT):
     def __init__(self, rom_bin):
-        self.rom_bytes = []
-        rom_bin.seek(0x00)
+        # rom_bytes has to index to ints (the bus hands it out as a plain
+        # buffer, see MBC.bus_buffer), which in Python 2 neither str, mmap nor
+        # memoryview do. A ctypes array over a mapping of the file does
+        # without copying anything, so every system running the game,
+        # in this process or any other, reads the same page cache pages.
+        # The mapping has to be copy-on-write for ctypes to take it, but
+        # nothing writes to it so no pages ever get copied.
+        # None for things like io.BytesIO that aren't backed by a file
+        self.filename = getattr(rom_bin, "name", None)
         try:
-            while True:
-                self.rom_bytes.append(ord(rom_bin.read(1)))
-        except:
-            pass
-        self.rom_bytes = tuple(self.rom_bytes)
+            self.rom_map = mmap.mmap(rom_bin.fileno(), 0, access=mmap.ACCESS_COPY)
+        except (AttributeError, IOError, OSError, ValueError):
+            # Not a real file (e.g. io.BytesIO), or an empty one
+            self.rom_map = None
+        if self.rom_map is not None:
+            self.rom_bytes = (ctypes.c_ubyte * len(self.rom_map)).from_buffer(self.rom_map)
+        else:
+            rom_bin.seek(0x00)
+            self.rom_bytes = bytearray(rom_bin.read())
 
     def slice(self, addr_lo, addr_hi):
         return self.rom_bytes[addr_lo:addr_hi+1]
@@ -22,9 +38,14 @@ class ROM(bus.BUS_OBJECT):
         print("WARNING: Write to ROM address 0x%04X=%02X" % (addr, value))
 
 class RAM(bus.BUS_OBJECT):
+    bus_buffer_writable = True
+
     def __init__(self, size=2**16):
         super(RAM, self).__init__()
-        self.ram_bytes = [0x00]*size
+        self.ram_bytes = bytearray(size)
+
+    def bus_buffer(self):
+        return (self.ram_bytes, 0)
 
     def bus_read(self, addr):
         if addr < len(self.ram_bytes):
@@ -35,10 +56,20 @@ class RAM(bus.BUS_OBJECT):
 
     def bus_write(self, addr, value):
         if addr < len(self.ram_bytes):
-            self.ram_bytes[addr] = value
+            self.ram_bytes[addr] = value & 0xFF
         else:
             print("WARNING: Write to out-of-bounds RAM address %04X=%02X" % (addr, value))
 
+    def snapshot(self):
+        return bytes(self.ram_bytes)
+
+    def restore(self, data):
+        # In place, since the bus indexes ram_bytes directly
+        if len(data) != len(self.ram_bytes):
+            raise Exception("Save state has %d bytes of RAM where %d were expected" %
+                (len(data), len(self.ram_bytes)))
+        self.ram_bytes[:] = data
+
 
 class MEM_SEGMENT(bus.BUS_OBJECT):
     def __init__(self, segment_idx, mbc):
@@ -52,12 +83,42 @@ class MEM_SEGMENT(bus.BUS_OBJECT):
     def bus_read(self, addr):
         return self.mbc.read(self.segment_idx, addr)
 
+    def bus_buffer(self):
+        return self.mbc.buffer(self.segment_idx)
+
 
 class MBC(object):
+    # Banking registers that go into save states
+    state = snapshot.FIELDS([("rom_bank", "i")])
+
     def __init__(self, cart):
         self.rom = cart.rom
         self.ram = cart.ram
         self.cart = cart
+        self.rom_bank = 1
+
+    def buffer(self, segment):
+        # Bus fast path for the ROM segments. Cartridge RAM always goes
+        # through read()/write() since it can be disabled or banked out.
+        if segment == 0:
+            return (self.rom.rom_bytes, 0)
+        elif segment == 1:
+            return (self.rom.rom_bytes, self.rom_bank*0x4000)
+        else:
+            return None
+
+    def switch_bank(self, rom_bank):
+        if rom_bank != self.rom_bank:
+            self.rom_bank = rom_bank
+            # Point the bus fast path at the new bank
+            self.cart.bus.remap(self.cart.rom_N)
+
+    def snapshot(self):
+        return self.state.pack(self)
+
+    def restore(self, data):
+        self.state.unpack(self, data)
+        self.cart.bus.remap(self.cart.rom_N)
 
 
 class MBC_NONE(MBC):
@@ -78,6 +139,9 @@ class MBC_NONE(MBC):
             return self.ram.bus_read(addr)
 
 class MBC1(MBC):
+    state = snapshot.FIELDS([("rom_bank", "i"), ("ram_bank", "i"),
+        ("ram_enable", "i"), ("rom_ram_mode", "i")])
+
     def __init__(self, cart):
         super(MBC1, self).__init__(cart)
         self.rom_bank = 1
@@ -95,15 +159,14 @@ class MBC1(MBC):
                 value = value & 0x1F
                 if value == 0:
                     value += 1
-                self.rom_bank &= 0x60
-                self.rom_bank |= value
+                self.switch_bank((self.rom_bank & 0x60) | value)
             else:
                 raise Exception("Unknown MBC operation")
         elif segment == 1:
             if addr <= 0x1FFF:
                 value = value & 0x03
                 if self.rom_ram_mode == 0:
-                    self.rom_bank |= value << 5
+                    self.switch_bank(self.rom_bank | (value << 5))
                 else:
                     self.ram_bank = value
             elif addr <= 0x3FFF:
@@ -111,7 +174,7 @@ class MBC1(MBC):
                 if self.rom_ram_mode == 0:
                     self.ram_bank = 0
                 else:
-                    self.rom_bank &= 0x1F
+                    self.switch_bank(self.rom_bank & 0x1F)
             else:
                 raise Exception("Unknown MBC operation")
         elif segment == 2:
@@ -130,6 +193,8 @@ class MBC1(MBC):
                 return 0xFF
 
 class MBC2(MBC):
+    state = snapshot.FIELDS([("rom_bank", "i"), ("ram_enable", "i")])
+
     def __init__(self, cart):
         super(MBC2, self).__init__(cart)
         self.rom_bank = 1
@@ -144,7 +209,7 @@ class MBC2(MBC):
                 if (addr & 0x0100) == 0:
                     self.ram_enable = (value & 0x0F) == 0x0A
             elif addr <= 0x3FFF:
-                self.rom_bank = value & 0x0F
+                self.switch_bank(value & 0x0F)
             else:
                 raise Exception("Unknown MBC operation")
         else:
@@ -163,6 +228,11 @@ class MBC2(MBC):
 
 
 class MBC3(MBC):
+    state = snapshot.FIELDS([("rom_bank", "i"), ("ram_bank", "i"),
+        ("ram_rtc_enable", "i"), ("rtc_seconds", "i"), ("rtc_minutes", "i"),
+        ("rtc_hours", "i"), ("rtc_days", "i"), ("rtc_halt", "i"),
+        ("rtc_carry", "i"), ("rtc_latch", "i")])
+
     def __init__(self, cart):
         super(MBC3, self).__init__(cart)
         self.rom_bank = 1
@@ -188,7 +258,7 @@ class MBC3(MBC):
                 value = value & 0x7F
                 if value == 0:
                     value += 1
-                self.rom_bank = value
+                self.switch_bank(value)
             else:
                 raise Exception("Unknown MBC operation")
         elif segment == 1:
@@ -282,9 +352,14 @@ class HuC1(MBC):
 class CARTRIDGE(object):
     def __init__(self, bus, rom_bin):
         self.bus = bus
-        self.rom = ROM(rom_bin)
+        if isinstance(rom_bin, ROM):
+            # Already read in by another system running the game (see
+            # GAMEBOY.fork()). ROM never changes, so it can be shared.
+            self.rom = rom_bin
+        else:
+            self.rom = ROM(rom_bin)
 
-        self.filename = rom_bin.name
+        self.filename = self.rom.filename
 
         self.cartridge_type = self.rom.bus_read(0x147)
         self.rom_size = (1024*32) << self.rom.bus_read(0x148)
@@ -380,6 +455,21 @@ class CARTRIDGE(object):
         self.ram_N = MEM_SEGMENT(2, self.mbc)
         self.bus.attach(self.ram_N, 0xA000, 0xBFFF)
 
+    def snapshot(self):
+        # The ROM's header, to make sure the state gets loaded back into the
+        # same game, then the MBC's registers and the cartridge RAM
+        mbc_state = self.mbc.snapshot()
+        return (bytes(bytearray(self.rom.slice(0x134, 0x14F))) +
+                struct.pack("<H", len(mbc_state)) + mbc_state +
+                self.ram.snapshot())
+
+    def restore(self, data):
+        if data[:28] != bytes(bytearray(self.rom.slice(0x134, 0x14F))):
+            raise Exception("Save state is for a different game than %s" % self.title.rstrip("\0 "))
+        (mbc_size,) = struct.unpack_from("<H", data, 28)
+        self.mbc.restore(data[30:30+mbc_size])
+        self.ram.restore(data[30+mbc_size:])
+
     def allow_bus_access(self, en):
         # TODO: not sure what pars of cart should be disabled during DMA
         # blockade, opus5 breaks if ROM is included
@@ -1,274 +1,272 @@
+# Instruction table, generated once at import time from the opcode bit fields
+# as described at http://www.z80.info/decoding.htm
+#
+# Each entry names the CPU method implementing the instruction along with the
+# operands to bind to it. Operands given as strings are register or condition
+# names, which the CPU resolves when it builds its dispatch table; everything
+# else is passed through as-is; names starting with "table_" are ALU lookup
+# tables (see alu.py). Instructions get a separate method per operand kind
+# (register, (HL), immediate, SP) so nothing needs to be checked when they
+# execute.
+#
+# In mnemonics, immediate data is written as d8/d16 (data), a8/a16
+# (addresses) and r8 (signed jump offsets).
+
 class INSTR(object):
-    def __init__(self, opcode, name, func):
+    def __init__(self, opcode, name, length, func, args=()):
         self.opcode = opcode
         self.name = name
-        self.func = fun
+        self.length = length
+        self.func = func
+        self.args = args
+
+    def __repr__(self):
+        return "<INSTR 0x%02X %s>" % (self.opcode, self.name)
 
-def ld_imm(cpu, dst):
-    cpu.regs[dst].set(cpu.read(cpu.regs["PC"].get()+1))
-    cpu.regs["PC"].set(cpu.regs["PC"].get() + 2)
-    return 8
 
-def ld_reg(cpu, dst, src):
-    cpu.regs[dst].set(cpu.regs[src].get())
-    cpu.regs["PC"].set(cpu.regs["PC"].get() + 2)
-    return 4 if src.size == 8 and dst.size == 8 else 8
+r = ["B", "C", "D", "E", "H", "L", "(HL)", "A"]
+rp = ["BC", "DE", "HL", "SP"]
+rp2 = ["BC", "DE", "HL", "AF"]
+cc = ["NZ", "Z", "NC", "C"]
+cc_arg = ["if_NZ", "if_Z", "if_NC", "if_C"]
 
-ops = [
-    INSTR(0x00, "", lambda dst, src: None),
-    INSTR(0x01, "", lambda dst, src: None),
-    INSTR(0x02, "", lambda dst, src: None),
-    INSTR(0x03, "", lambda dst, src: None),
-    INSTR(0x04, "", lambda dst, src: None),
-    INSTR(0x05, "", lambda dst, src: None),
-    INSTR(0x06, "LD B, imm", lambda cpu: ld_imm(cpu, "B")),
-    INSTR(0x07, "", lambda dst, src: None),
-    INSTR(0x08, "", lambda dst, src: None),
-    INSTR(0x09, "", lambda dst, src: None),
-    INSTR(0x0a, "LD A, BC", lambda cpu: ld_reg(cpu, "A", "BC")),
-    INSTR(0x0b, "", lambda dst, src: None),
-    INSTR(0x0c, "", lambda dst, src: None),
-    INSTR(0x0d, "", lambda dst, src: None),
-    INSTR(0x0e, "LD C, imm", lambda cpu: ld_imm(cpu, "C")),
-    INSTR(0x0f, "", lambda dst, src: None),
-    INSTR(0x10, "", lambda dst, src: None),
-    INSTR(0x11, "", lambda dst, src: None),
-    INSTR(0x12, "", lambda dst, src: None),
-    INSTR(0x13, "", lambda dst, src: None),
-    INSTR(0x14, "", lambda dst, src: None),
-    INSTR(0x15, "", lambda dst, src: None),
-    INSTR(0x16, "LD D, imm", lambda cpu: ld_imm(cpu, "D")),
-    INSTR(0x17, "", lambda dst, src: None),
-    INSTR(0x18, "", lambda dst, src: None),
-    INSTR(0x19, "", lambda dst, src: None),
-    INSTR(0x1a, "LD A, DE", lambda cpu: ld_reg(cpu, "A", "DE")),
-    INSTR(0x1b, "", lambda dst, src: None),
-    INSTR(0x1c, "", lambda dst, src: None),
-    INSTR(0x1d, "", lambda dst, src: None),
-    INSTR(0x1e, "LD E, imm", lambda cpu: ld_imm(cpu, "E")),
-    INSTR(0x1f, "", lambda dst, src: None),
-    INSTR(0x20, "", lambda dst, src: None),
-    INSTR(0x21, "", lambda dst, src: None),
-    INSTR(0x22, "", lambda dst, src: None),
-    INSTR(0x23, "", lambda dst, src: None),
-    INSTR(0x24, "", lambda dst, src: None),
-    INSTR(0x25, "", lambda dst, src: None),
-    INSTR(0x26, "LD H, imm", lambda cpu: ld_imm(cpu, "H")),
-    INSTR(0x27, "", lambda dst, src: None),
-    INSTR(0x28, "", lambda dst, src: None),
-    INSTR(0x29, "", lambda dst, src: None),
-    INSTR(0x2a, "", lambda dst, src: None),
-    INSTR(0x2b, "", lambda dst, src: None),
-    INSTR(0x2c, "", lambda dst, src: None),
-    INSTR(0x2d, "", lambda dst, src: None),
-    INSTR(0x2e, "LD L, imm", lambda cpu: ld_imm(cpu, "L")),
-    INSTR(0x2f, "", lambda dst, src: None),
-    INSTR(0x30, "", lambda dst, src: None),
-    INSTR(0x31, "", lambda dst, src: None),
-    INSTR(0x32, "", lambda dst, src: None),
-    INSTR(0x33, "", lambda dst, src: None),
-    INSTR(0x34, "", lambda dst, src: None),
-    INSTR(0x35, "", lambda dst, src: None),
-    INSTR(0x36, "", lambda dst, src: None),
-    INSTR(0x37, "", lambda dst, src: None),
-    INSTR(0x38, "", lambda dst, src: None),
-    INSTR(0x39, "", lambda dst, src: None),
-    INSTR(0x3a, "", lambda dst, src: None),
-    INSTR(0x3b, "", lambda dst, src: None),
-    INSTR(0x3c, "", lambda dst, src: None),
-    INSTR(0x3d, "", lambda dst, src: None),
-    INSTR(0x3e, "", lambda dst, src: None),
-    INSTR(0x3f, "", lambda dst, src: None),
-    INSTR(0x40, "LD B, B", lambda cpu: ld_reg(cpu, "B", "B")),
-    INSTR(0x41, "LD B, C", lambda cpu: ld_reg(cpu, "B", "C")),
-    INSTR(0x42, "LD B, D", lambda cpu: ld_reg(cpu, "B", "D")),
-    INSTR(0x43, "LD B, E", lambda cpu: ld_reg(cpu, "B", "E")),
-    INSTR(0x44, "LD B, H", lambda cpu: ld_reg(cpu, "B", "H")),
-    INSTR(0x45, "LD B, L", lambda cpu: ld_reg(cpu, "B", "L")),
-    INSTR(0x46, "LD B, HL", lambda cpu: ld_reg(cpu, "B", "HL")),
-    INSTR(0x47, "LD B, A", lambda cpu: ld_reg(cpu, "B", "A")),
-    INSTR(0x48, "LD C, B", lambda cpu: ld_reg(cpu, "C", "B")),
-    INSTR(0x49, "LD C, C", lambda cpu: ld_reg(cpu, "C", "C")),
-    INSTR(0x4a, "LD C, D", lambda cpu: ld_reg(cpu, "C", "D")),
-    INSTR(0x4b, "LD C, E", lambda cpu: ld_reg(cpu, "C", "E")),
-    INSTR(0x4c, "LD C, H", lambda cpu: ld_reg(cpu, "C", "H")),
-    INSTR(0x4d, "LD C, L", lambda cpu: ld_reg(cpu, "C", "L")),
-    INSTR(0x4e, "LD C, HL", lambda cpu: ld_reg(cpu, "C", "HL")),
-    INSTR(0x4f, "LD C, A", lambda cpu: ld_reg(cpu, "C", "A")),
-    INSTR(0x50, "LD D, B", lambda cpu: ld_reg(cpu, "D", "B")),
-    INSTR(0x51, "LD D, C", lambda cpu: ld_reg(cpu, "D", "C")),
-    INSTR(0x52, "LD D, D", lambda cpu: ld_reg(cpu, "D", "D")),
-    INSTR(0x53, "LD D, E", lambda cpu: ld_reg(cpu, "D", "E")),
-    INSTR(0x54, "LD D, H", lambda cpu: ld_reg(cpu, "D", "H")),
-    INSTR(0x55, "LD D, L", lambda cpu: ld_reg(cpu, "D", "L")),
-    INSTR(0x56, "LD D, HL", lambda cpu: ld_reg(cpu, "D", "HL")),
-    INSTR(0x57, "LD D, A", lambda cpu: ld_reg(cpu, "D", "A")),
-    INSTR(0x58, "LD E, B", lambda cpu: ld_reg(cpu, "E", "B")),
-    INSTR(0x59, "LD E, C", lambda cpu: ld_reg(cpu, "E", "C")),
-    INSTR(0x5a, "LD E, D", lambda cpu: ld_reg(cpu, "E", "D")),
-    INSTR(0x5b, "LD E, E", lambda cpu: ld_reg(cpu, "E", "E")),
-    INSTR(0x5c, "LD E, H", lambda cpu: ld_reg(cpu, "E", "H")),
-    INSTR(0x5d, "LD E, L", lambda cpu: ld_reg(cpu, "E", "L")),
-    INSTR(0x5e, "LD E, HL", lambda cpu: ld_reg(cpu, "E", "HL")),
-    INSTR(0x5f, "LD E, A", lambda cpu: ld_reg(cpu, "E", "A")),
-    INSTR(0x60, "LD H, B", lambda cpu: ld_reg(cpu, "H", "B")),
-    INSTR(0x61, "LD H, C", lambda cpu: ld_reg(cpu, "H", "C")),
-    INSTR(0x62, "LD H, D", lambda cpu: ld_reg(cpu, "H", "D")),
-    INSTR(0x63, "LD H, E", lambda cpu: ld_reg(cpu, "H", "E")),
-    INSTR(0x64, "LD H, H", lambda cpu: ld_reg(cpu, "H", "H")),
-    INSTR(0x65, "LD H, L", lambda cpu: ld_reg(cpu, "H", "L")),
-    INSTR(0x66, "LD H, HL", lambda cpu: ld_reg(cpu, "H", "HL")),
-    INSTR(0x67, "LD H, A", lambda cpu: ld_reg(cpu, "H", "A")),
-    INSTR(0x68, "LD L, B", lambda cpu: ld_reg(cpu, "L", "B")),
-    INSTR(0x69, "LD L, C", lambda cpu: ld_reg(cpu, "L", "C")),
-    INSTR(0x6a, "LD L, D", lambda cpu: ld_reg(cpu, "L", "D")),
-    INSTR(0x6b, "LD L, E", lambda cpu: ld_reg(cpu, "L", "E")),
-    INSTR(0x6c, "LD L, H", lambda cpu: ld_reg(cpu, "L", "H")),
-    INSTR(0x6d, "LD L, L", lambda cpu: ld_reg(cpu, "L", "L")),
-    INSTR(0x6e, "LD L, HL", lambda cpu: ld_reg(cpu, "L", "HL")),
-    INSTR(0x6f, "LD L, A", lambda cpu: ld_reg(cpu, "L", "A")),
-    INSTR(0x70, "LD HL, B", lambda cpu: ld_reg(cpu, "HL", "B")),
-    INSTR(0x71, "LD HL, B", lambda cpu: ld_reg(cpu, "HL", "C")),
-    INSTR(0x72, "LD HL, B", lambda cpu: ld_reg(cpu, "HL", "D")),
-    INSTR(0x73, "LD HL, B", lambda cpu: ld_reg(cpu, "HL", "E")),
-    INSTR(0x74, "LD HL, B", lambda cpu: ld_reg(cpu, "HL", "H")),
-    INSTR(0x75, "LD HL, B", lambda cpu: ld_reg(cpu, "HL", "L")),
-    INSTR(0x76,), # TODO : HALT
-    INSTR(0x77, "LD HL, A", lambda cpu: ld_reg(cpu, "HL", "A")),
-    INSTR(0x78, "LD A, B", lambda cpu: ld_reg(cpu, "A", "B")),
-    INSTR(0x79, "LD A, C", lambda cpu: ld_reg(cpu, "A", "C")),
-    INSTR(0x7a, "LD A, D", lambda cpu: ld_reg(cpu, "A", "D")),
-    INSTR(0x7b, "LD A, E", lambda cpu: ld_reg(cpu, "A", "E")),
-    INSTR(0x7c, "LD A, H", lambda cpu: ld_reg(cpu, "A", "H")),
-    INSTR(0x7d, "LD A, L", lambda cpu: ld_reg(cpu, "A", "L")),
-    INSTR(0x7e, "LD A, HL", lambda cpu: ld_reg(cpu, "A", "HL")),
-    INSTR(0x7f, "LD A, A", lambda cpu: ld_reg(cpu, "A", "A")),
-    INSTR(0x80, "", lambda dst, src: None),
-    INSTR(0x81, "", lambda dst, src: None),
-    INSTR(0x82, "", lambda dst, src: None),
-    INSTR(0x83, "", lambda dst, src: None),
-    INSTR(0x84, "", lambda dst, src: None),
-    INSTR(0x85, "", lambda dst, src: None),
-    INSTR(0x86, "", lambda dst, src: None),
-    INSTR(0x87, "", lambda dst, src: None),
-    INSTR(0x88, "", lambda dst, src: None),
-    INSTR(0x89, "", lambda dst, src: None),
-    INSTR(0x8a, "", lambda dst, src: None),
-    INSTR(0x8b, "", lambda dst, src: None),
-    INSTR(0x8c, "", lambda dst, src: None),
-    INSTR(0x8d, "", lambda dst, src: None),
-    INSTR(0x8e, "", lambda dst, src: None),
-    INSTR(0x8f, "", lambda dst, src: None),
-    INSTR(0x90, "", lambda dst, src: None),
-    INSTR(0x91, "", lambda dst, src: None),
-    INSTR(0x92, "", lambda dst, src: None),
-    INSTR(0x93, "", lambda dst, src: None),
-    INSTR(0x94, "", lambda dst, src: None),
-    INSTR(0x95, "", lambda dst, src: None),
-    INSTR(0x96, "", lambda dst, src: None),
-    INSTR(0x97, "", lambda dst, src: None),
-    INSTR(0x98, "", lambda dst, src: None),
-    INSTR(0x99, "", lambda dst, src: None),
-    INSTR(0x9a, "", lambda dst, src: None),
-    INSTR(0x9b, "", lambda dst, src: None),
-    INSTR(0x9c, "", lambda dst, src: None),
-    INSTR(0x9d, "", lambda dst, src: None),
-    INSTR(0x9e, "", lambda dst, src: None),
-    INSTR(0x9f, "", lambda dst, src: None),
-    INSTR(0xa0, "", lambda dst, src: None),
-    INSTR(0xa1, "", lambda dst, src: None),
-    INSTR(0xa2, "", lambda dst, src: None),
-    INSTR(0xa3, "", lambda dst, src: None),
-    INSTR(0xa4, "", lambda dst, src: None),
-    INSTR(0xa5, "", lambda dst, src: None),
-    INSTR(0xa6, "", lambda dst, src: None),
-    INSTR(0xa7, "", lambda dst, src: None),
-    INSTR(0xa8, "", lambda dst, src: None),
-    INSTR(0xa9, "", lambda dst, src: None),
-    INSTR(0xaa, "", lambda dst, src: None),
-    INSTR(0xab, "", lambda dst, src: None),
-    INSTR(0xac, "", lambda dst, src: None),
-    INSTR(0xad, "", lambda dst, src: None),
-    INSTR(0xae, "", lambda dst, src: None),
-    INSTR(0xaf, "", lambda dst, src: None),
-    INSTR(0xb0, "", lambda dst, src: None),
-    INSTR(0xb1, "", lambda dst, src: None),
-    INSTR(0xb2, "", lambda dst, src: None),
-    INSTR(0xb3, "", lambda dst, src: None),
-    INSTR(0xb4, "", lambda dst, src: None),
-    INSTR(0xb5, "", lambda dst, src: None),
-    INSTR(0xb6, "", lambda dst, src: None),
-    INSTR(0xb7, "", lambda dst, src: None),
-    INSTR(0xb8, "", lambda dst, src: None),
-    INSTR(0xb9, "", lambda dst, src: None),
-    INSTR(0xba, "", lambda dst, src: None),
-    INSTR(0xbb, "", lambda dst, src: None),
-    INSTR(0xbc, "", lambda dst, src: None),
-    INSTR(0xbd, "", lambda dst, src: None),
-    INSTR(0xbe, "", lambda dst, src: None),
-    INSTR(0xbf, "", lambda dst, src: None),
-    INSTR(0xc0, "", lambda dst, src: None),
-    INSTR(0xc1, "", lambda dst, src: None),
-    INSTR(0xc2, "", lambda dst, src: None),
-    INSTR(0xc3, "", lambda dst, src: None),
-    INSTR(0xc4, "", lambda dst, src: None),
-    INSTR(0xc5, "", lambda dst, src: None),
-    INSTR(0xc6, "", lambda dst, src: None),
-    INSTR(0xc7, "", lambda dst, src: None),
-    INSTR(0xc8, "", lambda dst, src: None),
-    INSTR(0xc9, "", lambda dst, src: None),
-    INSTR(0xca, "", lambda dst, src: None),
-    INSTR(0xcb, "", lambda dst, src: None),
-    INSTR(0xcc, "", lambda dst, src: None),
-    INSTR(0xcd, "", lambda dst, src: None),
-    INSTR(0xce, "", lambda dst, src: None),
-    INSTR(0xcf, "", lambda dst, src: None),
-    INSTR(0xd0, "", lambda dst, src: None),
-    INSTR(0xd1, "", lambda dst, src: None),
-    INSTR(0xd2, "", lambda dst, src: None),
-    INSTR(0xd3, "", lambda dst, src: None),
-    INSTR(0xd4, "", lambda dst, src: None),
-    INSTR(0xd5, "", lambda dst, src: None),
-    INSTR(0xd6, "", lambda dst, src: None),
-    INSTR(0xd7, "", lambda dst, src: None),
-    INSTR(0xd8, "", lambda dst, src: None),
-    INSTR(0xd9, "", lambda dst, src: None),
-    INSTR(0xda, "", lambda dst, src: None),
-    INSTR(0xdb, "", lambda dst, src: None),
-    INSTR(0xdc, "", lambda dst, src: None),
-    INSTR(0xdd, "", lambda dst, src: None),
-    INSTR(0xde, "", lambda dst, src: None),
-    INSTR(0xdf, "", lambda dst, src: None),
-    INSTR(0xe0, "", lambda dst, src: None),
-    INSTR(0xe1, "", lambda dst, src: None),
-    INSTR(0xe2, "", lambda dst, src: None),
-    INSTR(0xe3, "", lambda dst, src: None),
-    INSTR(0xe4, "", lambda dst, src: None),
-    INSTR(0xe5, "", lambda dst, src: None),
-    INSTR(0xe6, "", lambda dst, src: None),
-    INSTR(0xe7, "", lambda dst, src: None),
-    INSTR(0xe8, "", lambda dst, src: None),
-    INSTR(0xe9, "", lambda dst, src: None),
-    INSTR(0xea, "", lambda dst, src: None),
-    INSTR(0xeb, "", lambda dst, src: None),
-    INSTR(0xec, "", lambda dst, src: None),
-    INSTR(0xed, "", lambda dst, src: None),
-    INSTR(0xee, "", lambda dst, src: None),
-    INSTR(0xef, "", lambda dst, src: None),
-    INSTR(0xf0, "", lambda dst, src: None),
-    INSTR(0xf1, "", lambda dst, src: None),
-    INSTR(0xf2, "", lambda dst, src: None),
-    INSTR(0xf3, "", lambda dst, src: None),
-    INSTR(0xf4, "", lambda dst, src: None),
-    INSTR(0xf5, "", lambda dst, src: None),
-    INSTR(0xf6, "", lambda dst, src: None),
-    INSTR(0xf7, "", lambda dst, src: None),
-    INSTR(0xf8, "", lambda dst, src: None),
-    INSTR(0xf9, "", lambda dst, src: None),
-    INSTR(0xfa, "", lambda dst, src: None),
-    INSTR(0xfb, "", lambda dst, src: None),
-    INSTR(0xfc, "", lambda dst, src: None),
-    INSTR(0xfd, "", lambda dst, src: None),
-    INSTR(0xfe, "", lambda dst, src: None),
-    INSTR(0xff, "", lambda dst, src: None),
+# ALU ops, rotates and shifts are table driven, named by their lookup table.
+# For register operands the handler is called as is, for (HL) and immediate
+# operands the _mem and _imm variants are used.
+alu = [
+    ("ADD A, %s", "op_alu", "table_ADD"),
+    ("ADC A, %s", "op_alu_carry", "table_ADD"),
+    ("SUB %s", "op_alu", "table_SUB"),
+    ("SBC A, %s", "op_alu_carry", "table_SUB"),
+    ("AND %s", "op_alu", "table_AND"),
+    ("XOR %s", "op_alu", "table_XOR"),
+    ("OR %s", "op_alu", "table_OR"),
+    ("CP %s", "op_compare", "table_SUB"),
 ]
+
+# Rotates go through the carry flag, shifts (and SWAP) don't
+rot = [
+    ("RLC %s", "op_rot", "table_RLC"),
+    ("RRC %s", "op_rot", "table_RRC"),
+    ("RL %s", "op_rot", "table_RL"),
+    ("RR %s", "op_rot", "table_RR"),
+    ("SLA %s", "op_shift", "table_SLA"),
+    ("SRA %s", "op_shift", "table_SRA"),
+    ("SWAP %s", "op_shift", "table_SWAP"),
+    ("SRL %s", "op_shift", "table_SRL"),
+]
+
+
+def decode(opcode):
+    x = (opcode & 0b11000000) >> 6
+    y = (opcode & 0b00111000) >> 3
+    z = (opcode & 0b00000111) >> 0
+    p = (opcode & 0b00110000) >> 4
+    q = (opcode & 0b00001000) >> 3
+
+    def instr(name, length, func, *args):
+        return INSTR(opcode, name, length, func, args)
+
+    if x == 0:
+        if z == 0:
+            if y == 0:
+                return instr("NOP", 1, "op_nop")
+            elif y == 1:
+                return instr("LD (a16), SP", 3, "op_mem_store_sp")
+            elif y == 2:
+                return instr("STOP", 2, "op_stop")
+            elif y == 3:
+                return instr("JR r8", 2, "op_jr")
+            else:
+                return instr("JR %s, r8" % cc[y-4], 2, "op_jr_condition", cc_arg[y-4])
+        elif z == 1:
+            if q == 0 and p == 3:
+                return instr("LD SP, d16", 3, "op_ld_imm_16_sp")
+            elif q == 0:
+                return instr("LD %s, d16" % rp[p], 3, "op_ld_imm_16", rp[p])
+            elif p == 3:
+                return instr("ADD HL, SP", 1, "op_add_16_sp")
+            else:
+                return instr("ADD HL, %s" % rp[p], 1, "op_add_16", rp[p])
+        elif z == 2:
+            addr_reg, addr_delta, addr_name = [
+                ("BC", 0, "(BC)"),
+                ("DE", 0, "(DE)"),
+                ("HL", 1, "(HL+)"),
+                ("HL", -1, "(HL-)"),
+            ][p]
+            if q == 0:
+                return instr("LD %s, A" % addr_name, 1, "op_mem_store_indirect", addr_reg, "A", addr_delta)
+            else:
+                return instr("LD A, %s" % addr_name, 1, "op_mem_load_indirect", addr_reg, "A", addr_delta)
+        elif z == 3:
+            delta = 1 if q == 0 else -1
+            name = "INC %s" if q == 0 else "DEC %s"
+            if p == 3:
+                return instr(name % "SP", 1, "op_inc_16_sp", delta)
+            else:
+                return instr(name % rp[p], 1, "op_inc_16", rp[p], delta)
+        elif z == 4:
+            if y == 6:
+                return instr("INC (HL)", 1, "op_mem_inc_8", "table_INC")
+            else:
+                return instr("INC %s" % r[y], 1, "op_inc_8", r[y], "table_INC")
+        elif z == 5:
+            if y == 6:
+                return instr("DEC (HL)", 1, "op_mem_inc_8", "table_DEC")
+            else:
+                return instr("DEC %s" % r[y], 1, "op_inc_8", r[y], "table_DEC")
+        elif z == 6:
+            if y == 6:
+                return instr("LD (HL), d8", 2, "op_mem_store_indirect_imm")
+            else:
+                return instr("LD %s, d8" % r[y], 2, "op_ld_imm_8", r[y])
+        elif z == 7:
+            return [
+                instr("RLCA", 1, "op_rot_a", "table_RLC"),
+                instr("RRCA", 1, "op_rot_a", "table_RRC"),
+                instr("RLA", 1, "op_rot_a", "table_RL"),
+                instr("RRA", 1, "op_rot_a", "table_RR"),
+                instr("DAA", 1, "op_daa", "table_DAA"),
+                instr("CPL", 1, "op_cpl"),
+                instr("SCF", 1, "op_scf"),
+                instr("CCF", 1, "op_ccf"),
+            ][y]
+    elif x == 1:
+        if z == 6 and y == 6:
+            return instr("HALT", 1, "op_halt")
+        elif z == 6:
+            return instr("LD %s, (HL)" % r[y], 1, "op_mem_load_indirect", "HL", r[y])
+        elif y == 6:
+            return instr("LD (HL), %s" % r[z], 1, "op_mem_store_indirect", "HL", r[z])
+        else:
+            return instr("LD %s, %s" % (r[y], r[z]), 1, "op_ld", r[y], r[z])
+    elif x == 2:
+        name, func, table = alu[y]
+        if z == 6:
+            return instr(name % "(HL)", 1, func + "_mem", table)
+        else:
+            return instr(name % r[z], 1, func, r[z], table)
+    elif x == 3:
+        if z == 0:
+            if y <= 3:
+                return instr("RET %s" % cc[y], 1, "op_ret_condition", cc_arg[y])
+            elif y == 4:
+                return instr("LDH (a8), A", 2, "op_mem_store_high")
+            elif y == 5:
+                return instr("ADD SP, r8", 2, "op_add_sp", True)
+            elif y == 6:
+                return instr("LDH A, (a8)", 2, "op_mem_load_high")
+            elif y == 7:
+                return instr("LD HL, SP+r8", 2, "op_add_sp", False)
+        elif z == 1:
+            if q == 0 and p == 3:
+                return instr("POP AF", 1, "op_mem_pop_af")
+            elif q == 0:
+                return instr("POP %s" % rp2[p], 1, "op_mem_pop", rp2[p])
+            elif p == 0:
+                return instr("RET", 1, "op_ret", False)
+            elif p == 1:
+                return instr("RETI", 1, "op_ret", True)
+            elif p == 2:
+                return instr("JP (HL)", 1, "op_jp_hl")
+            elif p == 3:
+                return instr("LD SP, HL", 1, "op_ld_sp_hl")
+        elif z == 2:
+            if y <= 3:
+                return instr("JP %s, a16" % cc[y], 3, "op_jp_imm_condition", cc_arg[y])
+            elif y == 4:
+                # TODO: color matrix says this is a 2 byte intsr, not sure
+                # whether to trust that or not
+                return instr("LD (C), A", 1, "op_mem_store_c")
+            elif y == 5:
+                return instr("LD (a16), A", 3, "op_mem_store")
+            elif y == 6:
+                # TODO: color matrix says this is a 2 byte intsr, not sure
+                # whether to trust that or not
+                return instr("LD A, (C)", 1, "op_mem_load_c")
+            elif y == 7:
+                return instr("LD A, (a16)", 3, "op_mem_load")
+        elif z == 3:
+            if y == 0:
+                return instr("JP a16", 3, "op_jp_imm")
+            elif y == 1:
+                return instr("PREFIX CB", 2, "op_cb")
+            elif y == 6:
+                return instr("DI", 1, "op_change_interrupts_delayed", False)
+            elif y == 7:
+                return instr("EI", 1, "op_change_interrupts_delayed", True)
+        elif z == 4:
+            if y <= 3:
+                return instr("CALL %s, a16" % cc[y], 3, "op_call_condition", cc_arg[y])
+        elif z == 5:
+            if q == 0:
+                return instr("PUSH %s" % rp2[p], 1, "op_mem_push", rp2[p])
+            elif p == 0:
+                return instr("CALL a16", 3, "op_call")
+        elif z == 6:
+            name, func, table = alu[y]
+            return instr(name % "d8", 2, func + "_imm", table)
+        elif z == 7:
+            return instr("RST %02XH" % (y*8), 1, "op_rst", y*8)
+
+    return instr("INVALID", 1, "op_invalid", opcode)
+
+
+def cb_decode(opcode):
+    x = (opcode & 0b11000000) >> 6
+    y = (opcode & 0b00111000) >> 3
+    z = (opcode & 0b00000111) >> 0
+
+    from_memory = z == 6
+    dst_reg = "HL" if from_memory else r[z]
+
+    def instr(name, func, *args):
+        return INSTR(opcode, name, 2, func, args)
+
+    if x == 0:
+        name, func, table = rot[y]
+        if from_memory:
+            return instr(name % r[z], func + "_mem", table)
+        else:
+            return instr(name % r[z], func, r[z], table)
+    elif x == 1:
+        return instr("BIT %d, %s" % (y, r[z]), "op_bit_test", y, dst_reg, from_memory)
+    elif x == 2:
+        return instr("RES %d, %s" % (y, r[z]), "op_bit_modify", y, dst_reg, True, from_memory)
+    else:
+        return instr("SET %d, %s" % (y, r[z]), "op_bit_modify", y, dst_reg, False, from_memory)
+
+
+ops = [decode(opcode) for opcode in range(0x100)]
+cb_ops = [cb_decode(opcode) for opcode in range(0x100)]
+
+
+def lookup(bus, addr):
+    instr = ops[bus.read(addr)]
+    if instr.func == "op_cb":
+        instr = cb_ops[bus.read((addr+1) & 0xFFFF)]
+    return instr
+
+
+def disassemble(bus, addr):
+    # Returns the mnemonic at addr with its immediate data filled in, along
+    # with the instruction length
+    instr = lookup(bus, addr)
+    text = instr.name
+    if "d16" in text or "a16" in text:
+        imm = bus.read_16((addr+1) & 0xFFFF)
+        text = text.replace("d16", "$%04X" % imm).replace("a16", "$%04X" % imm)
+    elif "r8" in text:
+        imm = bus.read((addr+1) & 0xFFFF)
+        if imm & 0x80:
+            imm -= 0x100
+        if text.startswith("JR"):
+            text = text.replace("r8", "$%04X" % ((addr + 2 + imm) & 0xFFFF))
+        else:
+            text = text.replace("r8", "%d" % imm)
+    elif "d8" in text:
+        text = text.replace("d8", "$%02X" % bus.read((addr+1) & 0xFFFF))
+    elif "a8" in text:
+        text = text.replace("a8", "$FF%02X" % bus.read((addr+1) & 0xFFFF))
+    return text, instr.length
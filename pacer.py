@@ -0,0 +1,123 @@
+# Holds emulation to real time. The PPU calls v_blank() once a frame, which
+# compares how much time the system has emulated since the last resync with
+# how much has actually passed, and sleeps off any lead. When the host can't
+# keep up, the next frame is dropped (run without drawing) to win some time
+# back, and if it falls too far behind the pacer gives up and resyncs rather
+# than running fast to catch up.
+#
+# The clock is either the host's ("clock"), or the sound card's ("audio"),
+# going by how many samples the mixer has pulled out of the PCM stream. The
+# latter keeps the emulator from drifting away from the sound over time.
+
+import time
+
+# time.monotonic() only exists in Python 3
+monotonic = getattr(time, "monotonic", time.time)
+
+# Master clock / cycles per frame
+FRAME_RATE = 4194304.0 / 70224
+FRAME_TIME = 1 / FRAME_RATE
+
+class FRAME_PACER(object):
+    def __init__(self, sync="clock", max_lag=0.25, max_dropped=3):
+        if sync not in ("clock", "audio"):
+            raise Exception("Unknown sync source %s" % sync)
+        self.sync = sync
+
+        # Times normal speed to run at, or None to not hold back at all
+        self.speed = 1
+
+        # Seconds behind before giving up on catching up
+        self.max_lag = max_lag
+        # Frames that can be dropped in a row, so the screen still gets
+        # updated now and then on a host that's just too slow
+        self.max_dropped = max_dropped
+        self.dropped_in_a_row = 0
+
+        self.system = None
+        self.start_cycle = 0
+        self.start_time = 0
+
+        self.frames = 0
+        # Frames whose V-Blank came after it was due
+        self.late_frames = 0
+        # Frames that would've been drawn but were skipped to catch up
+        self.dropped_frames = 0
+        self.resyncs = 0
+        # Seconds spent sleeping
+        self.slept = 0
+
+    def attach(self, system):
+        # Called once the system is built
+        self.system = system
+        self.resync()
+
+    def now(self):
+        if self.sync == "audio":
+            pcm_stream = self.system.apu.pcm_stream
+            return float(pcm_stream.samples_read) / pcm_stream.sample_rate
+        else:
+            return monotonic()
+
+    def resync(self):
+        # Starts counting from here, forgetting any lead or lag
+        self.start_cycle = self.system.scheduler.clock
+        self.start_time = self.now()
+
+    def set_speed(self, speed):
+        self.speed = speed
+        self.resync()
+
+    def wait(self, due):
+        if self.sync == "audio":
+            # The mixer pulls a buffer at a time, so the audio clock moves in
+            # steps. Poll it, but never wait much longer than the wall clock
+            # says to, in case nothing's playing.
+            wall_start = monotonic()
+            deadline = wall_start + (due - self.now()) + FRAME_TIME
+            while self.now() < due and monotonic() < deadline:
+                time.sleep(0.001)
+            self.slept += monotonic() - wall_start
+        else:
+            delay = due - self.now()
+            time.sleep(delay)
+            self.slept += delay
+
+    def v_blank(self, draw):
+        # Called at the start of every V-Blank, with whether the next frame
+        # is going to be drawn. Returns whether it still should be.
+        self.frames += 1
+        if self.speed is None:
+            return draw
+
+        emulated = (self.system.scheduler.clock - self.start_cycle) * self.system.cpu.T_cyc
+        due = self.start_time + emulated / self.speed
+        lag = self.now() - due
+        if lag < -self.max_lag:
+            # Somehow way ahead (e.g. the audio clock stalled), so don't
+            # sleep it all off in one go
+            self.resyncs += 1
+            self.resync()
+        elif lag < 0:
+            self.wait(due)
+        else:
+            self.late_frames += 1
+            if lag > self.max_lag:
+                self.resyncs += 1
+                self.resync()
+            elif lag > FRAME_TIME and draw and self.dropped_in_a_row < self.max_dropped:
+                self.dropped_frames += 1
+                self.dropped_in_a_row += 1
+                return False
+        if draw:
+            self.dropped_in_a_row = 0
+        return draw
+
+    def report(self):
+        return "\n".join([
+            "Pacer: %d frames, synced to %s" % (self.frames, self.sync),
+            "  %d late (%.1f%%), %d dropped, %d resyncs" % (
+                self.late_frames, 100.0 * self.late_frames / max(self.frames, 1),
+                self.dropped_frames, self.resyncs),
+            "  %.2f seconds spent sleeping" % self.slept,
+        ])
@@ -0,0 +1,236 @@
+# Profiles the game rather than the emulator: which guest routines the
+# emulated CPU spends its cycles in, which ROM banks they live in and who
+# calls whom.
+#
+# By default the PC is sampled every interval cycles off the scheduler, with
+# each sample standing for that many cycles, which is cheap enough to leave
+# running. The gaps between samples are jittered, since timers and the LCD
+# fire at fixed periods and would otherwise always get sampled at the same
+# point. With interval=None every instruction is counted exactly instead
+# (time spent halted then isn't counted, since no instruction runs).
+#
+# Routines are told apart by a shadow call stack kept from CALL, RST,
+# interrupts and RET/RETI. Games don't always return the way they called
+# (popping return addresses, reloading SP), so each frame also remembers
+# where its return address was stored, and frames whose return address has
+# been popped off or overwritten get dropped.
+#
+# Recompiled blocks run calls and returns without going through the CPU's
+# dispatch table, so the recompiler should be off while profiling.
+
+import heapq
+import random
+
+import instrument
+
+# Opcodes whose handlers can push or pop a return address
+CALL_OPS = [0xC4, 0xCC, 0xCD, 0xD4, 0xDC] + list(range(0xC7, 0x100, 8))
+RET_OPS = [0xC0, 0xC8, 0xC9, 0xD0, 0xD8, 0xD9]
+
+class GUEST_PROFILER(instrument.PATCHER):
+    def __init__(self, interval=1024, range_size=0x10):
+        super(GUEST_PROFILER, self).__init__()
+        # Cycles between samples, or None to count every instruction
+        self.interval = interval
+        # Size of the address ranges in the report
+        self.range_size = range_size
+        self.system = None
+        self.cpu = None
+        # Seeded, so profiles of the same run come out the same
+        self.random = random.Random(0)
+        self.reset()
+
+    def reset(self):
+        # (bank, PC): cycles
+        self.pcs = {}
+        # Tuple of routine names, outermost first: cycles
+        self.stacks = {}
+        # (caller, callee): times called
+        self.edges = {}
+        self.samples = 0
+
+        # The shadow call stack. Each frame is a routine's name and the
+        # address its return address was pushed to, and stack_key is the
+        # names as a tuple, ready to count cycles against.
+        self.frames = [("(root)", 0x10000)]
+        self.stack_key = ("(root)",)
+
+    def install(self, system):
+        # Called once the system is built
+        self.uninstall()
+        if self.cpu is not system.cpu:
+            # A different system, so whatever was on the stack is gone
+            self.frames = [("(root)", 0x10000)]
+            self.stack_key = ("(root)",)
+        self.system = system
+        self.cpu = system.cpu
+        self.install_cpu(system.cpu)
+        if self.interval is not None:
+            self.schedule(system.scheduler.clock)
+
+    def uninstall(self):
+        super(GUEST_PROFILER, self).uninstall()
+        if self.system is not None:
+            # Take the sampling event out of the queue entirely, so the
+            # scheduler doesn't hang on to the profiler
+            scheduler = self.system.scheduler
+            scheduler.cancel(self)
+            scheduler.queue = [entry for entry in scheduler.queue if entry[2] is not self]
+            heapq.heapify(scheduler.queue)
+
+    def bank(self, addr):
+        # The ROM bank an address is in, or None outside ROM
+        if addr < 0x4000:
+            return 0
+        elif addr < 0x8000:
+            return getattr(self.system.cart.mbc, "rom_bank", 1)
+        else:
+            return None
+
+    def name(self, bank, addr):
+        if bank is None:
+            return "%04X" % addr
+        return "%02X:%04X" % (bank, addr)
+
+    def enter(self, addr, sp):
+        self.leave(sp + 1)
+        callee = self.name(self.bank(addr), addr)
+        edge = (self.frames[-1][0], callee)
+        self.edges[edge] = self.edges.get(edge, 0) + 1
+        self.frames.append((callee, sp))
+        self.stack_key = self.stack_key + (callee,)
+
+    def leave(self, sp):
+        # Drops the frames whose return address is below the stack pointer
+        frames = self.frames
+        if frames[-1][1] < sp:
+            while frames[-1][1] < sp:
+                frames.pop()
+            self.stack_key = tuple(frame[0] for frame in frames)
+
+    def count(self, pc, stack_key, cycles):
+        key = (self.bank(pc), pc)
+        self.pcs[key] = self.pcs.get(key, 0) + cycles
+        self.stacks[stack_key] = self.stacks.get(stack_key, 0) + cycles
+
+    def install_cpu(self, cpu):
+        profiler = self
+        def tracked_call(op):
+            def call_op():
+                sp = cpu.sp
+                cycles = op()
+                if cpu.sp != sp:
+                    profiler.enter(cpu.pc, cpu.sp)
+                return cycles
+            return call_op
+        def tracked_ret(op):
+            def ret_op():
+                sp = cpu.sp
+                cycles = op()
+                if cpu.sp != sp:
+                    profiler.leave(cpu.sp)
+                return cycles
+            return ret_op
+
+        ops = list(cpu.ops)
+        for opcode in CALL_OPS:
+            ops[opcode] = tracked_call(ops[opcode])
+        for opcode in RET_OPS:
+            ops[opcode] = tracked_ret(ops[opcode])
+
+        if self.interval is None:
+            def counted(op):
+                def counted_op():
+                    pc = cpu.pc
+                    stack_key = profiler.stack_key
+                    cycles = op()
+                    profiler.count(pc, stack_key, cycles)
+                    return cycles
+                return counted_op
+            ops = [counted(op) for op in ops]
+        self.patch(cpu, "ops", ops)
+
+        # Interrupts are calls too. As in INSTRUMENTS, the CPU has no
+        # instance attributes to hide service_interrupts behind, so it
+        # becomes a subclass while installed.
+        base = type(cpu)
+        class PROFILED_CPU(base):
+            __slots__ = ()
+            def service_interrupts(self):
+                pc = self.pc
+                cycles = base.service_interrupts(self)
+                if self.pc != pc:
+                    profiler.enter(self.pc, self.sp)
+                return cycles
+        self.patch(cpu, "__class__", PROFILED_CPU)
+
+    def schedule(self, cycle):
+        # Anywhere from half to one and a half intervals on, which still
+        # averages out to one
+        gap = self.random.randint(self.interval // 2, self.interval + self.interval // 2)
+        self.system.scheduler.schedule(self, cycle + max(gap, 1))
+
+    def scheduled_event(self, cycle):
+        self.samples += 1
+        self.count(self.system.cpu.pc, self.stack_key, self.interval)
+        self.schedule(cycle)
+
+    def total_cycles(self):
+        return sum(self.pcs.values())
+
+    def by_range(self):
+        totals = {}
+        for (bank, pc), cycles in self.pcs.items():
+            key = (bank, pc - pc % self.range_size)
+            totals[key] = totals.get(key, 0) + cycles
+        return totals
+
+    def by_bank(self):
+        totals = {}
+        for (bank, pc), cycles in self.pcs.items():
+            totals[bank] = totals.get(bank, 0) + cycles
+        return totals
+
+    def by_routine(self):
+        # routine: [self cycles, total cycles], where total includes
+        # everything it called
+        totals = {}
+        for stack_key, cycles in self.stacks.items():
+            totals.setdefault(stack_key[-1], [0, 0])[0] += cycles
+            for routine in set(stack_key):
+                totals.setdefault(routine, [0, 0])[1] += cycles
+        return totals
+
+    def write_folded(self, f):
+        # One "outer;...;inner cycles" line per call stack, as read by
+        # flamegraph.pl and friends
+        for stack_key, cycles in sorted(self.stacks.items()):
+            f.write("%s %d\n" % (";".join(stack_key), cycles))
+
+    def report(self, top=15):
+        total = max(self.total_cycles(), 1)
+        def percent(cycles):
+            return 100.0 * cycles / total
+
+        out = []
+        if self.interval is None:
+            out.append("Guest profile: %d cycles, counted exactly" % total)
+        else:
+            out.append("Guest profile: %d samples, one every %d cycles" % (self.samples, self.interval))
+
+        out.append("  Hottest ranges:")
+        for (bank, start), cycles in sorted(self.by_range().items(), key=lambda item: -item[1])[:top]:
+            address_range = "%s-%04X" % (self.name(bank, start), start + self.range_size - 1)
+            out.append("    %-13s %6.2f%%" % (address_range, percent(cycles)))
+
+        out.append("  Banks: " + ", ".join("%s %.1f%%" % ("RAM" if bank is None else "%02X" % bank, percent(cycles))
+            for bank, cycles in sorted(self.by_bank().items(), key=lambda item: -item[1])))
+
+        out.append("  %-14s %7s %7s" % ("Routine", "self", "total"))
+        for routine, (self_cycles, total_cycles) in sorted(self.by_routine().items(), key=lambda item: -item[1][0])[:top]:
+            out.append("    %-12s %6.2f%% %6.2f%%" % (routine, percent(self_cycles), percent(total_cycles)))
+
+        out.append("  Most made calls:")
+        for (caller, callee), calls in sorted(self.edges.items(), key=lambda item: -item[1])[:top]:
+            out.append("    %-8s -> %-8s %8d" % (caller, callee, calls))
+        return "\n".join(out)
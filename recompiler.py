@@ -0,0 +1,591 @@
+# Dynamic recompiler: once a basic block of ROM (or WRAM) code has run often
+# enough, it's turned into a single generated Python function that executes
+# the whole block and returns its total cycle count. Peripherals only get
+# advanced between blocks, so a block only runs when nothing is scheduled to
+# happen before its last instruction and nothing that's just happened is
+# about to interrupt it (otherwise the interpreter takes the next
+# instruction). Anything that touches IO registers at a fixed address is left
+# to the interpreter, and accesses through a register pair or SP get their
+# address checked as the block runs, ending it early in front of any that
+# would reach VRAM, OAM or IO, since those depend on where the PPU has got to.
+#
+# Blocks are keyed by (ROM bank << 16) | PC for the switchable ROM bank and by
+# PC everywhere else, so switching banks just means looking up different
+# blocks. Blocks compiled from WRAM are thrown away as soon as any of their
+# bytes get written to.
+
+import opcodes
+
+# Executions of a PC before it gets compiled
+HOT_THRESHOLD = 32
+
+# Blocks stop growing past this many cycles, since the longer a block is,
+# the more often something scheduled falls inside it and it has to be passed
+# over. The final instruction may go a little past it.
+MAX_BLOCK_CYCLES = 64
+
+# Most cycles any instruction left to the interpreter inside a block can take
+# (LD (a16),SP). Branches are always last, so aren't counted.
+MAX_FALLBACK_CYCLES = 20
+
+# WRAM blocks that get overwritten this many times are left to the
+# interpreter for good
+MAX_INVALIDATIONS = 8
+
+# Never compiled: these either touch IO registers no matter what or change
+# how the interpreter loop has to behave afterwards
+INTERPRET_ONLY = set([
+    "op_halt",
+    "op_stop",
+    "op_change_interrupts_delayed",
+    "op_invalid",
+    "op_mem_store_c",
+    "op_mem_load_c",
+])
+
+# Handlers that end a block
+BRANCHES = set([
+    "op_jr",
+    "op_jr_condition",
+    "op_jp_imm",
+    "op_jp_imm_condition",
+    "op_jp_hl",
+    "op_call",
+    "op_call_condition",
+    "op_ret",
+    "op_ret_condition",
+    "op_rst",
+])
+
+# Handlers that write to an address held in a register. In the switchable ROM
+# bank these end the block, since they may have just switched banks
+INDIRECT_WRITES = set([
+    "op_mem_store_indirect",
+    "op_mem_store_indirect_imm",
+    "op_mem_inc_8",
+    "op_rot_mem",
+    "op_shift_mem",
+    "op_bit_modify",
+    "op_mem_push",
+])
+
+HL = "((regs[4] << 8) | regs[5])"
+
+# Handlers that read or write (HL)
+HL_ACCESSES = set([
+    "op_alu_mem",
+    "op_alu_carry_mem",
+    "op_compare_mem",
+    "op_mem_store_indirect_imm",
+    "op_mem_inc_8",
+    "op_rot_mem",
+    "op_shift_mem",
+])
+
+# Handlers that push to or pop from the stack
+PUSHES = set(["op_mem_push", "op_call", "op_call_condition", "op_rst"])
+POPS = set(["op_mem_pop", "op_mem_pop_af", "op_ret", "op_ret_condition"])
+
+
+def io_address(addr, write):
+    # Whether an access to a fixed address has to be left to the interpreter
+    if 0xFF80 <= addr <= 0xFFFE:
+        return False # HRAM
+    if addr >= 0xFF00:
+        return True # IO registers and IE
+    if write and addr < 0x8000:
+        return True # MBC registers
+    return False
+
+
+def plain_memory(width):
+    # Per address, whether the width bytes from it are all in ROM, WRAM or
+    # HRAM, where it doesn't matter how far behind the peripherals are.
+    # Cartridge RAM is left out, since some MBCs map registers there.
+    plain = bytearray(0x10000)
+    for lo, hi in ((0x0000, 0x7FFF), (0xC000, 0xDFFF), (0xFF80, 0xFFFE)):
+        plain[lo:hi + 2 - width] = b"\x01" * (hi + 2 - width - lo)
+    return plain
+
+# By width
+PLAIN_MEMORY = {1: plain_memory(1), 2: plain_memory(2)}
+
+
+class BLOCK_BUILDER(object):
+    # Generates the source for one block
+    def __init__(self, cpu, addr):
+        self.cpu = cpu
+        self.bus = cpu.bus
+        self.start = addr
+        self.lines = []
+        self.namespace = {}
+        self.cycles = 0
+        self.dynamic_cycles = False
+        self.n_instrs = 0
+        # Most cycles the block can have taken by the start of its last
+        # instruction, and by the end of the ones built so far
+        self.lead = 0
+        self.max_cycles = 0
+
+    def emit(self, line, indent=1):
+        self.lines.append("    " * indent + line)
+
+    def const(self, obj):
+        name = "T%d" % len(self.namespace)
+        self.namespace[name] = obj
+        return name
+
+    def total(self, extra=0):
+        if self.dynamic_cycles:
+            return "cycles + %d" % (self.cycles + extra)
+        else:
+            return "%d" % (self.cycles + extra)
+
+    def imm_8(self, addr):
+        return self.bus.read((addr + 1) & 0xFFFF)
+
+    def imm_16(self, addr):
+        return self.bus.read_16((addr + 1) & 0xFFFF)
+
+    def lookup(self, addr):
+        # Returns the instruction at addr and whether it's CB prefixed
+        instr = opcodes.ops[self.bus.read(addr)]
+        if instr.func == "op_cb":
+            return opcodes.cb_ops[self.imm_8(addr)], True
+        return instr, False
+
+    def compilable(self, addr, instr):
+        func = instr.func
+        if func in INTERPRET_ONLY:
+            return False
+        if func == "op_ret" and instr.args == (True,):
+            # RETI
+            return False
+        if func == "op_mem_store_high":
+            return not io_address(0xFF00 + self.imm_8(addr), True)
+        if func == "op_mem_load_high":
+            return not io_address(0xFF00 + self.imm_8(addr), False)
+        if func == "op_mem_store":
+            return not io_address(self.imm_16(addr), True)
+        if func == "op_mem_load":
+            return not io_address(self.imm_16(addr), False)
+        if func == "op_mem_store_sp":
+            target = self.imm_16(addr)
+            return not (io_address(target, True) or io_address((target + 1) & 0xFFFF, True))
+        return True
+
+    def indirect_access(self, instr):
+        # (address expression, width) for the memory an instruction gets at
+        # through a register pair or SP, or None if it doesn't
+        func = instr.func
+        args = self.cpu.resolve(instr)
+        if func in ("op_mem_load_indirect", "op_mem_store_indirect"):
+            return "((regs[%d] << 8) | regs[%d])" % (args[0], args[0] + 1), 1
+        elif func in HL_ACCESSES:
+            return HL, 1
+        elif func == "op_bit_test" and args[2]:
+            return HL, 1
+        elif func == "op_bit_modify" and args[3]:
+            return HL, 1
+        elif func in PUSHES:
+            return "((cpu.sp - 2) & 0xFFFF)", 2
+        elif func in POPS:
+            return "cpu.sp", 2
+        return None
+
+    def guard(self, addr, instr, is_cb):
+        # Ends the block in front of the instruction if its address turns out
+        # to be anywhere but plain memory, leaving a = the address. At the
+        # start of the block there's nothing to end, and the peripherals are
+        # as up to date as they'd be for the interpreter, so it's run through
+        # its handler then.
+        access = self.indirect_access(instr)
+        if access is None:
+            return
+        expr, width = access
+        self.emit("a = %s" % expr)
+        self.emit("if not %s[a]:" % self.const(PLAIN_MEMORY[width]))
+        self.emit("cpu.pc = 0x%04X" % addr, 2)
+        if self.n_instrs == 1:
+            self.emit("return %s[0x%02X]()" % ("cb_ops" if is_cb else "ops", instr.opcode), 2)
+        else:
+            self.emit("return %s" % self.total(), 2)
+
+    def fallback(self, addr, instr, is_cb):
+        # Run an instruction through its interpreter handler
+        self.emit("cpu.pc = 0x%04X" % addr)
+        if is_cb:
+            self.emit("cycles += cb_ops[0x%02X]()" % instr.opcode)
+        else:
+            self.emit("cycles += ops[0x%02X]()" % instr.opcode)
+        self.dynamic_cycles = True
+
+    def inline(self, addr, instr, is_cb):
+        # Emit an instruction's effect directly, returning its cycle count,
+        # or None if there's no template for it
+        func = instr.func
+        args = self.cpu.resolve(instr)
+        emit = self.emit
+
+        if func == "op_nop":
+            return 4
+        elif func == "op_ld":
+            emit("regs[%d] = regs[%d]" % tuple(args))
+            return 4
+        elif func == "op_ld_imm_8":
+            emit("regs[%d] = 0x%02X" % (args[0], self.imm_8(addr)))
+            return 8
+        elif func == "op_ld_imm_16":
+            value = self.imm_16(addr)
+            emit("regs[%d] = 0x%02X" % (args[0], value >> 8))
+            emit("regs[%d] = 0x%02X" % (args[0] + 1, value & 0xFF))
+            return 12
+        elif func == "op_ld_imm_16_sp":
+            emit("cpu.sp = 0x%04X" % self.imm_16(addr))
+            return 12
+        elif func == "op_inc_8":
+            dst, table = args
+            emit("e = %s[regs[%d]]" % (self.const(table), dst))
+            emit("regs[%d] = e & 0xFF" % dst)
+            emit("regs[7] = (regs[7] & 0x10) | (e >> 8)")
+            return 4
+        elif func == "op_inc_16":
+            dst, delta = args
+            emit("v = (((regs[%d] << 8) | regs[%d]) + %d) & 0xFFFF" % (dst, dst + 1, delta))
+            emit("regs[%d] = v >> 8" % dst)
+            emit("regs[%d] = v & 0xFF" % (dst + 1))
+            return 8
+        elif func == "op_inc_16_sp":
+            emit("cpu.sp = (cpu.sp + %d) & 0xFFFF" % args[0])
+            return 8
+        elif func in ("op_alu", "op_alu_mem", "op_alu_imm",
+                "op_alu_carry", "op_alu_carry_mem", "op_alu_carry_imm",
+                "op_compare", "op_compare_mem", "op_compare_imm"):
+            table = self.const(args[-1])
+            if func.endswith("_mem"):
+                operand = "bus.read(a)"
+            elif func.endswith("_imm"):
+                operand = "0x%02X" % self.imm_8(addr)
+            else:
+                operand = "regs[%d]" % args[0]
+            if "carry" in func:
+                index = "((regs[7] & 0x10) << 12) | (regs[6] << 8) | %s" % operand
+            else:
+                index = "(regs[6] << 8) | %s" % operand
+            if func.startswith("op_compare"):
+                emit("regs[7] = %s[%s] >> 8" % (table, index))
+            else:
+                emit("e = %s[%s]" % (table, index))
+                emit("regs[6] = e & 0xFF")
+                emit("regs[7] = e >> 8")
+            return 4 if operand.startswith("regs") else 8
+        elif func in ("op_mem_load_indirect", "op_mem_store_indirect"):
+            addr_reg, reg, delta = (args + [0])[:3]
+            if func == "op_mem_load_indirect":
+                emit("regs[%d] = bus.read(a)" % reg)
+            else:
+                emit("bus.write(a, regs[%d])" % reg)
+            if delta != 0:
+                emit("a = (a + %d) & 0xFFFF" % delta)
+                emit("regs[%d] = a >> 8" % addr_reg)
+                emit("regs[%d] = a & 0xFF" % (addr_reg + 1))
+            return 8
+        elif func == "op_mem_store_indirect_imm":
+            emit("bus.write(a, 0x%02X)" % self.imm_8(addr))
+            return 12
+        elif func == "op_mem_load_high":
+            emit("regs[6] = bus.read(0x%04X)" % (0xFF00 + self.imm_8(addr)))
+            return 12
+        elif func == "op_mem_store_high":
+            emit("bus.write(0x%04X, regs[6])" % (0xFF00 + self.imm_8(addr)))
+            return 12
+        elif func == "op_mem_load":
+            emit("regs[6] = bus.read(0x%04X)" % self.imm_16(addr))
+            return 16
+        elif func == "op_mem_store":
+            emit("bus.write(0x%04X, regs[6])" % self.imm_16(addr))
+            return 16
+        elif func == "op_mem_push":
+            src = args[0]
+            emit("cpu.sp = a")
+            emit("bus.write_16(a, (regs[%d] << 8) | regs[%d])" % (src, src + 1))
+            return 16
+        elif func in ("op_mem_pop", "op_mem_pop_af"):
+            dst = args[0] if args else 6
+            emit("v = bus.read_16(a)")
+            emit("regs[%d] = v >> 8" % dst)
+            emit("regs[%d] = v & 0x%02X" % (dst + 1, 0xF0 if func == "op_mem_pop_af" else 0xFF))
+            emit("cpu.sp = (a + 2) & 0xFFFF")
+            return 12
+        elif func == "op_rot_a":
+            emit("e = %s[((regs[7] & 0x10) << 4) | regs[6]]" % self.const(args[0]))
+            emit("regs[6] = e & 0xFF")
+            emit("regs[7] = (e >> 8) & 0x10")
+            return 4
+        elif func == "op_cpl":
+            emit("regs[6] ^= 0xFF")
+            emit("regs[7] |= 0x60")
+            return 4
+        elif func == "op_scf":
+            emit("regs[7] = (regs[7] & 0x80) | 0x10")
+            return 4
+        elif func == "op_ccf":
+            emit("regs[7] = (regs[7] & 0x90) ^ 0x10")
+            return 4
+        elif is_cb and func in ("op_rot", "op_shift"):
+            dst, table = args
+            if func == "op_rot":
+                emit("e = %s[((regs[7] & 0x10) << 4) | regs[%d]]" % (self.const(table), dst))
+            else:
+                emit("e = %s[regs[%d]]" % (self.const(table), dst))
+            emit("regs[%d] = e & 0xFF" % dst)
+            emit("regs[7] = e >> 8")
+            return 8
+        elif is_cb and func == "op_bit_test" and not args[2]:
+            idx, src, _ = args
+            emit("regs[7] = (regs[7] & 0x10) | (0x20 if regs[%d] & 0x%02X else 0xA0)" % (src, 1 << idx))
+            return 8
+        elif is_cb and func == "op_bit_modify" and not args[3]:
+            idx, dst, reset, _ = args
+            if reset:
+                emit("regs[%d] &= 0x%02X" % (dst, ~(1 << idx) & 0xFF))
+            else:
+                emit("regs[%d] |= 0x%02X" % (dst, 1 << idx))
+            return 8
+        return None
+
+    def branch(self, addr, instr):
+        # Emit the instruction ending the block
+        func = instr.func
+        args = self.cpu.resolve(instr)
+        next_addr = (addr + instr.length) & 0xFFFF
+        emit = self.emit
+
+        if func in ("op_jr", "op_jr_condition"):
+            r8 = self.imm_8(addr)
+            if r8 & 0x80:
+                r8 -= 0x100
+            target = (addr + 2 + r8) & 0xFFFF
+        elif func in ("op_jp_imm", "op_jp_imm_condition"):
+            target = self.imm_16(addr)
+        else:
+            self.fallback(addr, instr, False)
+            emit("return %s" % self.total())
+            return
+
+        taken_cycles = 12 if func.startswith("op_jr") else 16
+        if func.endswith("_condition"):
+            flag, value = args
+            emit("if (regs[7] & 0x%02X) == 0x%02X:" % (flag, value))
+            emit("cpu.pc = 0x%04X" % target, 2)
+            emit("return %s" % self.total(taken_cycles), 2)
+            emit("cpu.pc = 0x%04X" % next_addr)
+            emit("return %s" % self.total(taken_cycles - 4))
+        else:
+            emit("cpu.pc = 0x%04X" % target)
+            emit("return %s" % self.total(taken_cycles))
+
+    def build(self):
+        # Returns (function, end address), or None if the very first
+        # instruction can't be compiled
+        addr = self.start
+        if addr >= 0xC000:
+            limit = 0xE000
+        else:
+            limit = ((addr >> 14) + 1) << 14
+        switchable = 0x4000 <= addr < 0x8000
+        returned = False
+        while True:
+            instr, is_cb = self.lookup(addr)
+            if not self.compilable(addr, instr):
+                break
+            # Don't run off the end of the ROM bank or RAM we started in
+            if addr + instr.length > limit:
+                break
+
+            self.n_instrs += 1
+            self.lead = self.max_cycles
+            self.guard(addr, instr, is_cb)
+            if instr.func in BRANCHES:
+                self.branch(addr, instr)
+                addr += instr.length
+                returned = True
+                break
+
+            cycles = self.inline(addr, instr, is_cb)
+            if cycles is None:
+                self.fallback(addr, instr, is_cb)
+                self.max_cycles += MAX_FALLBACK_CYCLES
+            else:
+                self.cycles += cycles
+                self.max_cycles += cycles
+            addr += instr.length
+
+            if self.cycles >= MAX_BLOCK_CYCLES or (switchable and instr.func in INDIRECT_WRITES):
+                break
+
+        if self.n_instrs == 0:
+            return None
+        if not returned:
+            # Out of cycles, or stopped in front of an instruction that has to
+            # be interpreted
+            self.emit("cpu.pc = 0x%04X" % addr)
+            self.emit("return %s" % self.total())
+
+        name = "block_%04X" % self.start
+        header = [
+            "def %s(cpu):" % name,
+            "    regs = cpu.regs",
+            "    bus = cpu.bus",
+            "    ops = cpu.ops",
+            "    cb_ops = cpu.cb_ops",
+        ]
+        if self.dynamic_cycles:
+            header.append("    cycles = 0")
+        self.source = "\n".join(header + self.lines) + "\n"
+        exec(compile(self.source, "<%s>" % name, "exec"), self.namespace)
+        return self.namespace[name], addr
+
+
+class RECOMPILER(object):
+    def __init__(self, cpu, cart, scheduler):
+        self.cpu = cpu
+        self.cart = cart
+        self.scheduler = scheduler
+        self.reset()
+
+        # Stats
+        self.compiled = 0
+        self.invalidated = 0
+        self.block_runs = 0
+        self.block_instrs = 0
+        self.interpreted = 0
+        # Times a block was passed over because of something scheduled
+        self.deferred = 0
+
+    def reset(self):
+        # key: (function, n_instrs, lead), or False if the block can't be
+        # compiled
+        self.blocks = {}
+        # key: (start, end) for blocks in RAM
+        self.ram_blocks = {}
+        # key: number of times the block has been executed while not compiled
+        self.heat = {}
+        # key: number of times the block has been thrown away
+        self.invalidations = {}
+        # page: bytearray of how many blocks each byte of the page is part of
+        self.code_pages = {}
+
+    def key(self, pc):
+        # None for code that doesn't get compiled (cart RAM, VRAM, OAM, IO,
+        # HRAM)
+        if pc < 0x4000:
+            return pc
+        elif pc < 0x8000:
+            return (self.cart.mbc.rom_bank << 16) | pc
+        elif 0xC000 <= pc < 0xE000:
+            return pc
+        return None
+
+    def step(self):
+        # Run the next block if there is one, otherwise a single instruction
+        cpu = self.cpu
+        key = self.key(cpu.pc)
+        block = self.blocks.get(key)
+        if block:
+            func, n_instrs, lead = block
+            # Nothing may come due before the last instruction, and nothing
+            # that's just come due may be waiting to interrupt the first
+            scheduler = self.scheduler
+            clock = scheduler.clock
+            if clock + lead < scheduler.next_cycle and clock != scheduler.last_run:
+                self.block_runs += 1
+                self.block_instrs += n_instrs
+                return func(cpu)
+            self.deferred += 1
+        elif block is None and key is not None:
+            heat = self.heat.get(key, 0) + 1
+            self.heat[key] = heat
+            if heat >= HOT_THRESHOLD:
+                self.compile(key, cpu.pc)
+
+        self.interpreted += 1
+        return cpu.step()
+
+    def compile(self, key, pc):
+        builder = BLOCK_BUILDER(self.cpu, pc)
+        result = builder.build()
+        if result is None:
+            self.blocks[key] = False
+            return
+        func, end = result
+        self.blocks[key] = (func, builder.n_instrs, builder.lead)
+        self.compiled += 1
+        if pc >= 0x8000:
+            self.ram_blocks[key] = (pc, end)
+            self.mark_code(pc, end, 1)
+
+    def mark_code(self, start, end, delta):
+        bus = self.cpu.bus
+        for addr in range(start, end):
+            page_idx = addr >> 8
+            page = self.code_pages.get(page_idx)
+            if page is None:
+                page = self.code_pages[page_idx] = bytearray(0x100)
+                bus.watch_writes(page_idx, self)
+            page[addr & 0xFF] += delta
+            if delta < 0 and not any(page):
+                del self.code_pages[page_idx]
+                bus.unwatch_writes(page_idx)
+
+    def bus_write_watch(self, addr):
+        page = self.code_pages.get(addr >> 8)
+        if page is None:
+            # Left over from before a state load
+            self.cpu.bus.unwatch_writes(addr >> 8)
+            return
+        if page[addr & 0xFF] == 0:
+            return
+        for key, (start, end) in list(self.ram_blocks.items()):
+            if start <= addr < end:
+                self.invalidate(key)
+
+    def adopt_blocks(self, other):
+        # Takes the blocks another recompiler has built from the same game's
+        # ROM. Blocks get everything through the CPU they're called with, so
+        # they work for any system. Ones from RAM stay behind, since they'd
+        # need the other system's RAM to stay the same as this one's.
+        for key, block in other.blocks.items():
+            if not 0xC000 <= key < 0xE000:
+                self.blocks.setdefault(key, block)
+
+    def drop_ram_blocks(self):
+        # RAM's been overwritten wholesale (e.g. by loading a state) without
+        # going through the bus, so nothing compiled from it can be trusted
+        for key, (start, end) in list(self.ram_blocks.items()):
+            del self.ram_blocks[key]
+            self.mark_code(start, end, -1)
+            del self.blocks[key]
+            self.heat[key] = 0
+
+    def invalidate(self, key):
+        start, end = self.ram_blocks.pop(key)
+        self.mark_code(start, end, -1)
+        self.invalidated += 1
+        self.heat[key] = 0
+        self.invalidations[key] = self.invalidations.get(key, 0) + 1
+        if self.invalidations[key] >= MAX_INVALIDATIONS:
+            # Self-modifying or constantly reloaded, not worth it
+            self.blocks[key] = False
+        else:
+            del self.blocks[key]
+
+    def report(self):
+        total = self.block_instrs + self.interpreted
+        return "\n".join([
+            "Recompiler: %d blocks compiled, %d invalidated" % (self.compiled, self.invalidated),
+            "  %d of %d instructions (%.1f%%) ran from compiled blocks" % (
+                self.block_instrs, total, 100.0 * self.block_instrs / max(total, 1)),
+            "  %d block runs, %.1f instructions per block, %d passed over for scheduled events" % (
+                self.block_runs, float(self.block_instrs) / max(self.block_runs, 1), self.deferred),
+        ])
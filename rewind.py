@@ -0,0 +1,147 @@
+# Rewind: a snapshot of the system (see snapshot.py) is taken every interval
+# frames and kept in memory, so play can be wound back a bit at a time while
+# the rewind key is held.
+#
+# Consecutive snapshots differ in very few bytes, so each group of
+# keyframe_every snapshots stores its first one (the keyframe) as is, and the
+# rest as the XOR against it, which is mostly zeroes. Everything is zlib
+# compressed, though the newest keyframe is also kept uncompressed to take
+# deltas against (and counts towards max_bytes too). Once the buffer goes over
+# max_bytes the oldest group is thrown away, keyframe and all.
+
+import binascii
+import collections
+import time
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    # XORing through Python longs instead is slower, but still well under
+    # a millisecond for a snapshot
+    numpy = None
+
+
+def xor_bytes(a, b):
+    if numpy is not None:
+        return (numpy.frombuffer(a, numpy.uint8) ^ numpy.frombuffer(b, numpy.uint8)).tostring()
+    value = int(binascii.hexlify(a), 16) ^ int(binascii.hexlify(b), 16)
+    return binascii.unhexlify("%0*x" % (2 * len(a), value))
+
+
+class REWIND_BUFFER(object):
+    def __init__(self, interval=2, keyframe_every=30, max_bytes=32 << 20, level=1):
+        # Frames between snapshots
+        self.interval = interval
+        self.keyframe_every = keyframe_every
+        self.max_bytes = max_bytes
+        # zlib compression level
+        self.level = level
+
+        # Each group is [compressed keyframe, [compressed deltas]], oldest
+        # first
+        self.groups = collections.deque()
+        # The newest group's keyframe, uncompressed, for taking deltas
+        # against (or for stepping back through it)
+        self.keyframe = None
+        # Compressed bytes held, see size() for everything
+        self.n_bytes = 0
+        self.frames_to_capture = 0
+        # Frames since the newest snapshot was taken
+        self.newest_age = 0
+
+        # Stats
+        self.frames = 0
+        self.captures = 0
+        self.capture_seconds = 0
+        self.rewinds = 0
+        self.rewind_seconds = 0
+        self.dropped_groups = 0
+
+    def __len__(self):
+        return sum(1 + len(deltas) for keyframe, deltas in self.groups)
+
+    def size(self):
+        # Bytes held, compressed or not
+        return self.n_bytes + (len(self.keyframe) if self.keyframe is not None else 0)
+
+    def frame(self, system):
+        # Called once per frame's worth of cycles
+        self.frames += 1
+        self.newest_age += 1
+        self.frames_to_capture -= 1
+        if self.frames_to_capture <= 0:
+            self.frames_to_capture = self.interval
+            self.capture(system)
+
+    def capture(self, system):
+        T_start = time.time()
+        state = system.snapshot()
+        if (self.keyframe is None or len(state) != len(self.keyframe) or
+                len(self.groups[-1][1]) + 1 >= self.keyframe_every):
+            data = zlib.compress(state, self.level)
+            self.groups.append([data, []])
+            self.keyframe = state
+        else:
+            data = zlib.compress(xor_bytes(state, self.keyframe), self.level)
+            self.groups[-1][1].append(data)
+        self.n_bytes += len(data)
+        self.newest_age = 0
+
+        while self.size() > self.max_bytes and len(self.groups) > 1:
+            keyframe, deltas = self.groups.popleft()
+            self.n_bytes -= len(keyframe) + sum(len(delta) for delta in deltas)
+            self.dropped_groups += 1
+
+        self.captures += 1
+        self.capture_seconds += time.time() - T_start
+
+    def pop_state(self):
+        # Takes the newest snapshot off the buffer and returns it
+        keyframe, deltas = self.groups[-1]
+        if self.keyframe is None:
+            self.keyframe = zlib.decompress(keyframe)
+        if deltas:
+            data = deltas.pop()
+            state = xor_bytes(zlib.decompress(data), self.keyframe)
+        else:
+            data = keyframe
+            state = self.keyframe
+            self.groups.pop()
+            self.keyframe = None
+        self.n_bytes -= len(data)
+        return state
+
+    def step_back(self, system):
+        # Restores the newest snapshot at least interval frames old and
+        # forgets it (and anything newer), so the next call goes back another
+        # interval. Returns False once there's nothing left.
+        if len(self.groups) == 0:
+            return False
+        T_start = time.time()
+        state = self.pop_state()
+        if self.newest_age < self.interval and len(self.groups) > 0:
+            # Too recent to look any different from where play is now
+            state = self.pop_state()
+        system.restore(state)
+        # The next one back is now an interval behind
+        self.newest_age = self.interval
+        # Pick up capturing from here once the rewinding stops
+        self.frames_to_capture = self.interval
+        self.rewinds += 1
+        self.rewind_seconds += time.time() - T_start
+        return True
+
+    def report(self):
+        n_states = len(self)
+        return "\n".join([
+            "Rewind: %d states in %.1f KiB (%.1f KiB each), covering %d frames" % (
+                n_states, self.size() / 1024.0, self.size() / 1024.0 / max(n_states, 1),
+                n_states * self.interval),
+            "  %d captures at %.3f ms each, %.3f ms per frame" % (
+                self.captures, 1000.0 * self.capture_seconds / max(self.captures, 1),
+                1000.0 * self.capture_seconds / max(self.frames, 1)),
+            "  %d steps back at %.3f ms each, %d old groups dropped" % (
+                self.rewinds, 1000.0 * self.rewind_seconds / max(self.rewinds, 1),
+                self.dropped_groups),
+        ])
@@ -0,0 +1,83 @@
+# Central event queue for the peripherals. Time is counted in master clock
+# cycles (4.194304MHz) as plain integers, so nothing drifts no matter how long
+# the system runs.
+#
+# Devices schedule themselves for the cycle their state next changes, and
+# get their scheduled_event(cycle) method called once the CPU has run past
+# it. In between, the CPU can run without touching them at all.
+
+import heapq
+import struct
+
+CLOCK = struct.Struct("<Q")
+
+# next_cycle when nothing is scheduled
+NEVER = 1 << 62
+
+class SCHEDULER(object):
+    def __init__(self):
+        # Cycles run so far. The run loop adds to this after every
+        # instruction, so during an instruction it's the cycle it started on
+        self.clock = 0
+
+        # Heap of (cycle, seq, device). seq keeps events on the same cycle in
+        # the order they were scheduled
+        self.queue = []
+        self.seq = 0
+
+        # device: seq of its pending event. Entries in the queue that don't
+        # match have been cancelled or replaced and just get skipped
+        self.pending = {}
+
+        # Cycle of the earliest event, checked by the run loop after every
+        # instruction. May be early if that event has since been cancelled.
+        self.next_cycle = NEVER
+
+        # Clock when events were last run. Anything they raised is serviced
+        # after the next instruction, so the recompiler only runs a block if
+        # the clock has moved on since (see RECOMPILER.step).
+        self.last_run = 0
+
+    def schedule(self, device, cycle):
+        # Replaces any event the device already has. Scheduling for the
+        # current clock (or earlier) means the end of the current
+        # instruction.
+        self.seq += 1
+        self.pending[device] = self.seq
+        heapq.heappush(self.queue, (cycle, self.seq, device))
+        if cycle < self.next_cycle:
+            self.next_cycle = cycle
+
+    def snapshot(self):
+        return CLOCK.pack(self.clock)
+
+    def restore(self, data):
+        # Only the clock is saved: devices that are part of the state
+        # reschedule themselves once they're restored. Anything else keeps
+        # its event the same number of cycles away.
+        (clock,) = CLOCK.unpack(data)
+        shift = clock - self.clock
+        self.queue = [(cycle + shift, seq, device) for cycle, seq, device in self.queue]
+        if self.next_cycle != NEVER:
+            self.next_cycle += shift
+        self.clock = clock
+        # Whatever was pending when the snapshot was taken is about to be
+        # serviced
+        self.last_run = clock
+
+    def cancel(self, device):
+        self.pending.pop(device, None)
+
+    def run_due(self):
+        self.last_run = self.clock
+        queue = self.queue
+        pending = self.pending
+        while queue and queue[0][0] <= self.clock:
+            cycle, seq, device = heapq.heappop(queue)
+            if pending.get(device) == seq:
+                del pending[device]
+                device.scheduled_event(cycle)
+
+        while queue and pending.get(queue[0][2]) != queue[0][1]:
+            heapq.heappop(queue)
+        self.next_cycle = queue[0][0] if queue else NEVER
@@ -0,0 +1,82 @@
+# Save state format. A snapshot is a header followed by tagged sections,
+# one per component, each holding that component's raw state as packed
+# ints and flat runs of bytes (see the snapshot()/restore() methods on the
+# components, and GAMEBOY.snapshot() for the list of sections):
+#
+#   "PYGBSNAP" u16 version, u16 section count
+#   then per section: 4 byte tag, u32 length, data
+#
+# Everything is little-endian. Restoring writes the state back into the
+# objects that are already there rather than building new ones, so the bus
+# mappings, the frontend's surfaces and any renderer caches for things that
+# didn't change all stay put.
+
+import struct
+
+MAGIC = b"PYGBSNAP"
+# Bump whenever any component's layout changes
+VERSION = 1
+
+HEADER = struct.Struct("<8sHH")
+SECTION = struct.Struct("<4sI")
+
+
+def pack(sections):
+    # sections is a list of (tag, data)
+    out = [HEADER.pack(MAGIC, VERSION, len(sections))]
+    for tag, data in sections:
+        out.append(SECTION.pack(tag, len(data)))
+        out.append(data)
+    return b"".join(out)
+
+
+def unpack(snapshot):
+    # Returns {tag: data}
+    if len(snapshot) < HEADER.size:
+        raise Exception("Save state is truncated")
+    magic, version, n_sections = HEADER.unpack_from(snapshot, 0)
+    if magic != MAGIC:
+        raise Exception("Not a pygb save state (or one from before they were versioned)")
+    if version != VERSION:
+        raise Exception("Save state is version %d, this is version %d" % (version, VERSION))
+
+    sections = {}
+    offset = HEADER.size
+    for _ in range(n_sections):
+        if offset + SECTION.size > len(snapshot):
+            raise Exception("Save state is truncated")
+        tag, length = SECTION.unpack_from(snapshot, offset)
+        offset += SECTION.size
+        if offset + length > len(snapshot):
+            raise Exception("Save state is truncated")
+        sections[tag] = snapshot[offset:offset+length]
+        offset += length
+    return sections
+
+
+class FIELDS(object):
+    # Packs a fixed list of an object's attributes, given as (name, struct
+    # code) pairs. Attributes named in optional may be None, which is stored
+    # as -1.
+    def __init__(self, spec, optional=()):
+        self.spec = list(spec)
+        self.names = [name for name, code in spec]
+        self.struct = struct.Struct("<" + "".join(code for name, code in spec))
+        self.size = self.struct.size
+        self.optional = optional
+
+    def pack(self, obj):
+        values = [getattr(obj, name) for name in self.names]
+        for name in self.optional:
+            idx = self.names.index(name)
+            if values[idx] is None:
+                values[idx] = -1
+        return self.struct.pack(*values)
+
+    def unpack(self, obj, data, offset=0):
+        # Returns the offset just past the fields
+        for name, value in zip(self.names, self.struct.unpack_from(data, offset)):
+            if value == -1 and name in self.optional:
+                value = None
+            setattr(obj, name, value)
+        return offset + self.size
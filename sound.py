@@ -1,5 +1,6 @@
 import bus
 import cpu
+import snapshot
 
 from array import array
 from time import sleep
@@ -7,10 +8,18 @@ import struct
 import io
 import wave
 
-import pygame
-from pygame.mixer import Sound, music, get_init, pre_init
+# Only needed to actually play the sound, so it's imported by connect()
+pygame = None
 
 class SynthChannel(object):
+    # What goes into save states (see snapshot.py)
+    state = snapshot.FIELDS([
+        ("enabled", "?"), ("_length_counter", "q"),
+        ("_volume_envelope_period", "q"), ("_volume_envelope_counter", "q"),
+        ("_volume_envelope_steps", "q"), ("_volume_envelope_delta", "d"),
+        ("_volume_envelope_value", "d"),
+    ], optional=("_length_counter",))
+
     def __init__(self, sample_rate, stereo = True):
         self.sample_rate = sample_rate
         self.n_channels = {True: 2, False: 1}[stereo]
@@ -35,6 +44,12 @@ class SynthChannel(object):
 
         self._data_buffer = array("f")
 
+    def snapshot(self):
+        return self.state.pack(self)
+
+    def restore(self, data):
+        self.state.unpack(self, data)
+
     def set_duration(self, seconds):
         if seconds is None:
             self._length_counter = None
@@ -49,10 +64,15 @@ class SynthChannel(object):
         self._volume_envelope_period = int(self.sample_rate * period_seconds)
         self._volume_envelope_counter = self._volume_envelope_period
 
-    def channel_function(self, n_samples, min_sample, max_sample):
+    def channel_function(self, n_samples, min_sample, max_sample, render=True):
+        # Fills in n_samples of the data buffer, or with render False just
+        # moves the channel on as if it had. Returns False if the channel is
+        # silent.
         return False
 
-    def gen_samples(self, n_words):
+    def gen_samples(self, n_words, render=True):
+        # With render False, the channel's state moves on by n_words but no
+        # samples get generated and None is returned
         if len(self._data_buffer) < n_words:
             self._data_buffer.extend([0]*n_words)
 
@@ -64,9 +84,10 @@ class SynthChannel(object):
                     return None
                 elif self._length_counter <= n_samples:
                     # Zero out the sound after the tone gets clipped
-                    for time in range(self._length_counter, n_samples):
-                        self._data_buffer[time*2] = 0 # L
-                        self._data_buffer[time*2+1] = 0 # R
+                    if render:
+                        for time in range(self._length_counter, n_samples):
+                            self._data_buffer[time*2] = 0 # L
+                            self._data_buffer[time*2+1] = 0 # R
                     # Readjust the requested number of wave samples
                     # to stop at the clipping time
                     n_samples = self._length_counter
@@ -90,7 +111,7 @@ class SynthChannel(object):
                 max_sample = 1
                 min_sample = 0
 
-            if self.channel_function(n_samples, min_sample, max_sample):
+            if self.channel_function(n_samples, min_sample, max_sample, render) and render:
                 return self._data_buffer[:n_words]
             else:
                 return None
@@ -98,6 +119,12 @@ class SynthChannel(object):
             return None
 
 class SquareChannel(SynthChannel):
+    state = snapshot.FIELDS(SynthChannel.state.spec + [
+        ("freq", "d"), ("duty", "d"), ("_last_pos", "d"),
+        ("_freq_sweep_period", "q"), ("_freq_sweep_coef", "d"),
+        ("_freq_sweep_counter", "q"), ("_freq_sweep_effective", "d"),
+    ], optional=SynthChannel.state.optional)
+
     def __init__(self, *args, **kwargs):
         super(SquareChannel, self).__init__(*args, **kwargs)
 
@@ -130,7 +157,7 @@ class SquareChannel(SynthChannel):
         self._freq_sweep_effective = self.freq
 
 
-    def channel_function(self, n_samples, min_sample, max_sample):
+    def channel_function(self, n_samples, min_sample, max_sample, render=True):
         if self.freq <= 0:
             return False
 
@@ -157,13 +184,14 @@ class SquareChannel(SynthChannel):
         period = self.sample_rate // effective_freq
 
         # TODO: profile if this is faster than a normal python array
-        for time in range(n_samples):
-            if ((time+self._last_pos) % period) < period * self.duty:
-                self._data_buffer[time*2] = max_sample # L
-                self._data_buffer[time*2+1] = max_sample # R
-            else:
-                self._data_buffer[time*2] = min_sample # L
-                self._data_buffer[time*2+1] = min_sample # R
+        if render:
+            for time in range(n_samples):
+                if ((time+self._last_pos) % period) < period * self.duty:
+                    self._data_buffer[time*2] = max_sample # L
+                    self._data_buffer[time*2+1] = max_sample # R
+                else:
+                    self._data_buffer[time*2] = min_sample # L
+                    self._data_buffer[time*2+1] = min_sample # R
 
         self._last_pos += n_samples
         self._last_pos %= period
@@ -172,6 +200,11 @@ class SquareChannel(SynthChannel):
 
 
 class NoiseChannel(SynthChannel):
+    state = snapshot.FIELDS(SynthChannel.state.spec + [
+        ("_wide_mode", "?"), ("_lfsr", "q"),
+        ("_update_counter", "d"), ("_update_period_samples", "d"),
+    ], optional=SynthChannel.state.optional)
+
     def __init__(self, *args, **kwargs):
         super(NoiseChannel, self).__init__(*args, **kwargs)
         self._wide_mode = True 
@@ -190,7 +223,7 @@ class NoiseChannel(SynthChannel):
         update_frequency = int(524288.0 / (r * 2**(s+1)))
         self._update_period_samples = self.sample_rate / update_frequency
 
-    def channel_function(self, n_samples, min_sample, max_sample):
+    def channel_function(self, n_samples, min_sample, max_sample, render=True):
         # The amplitude is randomly switched between high and low at the given frequency. A higher frequency will make the noise to appear 'softer'.
         # When Bit 3 is set, the output will become more regular, and some frequencies will sound more like Tone than Noise.
         #   Bit 7-4 - Shift Clock Frequency (s); max == 
@@ -250,9 +283,10 @@ class NoiseChannel(SynthChannel):
             else:
                 period_value = max_sample
            
-            for i in range(int(time), int(time + period_samples)):
-                self._data_buffer[i*2] = period_value
-                self._data_buffer[i*2+1] = period_value
+            if render:
+                for i in range(int(time), int(time + period_samples)):
+                    self._data_buffer[i*2] = period_value
+                    self._data_buffer[i*2+1] = period_value
             time += period_samples
             self._update_counter += period_samples
 
@@ -304,6 +338,15 @@ class GameboyMixerStream(object):
 
         self.master_volume = (1,1)
 
+        # When fast-forwarding there's no point mixing sound nobody can
+        # follow, so the channels just get moved on and the output is silent
+        self.skip_samples = False
+
+        # Samples (per channel) handed to the mixer so far. The mixer pulls
+        # them at the rate the sound card plays them, so this doubles as a
+        # clock to pace the emulator against.
+        self.samples_read = 0
+
     def set_master_volume(self, left, right):
         self.master_volume = (left, right)
 
@@ -311,6 +354,13 @@ class GameboyMixerStream(object):
         if len(self._data_buffer) < n_words:
             self._data_buffer.extend([0]*n_words)
 
+        if self.skip_samples:
+            self.square_a.gen_samples(n_words, render=False)
+            self.square_b.gen_samples(n_words, render=False)
+            self.noise.gen_samples(n_words, render=False)
+            self._data_buffer[:n_words] = array("h", [0]) * n_words
+            return
+
         sounds = [
             self.square_a.gen_samples(n_words),
             self.square_b.gen_samples(n_words),
@@ -344,6 +394,9 @@ class GameboyMixerStream(object):
     def read(self, size=None):
         if size is None:
             raise ValueError("Mixer stream does not support unbounded reads")
+        # The WAV loader looks for more chunks after the data, so there has
+        # to be an end of file for it to stop at
+        size = max(0, min(size, self.max_file_pos - self.file_pos))
         # print ("read ", self.file_pos, size)
         output_bytes = ""
         if self.file_pos < len(self.riff_header):
@@ -354,12 +407,14 @@ class GameboyMixerStream(object):
                 # print("bleed")
                 read_size_words = (size-len(self.riff_header)) // self._data_buffer.itemsize
                 self.fill_data(read_size_words)
-                output_bytes = self.riff_header[self.file_pos:] + self._data_buffer[:read_size_words].tobytes()
+                self.samples_read += read_size_words // self.n_channels
+                output_bytes = self.riff_header[self.file_pos:] + self._data_buffer[:read_size_words].tostring()
         else:
             # print("data")
             read_size_words = size // self._data_buffer.itemsize
             self.fill_data(read_size_words)
-            output_bytes = self._data_buffer[:read_size_words].tobytes()
+            self.samples_read += read_size_words // self.n_channels
+            output_bytes = self._data_buffer[:read_size_words].tostring()
 
         self.file_pos += size
         return output_bytes
@@ -376,6 +431,8 @@ class GameboyMixerStream(object):
             raise ValueError("Bad value for whence argument")
 
     def connect(self):
+        global pygame
+        import pygame
         pygame.mixer.music.load(self)
         pygame.mixer.music.play(loops=-1)
 
@@ -383,16 +440,17 @@ class GameboyMixerStream(object):
         pygame.mixer.music.stop()
 
 
-class SOUND(object):
-    def __init__(self, bus):
-        self.bus = bus
-        bus.attach(self, 0xFF10, 0xFF26)
+class SOUND(bus.BUS_OBJECT):
+    def __init__(self, bus, sample_rate=44100):
+        super(SOUND, self).__init__()
+        bus.attach(self, 0xFF10, 0xFF3F)
 
-        self.pcm_stream = GameboyMixerStream(sample_rate = get_init()[0])
-        pcm_stream.connect()
-        # TODO: need to disconnect at some point
+        # Samples only get generated when something reads from the stream,
+        # e.g. the frontend playing it through pygame.mixer
+        self.pcm_stream = GameboyMixerStream(sample_rate = sample_rate)
 
         self.reg_values = {}
+        self.reset()
 
     def reset(self):
         defaults = [
@@ -443,6 +501,25 @@ class SOUND(object):
             self.reg_values[default[0]-0xFF10] = default[2]
         # TODO: reset actual audio units
 
+    def snapshot(self):
+        # Registers as last written (0xFF for never), the mixer's master
+        # volume, then each channel's state
+        pcm_stream = self.pcm_stream
+        return (bytes(bytearray(self.reg_values.get(addr, 0xFF) for addr in range(0x30))) +
+                struct.pack("<dd", *pcm_stream.master_volume) +
+                pcm_stream.square_a.snapshot() +
+                pcm_stream.square_b.snapshot() +
+                pcm_stream.noise.snapshot())
+
+    def restore(self, data):
+        pcm_stream = self.pcm_stream
+        self.reg_values = dict(enumerate(bytearray(data[:0x30])))
+        pcm_stream.master_volume = struct.unpack_from("<dd", data, 0x30)
+        offset = 0x40
+        for channel in (pcm_stream.square_a, pcm_stream.square_b, pcm_stream.noise):
+            channel.restore(data[offset:offset+channel.state.size])
+            offset += channel.state.size
+
     def bus_read(self, addr):
         # TODO:
         # Reading NR52 yields the current power status and each channel's enabled status (from the length counter).
@@ -496,7 +573,9 @@ class SOUND(object):
             # Bit 2-0 - SO1 output level (volume)  (0-7)
             return self.reg_values[addr]
         else:
-            raise Exception("audio driver doesn't know WHAT the fuck to do")
+            # TODO: the rest of the registers just read back as written for
+            # now, or as all 1s if they've never been written
+            return self.reg_values.get(addr, 0xFF)
 
 
     def bus_write(self, addr, value):
@@ -564,16 +643,17 @@ class SOUND(object):
             vol_r = (value & 0b111)//0b111
             vol_l = ((value>>4) & 0b111)//0b111
             self.pcm_stream.set_master_volume(vol_l, vol_r)
-        if addr == 21: # 0xFF25 NR51
+        elif addr == 21: # 0xFF25 NR51
             # NR51 FF25 NW21 NW21 Left enables, Right enables
             # TODO
             pass
-        if addr == 22: # 0xFF26 NR52
+        elif addr == 22: # 0xFF26 NR52
             # NR52 FF26 P--- NW21 Power control/status, Channel length statuses
             # TODO
             pass
         else:
-            raise Exception("audio driver doesn't know WHAT the fuck to do")
+            # TODO: the rest of the channels
+            self.reg_values[addr] = value & 0xFF
 
 
     # TODO: duty cycle lookup table:
@@ -672,10 +752,11 @@ if __name__ == "__main__":
 
     tests = [siren, noise_test, freq_sweep_test, volume_envelope_test, duration_train, duty_sweep, flat_chord, flat_tone]
     if len(sys.argv) >= 2:
-        pre_init(44100, -16, 1, 1024)
+        import pygame
+        pygame.mixer.pre_init(44100, -16, 1, 1024)
         pygame.init()
 
-        pcm_stream = GameboyMixerStream(sample_rate = get_init()[0])
+        pcm_stream = GameboyMixerStream(sample_rate = pygame.mixer.get_init()[0])
         pcm_stream.set_master_volume(0.05,0.05)
         pcm_stream.connect()
 
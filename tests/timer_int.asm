@@ -16,6 +16,11 @@ SLOT 1 $4000
 
 ;***********************************
 ; Timer interrupt test
+;
+; Runs the timer at each TAC speed until TIMA overflows, then checks DIV
+; against how long that should have taken. Prints one character per speed
+; over serial, "." if DIV matched and "F" if it didn't, then stops. A
+; timer interrupt that never arrives hangs on the HALT.
 
 .BANK 0 SLOT 0
 .ORG $100
@@ -23,17 +28,63 @@ NOP
 JP $150
 
 .ORG $50
-STOP
+RET ; Leave interrupts disabled until the next EI
 
 .ORG $150
 
-EI
+LD SP, $DFFE
 LD HL, $FFFF
-LD (HL), $04
-LD HL, $FF04
-LD (HL), 0 
+LD (HL), $04 ; Only enable the timer interrupt
+
+LD B, $04 ; 4096Hz, 1024 cycles per tick
+LD C, $FC ; 4 ticks to overflow, 4096 cycles
+LD D, 16 ; DIV counts every 256 cycles
+CALL run_speed
+
+LD B, $05 ; 262144Hz, 16 cycles per tick
+LD C, $C0 ; 64 ticks, 1024 cycles
+LD D, 4
+CALL run_speed
+
+LD B, $06 ; 65536Hz, 64 cycles per tick
+LD C, $F0 ; 16 ticks, 1024 cycles
+LD D, 4
+CALL run_speed
+
+LD B, $07 ; 16384Hz, 256 cycles per tick
+LD C, $FC ; 4 ticks, 1024 cycles
+LD D, 4
+CALL run_speed
+
+STOP
+
+; B = TAC, C = starting TIMA, D = expected DIV
+run_speed:
 LD HL, $FF07
-LD (HL), 4
-wait_loop: 
+LD (HL), 0 ; Stop the timer while setting it up
+LD HL, $FF0F
+LD (HL), 0 ; Clear pending interrupts
+LD HL, $FF05
+LD (HL), C ; TIMA
+LD HL, $FF06
+LD (HL), C ; TMA
+LD HL, $FF04
+LD (HL), 0 ; Reset DIV
+LD L, $07
+LD (HL), B ; Start the timer
+EI
+HALT
 NOP
-JP wait_loop
+LD L, $04
+LD A, (HL) ; DIV, read a little after the overflow
+LD HL, $FF01
+CP D
+JR Z, passed
+LD (HL), $46 ; "F"
+JR send
+passed:
+LD (HL), $2E ; "."
+send:
+LD L, $02
+LD (HL), $81 ; Start the transfer
+RET
@@ -1,45 +1,182 @@
 import bus
-import pygame
+import snapshot
+import struct
 import util
 
-# TODO: For HBLANK, maybe speculatively draw the whole screen right after
-# vblank and then just leave the backend idle while the video mode cycles,
-# and then if any vram/regs get modified before the next vblank we
-# speculatively draw the screen from that scanline down and blit it onto
-# the original screen?
-# and regardless only flip at the start of the next vblank?
+SHADE_TABLES = {}
+
+def shade_table(palette):
+    # bytearray.translate() table mapping colour numbers through a palette.
+    # There are only 256 palettes, so each is only built once.
+    key = tuple(palette)
+    table = SHADE_TABLES.get(key)
+    if table is None:
+        table = SHADE_TABLES[key] = bytes(bytearray(palette)) + b"\0" * 252
+    return table
+
+
+def build_row_table():
+    # Pixels (colour numbers, left to right) for a row of a tile, indexed by
+    # the row's two bytes as (hi << 8) | lo. Bit 7 is the leftmost pixel.
+    spread = [sum(((byte >> (7 - x)) & 1) << (8 * (7 - x)) for x in range(8))
+        for byte in range(0x100)]
+    pack = struct.Struct(">Q").pack
+    table = []
+    for hi in range(0x100):
+        hi_bits = spread[hi] << 1
+        table += [pack(lo_bits | hi_bits) for lo_bits in spread]
+    return table
+
+ROW_PIXELS = build_row_table()
+
+
+class LINE_RENDERER(object):
+    # Draws each line in pure Python as the PPU finishes it
+    name = "python"
+
+    def __init__(self, video):
+        self.video = video
+
+    def map_row(self, map_select, y, first_col, n_cols):
+        # Colour numbers for one row of pixels, n_cols tiles wide, from the
+        # tile map (wrapping around at its right edge)
+        video = self.video
+        tile_map = video.vram_map_1.map if map_select else video.vram_map_0.map
+        tile = video.vram_tile.tile
+        signed = not video.vregs.map_data
+        map_base = (y >> 3) * 32
+        pix_base = (y & 7) * 8
+        row = bytearray()
+        for col in xrange(first_col, first_col + n_cols):
+            tile_idx = tile_map[map_base + (col & 0x1F)]
+            if signed:
+                # Tiles 0x80-0xFF are shared, 0x00-0x7F come from 0x9000
+                tile_idx = (tile_idx ^ 0x80) + 0x80
+            row += tile(tile_idx)[pix_base:pix_base+8]
+        return row
+
+    def render_line(self, ly):
+        # Draws scanline ly into the framebuffer. Called as the line's mode 3
+        # ends, so it sees the registers as they were while it was drawn.
+        video = self.video
+        width = video.width
+        video.framebuffer[ly*width:(ly+1)*width] = self.draw_line(ly)
+
+    def draw_line(self, ly):
+        # Returns the shades for scanline ly
+        video = self.video
+        regs = video.vregs
+        width = video.width
+
+        # Background and window colour numbers, which sprites behind the
+        # background also need to see
+        if regs.bg_enable:
+            scx = regs.scx
+            line = self.map_row(regs.bg_map, (ly + regs.scy) & 0xFF, scx >> 3, 21)
+            line = line[scx & 7:(scx & 7) + width]
+        else:
+            line = bytearray(width)
+
+        if video.window_visible(ly):
+            row = self.map_row(regs.window_map, video.window_line, 0, 21)
+            wx = regs.wx - 7
+            if wx < 0:
+                row = row[-wx:]
+                wx = 0
+            line[wx:] = row[:width - wx]
+
+        shades = line.translate(shade_table(regs.bgp))
+
+        if regs.sprite_enable:
+            tile = video.vram_tile.tile
+            height = 16 if regs.sprite_size else 8
+
+            # Only the first 10 sprites in OAM that are on this line get drawn
+            scan_sprites = []
+            for sprite in video.vram_oam.sprites:
+                if 0 <= ly + 16 - sprite.y < height:
+                    scan_sprites.append(sprite)
+                    if len(scan_sprites) == 10:
+                        break
+
+            # Lower X, then lower OAM index, ends up on top
+            scan_sprites.sort(key=lambda spr: (-spr.x, -spr.idx))
+            for sprite in scan_sprites:
+                row = ly + 16 - sprite.y
+                if sprite.v_flip:
+                    row = height - 1 - row
+                tile_idx = sprite.tile_idx
+                if height == 16:
+                    tile_idx = (tile_idx & 0xFE) + (row >> 3)
+                pix_base = (row & 7) * 8
+                pixels = tile(tile_idx)[pix_base:pix_base+8]
+                if sprite.h_flip:
+                    pixels.reverse()
+
+                palette = regs.obp1 if sprite.palette == 1 else regs.obp0
+                x = sprite.x - 8
+                for pix_x in xrange(max(x, 0), min(x + 8, width)):
+                    pix = pixels[pix_x - x]
+                    # Colour 0 is transparent, and low priority sprites only
+                    # show through background colour 0
+                    if pix and not (sprite.priority and line[pix_x]):
+                        shades[pix_x] = palette[pix]
+
+        return shades
+
+
+def make_renderer(video, name):
+    if name == "numpy":
+        try:
+            import video_numpy
+        except ImportError:
+            print("WARNING: NumPy isn't available, using the Python renderer")
+        else:
+            return video_numpy.NUMPY_RENDERER(video)
+    elif name != "python":
+        raise Exception("unknown renderer %s" % name)
+    return LINE_RENDERER(video)
+
+
+# What goes into save states (see snapshot.py). The frame counter and
+# clocks, then the framebuffer, so the picture's there straight away
+VIDEO_STATE = snapshot.FIELDS([
+    ("frame", "Q"), ("enabled", "?"), ("display_clock", "i"),
+    ("dma_clock", "i"), ("window_line", "i"), ("cycle", "q"),
+])
+
+# The registers as they read back, apart from LY and DMA which are stored as
+# they are
+VIDEO_REGS_STATE = snapshot.FIELDS([("ly", "B"), ("dma_base", "i")], optional=("dma_base",))
+VIDEO_REGS_READABLE = (0, 1, 2, 3, 5, 7, 8, 9, 10, 11)
 
 class VIDEO(object):
-    def __init__(self, bus, scale=4):
-        self.T_mode2 = 19e-6
-        self.T_mode3 = 41e-6
-        self.T_mode0 = 48.6e-6
-        self.T_mode1 = 1.08e-3
-        self.T_refresh = (1/59.7)
+    def __init__(self, bus, scheduler, renderer="python", frontend=None, pacer=None):
+        # Timings are in master clock cycles
+        self.C_mode2 = 80
+        self.C_mode3 = 172
+        self.C_mode0 = 204
+        self.C_refresh = 70224
 
-        self.T_mode2_edge = self.T_mode2
-        self.T_mode3_edge = self.T_mode2 + self.T_mode3
-        self.T_mode0_edge = self.T_mode2 + self.T_mode3 + self.T_mode0
-        self.T_scanline = self.T_mode0_edge
+        self.C_mode2_edge = self.C_mode2
+        self.C_mode3_edge = self.C_mode2 + self.C_mode3
+        self.C_mode0_edge = self.C_mode2 + self.C_mode3 + self.C_mode0
+        self.C_scanline = self.C_mode0_edge
 
-        # TODO: this *should* be 160, why doesn't that work??
-        self.T_dma = 140e-6
+        # TODO: this *should* be 640, why doesn't that work??
+        self.C_dma = 588
 
         self.bus = bus
-        self.scale = scale
+        self.scheduler = scheduler
+        # Gets the framebuffer at every V-Blank. Without one, the picture is
+        # only ever in self.framebuffer
+        self.frontend = frontend
+        # Holds the frame rate to real time, if there is one
+        self.pacer = pacer
         self.width = 160
         self.height = 144
 
-        self.window = pygame.display.set_mode((self.width*self.scale, self.height*self.scale))
-        self.colors = [
-            pygame.Color(0xFC, 0xFC, 0xFC, 0xFF),
-            pygame.Color(0xBC, 0xBC, 0xBC, 0xFF),
-            pygame.Color(0x74, 0x74, 0x74, 0xFF),
-            pygame.Color(0x00, 0x00, 0x00, 0xFF),
-        ]
-        self.window.fill(self.colors[3])
-
-        self.vregs = VIDEO_REGS()
+        self.vregs = VIDEO_REGS(self)
         bus.attach(self.vregs, 0xFF40, 0xFF4B)
 
         self.vram_tile = VIDEO_TILE_RAM()
@@ -54,255 +191,115 @@ class VIDEO(object):
         self.vram_oam = VIDEO_OAM()
         bus.attach(self.vram_oam, 0xFE00, 0xFE9F)
 
-        self.bg_tiles = [None] * self.vram_tile.N_tiles
-        self.oam_tiles = [None] * len(self.vram_oam.sprites)
-        self.update_bg_tiles()
-        self.update_oam()
+        # Shades (0 = lightest to 3 = darkest), one byte per pixel. Each line
+        # is filled in as the PPU finishes it and the whole frame goes to the
+        # frontend at V-Blank
+        self.framebuffer = bytearray(self.width * self.height)
+        self.renderer = make_renderer(self, renderer)
 
         self.frame = 0
 
+        # Only one frame in frameskip gets drawn and presented (e.g. when
+        # fast-forwarding). The rest still run, just without any pixels.
+        # Counted in V-Blanks, since some games turn the LCD off every frame
+        # and never wrap the display clock.
+        self.frameskip = 1
+        self.skipped_frames = 0
+        self.draw_frame = True
+
         self.enabled = False
-        self.display_clock = 0.0
-        self.dma_clock = 0.0
-        self.window_y = 0
+        self.display_clock = 0
+        self.dma_clock = 0
+
+        # Line of the window to draw next. It only moves on for lines the
+        # window was actually drawn on
+        self.window_line = 0
+
+        # Master clock cycle advance() has been run up to
+        self.cycle = scheduler.clock
+        self.reschedule()
 
     def __repr__(self):
         return util.objdumper(self)
 
-    def __getstate__(self):
-        pickled_ppu = self.__dict__.copy()
-        del pickled_ppu["window"]
-        del pickled_ppu["colors"]
-        del pickled_ppu["bg_tiles"]
-        del pickled_ppu["oam_tiles"]
-        return pickled_ppu
-
-    def __setstate__(self, pickled_ppu):
-        self.__dict__.update(pickled_ppu)
-
-        # TODO: decompose color palette here and in __init__
-        self.window = pygame.display.get_surface()
-        self.colors = [
-            pygame.Color(0xFC, 0xFC, 0xFC, 0xFF),
-            pygame.Color(0xBC, 0xBC, 0xBC, 0xFF),
-            pygame.Color(0x74, 0x74, 0x74, 0xFF),
-            pygame.Color(0x00, 0x00, 0x00, 0xFF),
-        ]
-        self.bg_tiles = [None] * self.vram_tile.N_tiles
-        self.oam_tiles = [None] * len(self.vram_oam.sprites)
-
-        for sprite in self.vram_oam.sprites:
-            sprite.rerender = True
-        for tile_idx in xrange(len(self.vram_tile.tiles_changed)):
-            self.vram_tile.tiles_changed[tile_idx] = True
-        self.update_bg_tiles()
-        self.update_oam()
+    def snapshot(self):
+        return VIDEO_STATE.pack(self) + bytes(self.framebuffer)
+
+    def restore(self, data):
+        # The framebuffer is restored in place, so the frontend can keep its
+        # surfaces. Whoever restores the state reschedules the video.
+        offset = VIDEO_STATE.unpack(self, data)
+        self.framebuffer[:] = data[offset:]
 
     def dma_active(self):
         return self.dma_clock > 0
 
-    def render_bitmap(self, tile, palette):
-        bitmap = pygame.Surface((8*self.scale, len(tile) / 8 * self.scale), depth=8)
-        bitmap.set_palette(map(lambda x: self.colors[x], palette))
-        # Color 0 is transparent on sprites. For tile maps, we'll also have
-        # it be transparent but paint the screen with this color right after
-        # clearing it to allow a semi-transparent effect for low-priority
-        # sprites to show through
-        bitmap.set_colorkey(0)
-        for pix_idx, pix in enumerate(tile):
-            pix_x = 7 - (pix_idx % 8)
-            pix_y = pix_idx / 8
-            pix_x *= self.scale
-            pix_y *= self.scale
-            bitmap.fill(pix, (pix_x, pix_y, self.scale, self.scale))
-        return bitmap
-    
-    def update_oam(self):
-        size = self.vregs.sprite_size
-        for sprite in self.vram_oam.sprites:
-            if (sprite.rerender or
-                (size == 0 and self.vram_tile.tiles_changed[sprite.tile_idx]) or
-                (size == 1 and self.vram_tile.tiles_changed[sprite.tile_idx & 0xFE]) or
-                (size == 1 and self.vram_tile.tiles_changed[(sprite.tile_idx & 0xFE) + 1])):
-                if size == 0:
-                    tile = self.vram_tile.tiles[sprite.tile_idx]
-                else:
-                    tile = self.vram_tile.tiles[sprite.tile_idx & 0xFE][:]
-                    tile += self.vram_tile.tiles[(sprite.tile_idx & 0xFE) + 1]
-
-                palette = self.vregs.obp1 if sprite.palette == 1 else self.vregs.obp0
-                self.oam_tiles[sprite.idx] = self.render_bitmap(tile, palette)
-                if sprite.h_flip or sprite.v_flip:
-                    self.oam_tiles[sprite.idx] = pygame.transform.flip(self.oam_tiles[sprite.idx], sprite.h_flip, sprite.v_flip)
-                sprite.rerender = False
-            elif sprite.palette == 0 and self.vregs.obp0_changed:
-                self.oam_tiles[sprite.idx].set_palette(map(lambda x: self.colors[x], self.vregs.obp0))
-            elif sprite.palette == 1 and self.vregs.obp1_changed:
-                self.oam_tiles[sprite.idx].set_palette(map(lambda x: self.colors[x], self.vregs.obp1))
-
-    def update_bg_tiles(self):
-        for tile_idx in xrange(len(self.bg_tiles)):
-            if self.vram_tile.tiles_changed[tile_idx]:
-                self.bg_tiles[tile_idx] = self.render_bitmap(
-                    self.vram_tile.tiles[tile_idx],
-                    self.vregs.bgp
-                )
-            elif self.vregs.bgp_changed:
-                self.bg_tiles[tile_idx].set_palette(map(lambda x: self.colors[x], self.vregs.bgp))
-
-    def draw(self, scanline=0, window_y=0, surface=None, flip=True):
-        if surface is None:
-            surface = self.window
-
-        if scanline == 0:
-            surface.set_clip(None)
+    def next_event(self):
+        # Cycles until advance() next has something to do, or None if that
+        # won't happen without a register write. Anything up to then can be
+        # covered by a single advance() call.
+        if self.vregs.dma_base is not None and not self.dma_active():
+            return 0
+        if self.vregs.display_enable != self.enabled:
+            return 0
+
+        events = []
+        if self.dma_active():
+            events.append(self.dma_clock)
+        if self.enabled:
+            clock = self.display_clock
+            scan_clock = clock % self.C_scanline
+            # Next LY change
+            events.append(self.C_scanline - scan_clock)
+            # Next mode change within the line
+            if clock < self.C_scanline * self.height:
+                for edge in (self.C_mode2_edge, self.C_mode3_edge):
+                    if edge > scan_clock:
+                        events.append(edge - scan_clock)
+                        break
+            events.append(self.C_refresh - clock)
+        return min(events) if events else None
+
+    def catch_up(self):
+        now = self.scheduler.clock
+        self.advance(now - self.cycle)
+        self.cycle = now
+        self.reschedule()
+
+    def reschedule(self):
+        next_event = self.next_event()
+        if next_event is None:
+            self.scheduler.cancel(self)
         else:
-            surface.set_clip([0, scanline*self.scale, self.width*self.scale, (self.height-scanline)*self.scale])
+            self.scheduler.schedule(self, self.cycle + max(next_event, 1))
 
-        if self.vram_tile.any_tile_changed or self.vregs.bgp_changed:
-            self.update_bg_tiles()
+    def scheduled_event(self, cycle):
+        self.catch_up()
 
-        if self.vregs.display_enable:
+    def recheck(self):
+        # Takes another look at the end of the current instruction
+        self.scheduler.schedule(self, self.cycle)
 
-            # Fill with color 0 before drawing low-priority sprites
-            if self.vregs.bg_enable or self.vregs.window_enable:
-                surface.fill(self.colors[self.vregs.bgp[0]])
-
-            scx = 256 - self.vregs.scx
-            scy = 256 - self.vregs.scy
-            wx = self.vregs.wx
-            wy = self.vregs.wy
-            data_select = self.vregs.map_data
-
-            # Draw low-priority sprites
-            if self.vregs.sprite_enable:
-                self.update_oam()
-
-                scan_sprites = []
-                for sprite in self.vram_oam.sprites:
-                    if sprite.priority == 1 and scanline <= sprite.y <= self.height + 16:
-                        scan_sprites.append(sprite)
-                scan_sprites.sort(key=lambda spr: (-spr.x, -spr.idx))
-                for sprite in scan_sprites:
-                    bitmap = self.oam_tiles[sprite.idx]
-                    surface.blit(bitmap, (
-                        (sprite.x - 8) * self.scale, 
-                        (sprite.y - 16) * self.scale
-                    ))
-
-            # Draw background
-            if self.vregs.bg_enable:
-                if self.vregs.bg_map == 0:
-                    tile_map = self.vram_map_0.map 
-                else:
-                    tile_map = self.vram_map_1.map
-
-                x = 0
-                y = 0
-                for x in range(-1,self.width/8):
-                    for y in range(-1+(scanline/8),self.height/8):
-                        map_x = (x - scx / 8) & 0x1F
-                        map_y = (y - scy / 8) & 0x1F
-                        map_idx = map_x + map_y * 32
-                        if data_select:
-                            tile_idx = tile_map[map_idx]
-                        else:
-                            tile_idx = 0x80 + (((tile_map[map_idx]&0xFF)-128)&0xFF)
-                        bitmap = self.bg_tiles[tile_idx]
-                        surface.blit(bitmap, (
-                            (x*8+scx%8)*self.scale, 
-                            (y*8+scy%8)*self.scale
-                        ))
-
-            # Draw window
-            if self.vregs.window_enable and wx <= 166 and wy <= 143 :
-                if self.vregs.window_map == 0:
-                    tile_map = self.vram_map_0.map 
-                else:
-                    tile_map = self.vram_map_1.map
-                    
-                x = 0
-                y = 0
-                data_select = self.vregs.map_data
-
-                pygame.draw.rect(surface, self.colors[self.vregs.bgp[0]],
-                    (wx*self.scale, (wy)*self.scale,
-                    self.width*self.scale, self.height*self.scale)
-                )
-
-                # TODO: Hmmmmmmmm, wrt window:
-                #  If the window is used and a scan line interrupt disables
-                # it (either by writing to LCDC or by setting WX > 166)
-                # and a scan line interrupt a little later on enables it
-                # then the window will resume appearing on the screen at the
-                # exact position of the window where it left off earlier.
-                # This way, even if there are only 16 lines of useful graphics
-                # in the window, you could display the first 8 lines at the
-                # top of the screen and the next 8 lines at the bottom if
-                # you wanted to do so.
-                #
-                #  WX may be changed during a scan line interrupt (to either
-                # cause a graphic distortion effect or to disable the window
-                # (WX>166) ) but changes to WY are not dynamic and won't
-                # be noticed until the next screen redraw.
-
-                for x in range(-1,self.width/8):
-                    for y in range(-1+(window_y/8),self.height/8):
-                        # TODO: it seems we get rendering glitches without this
-                        #   check (in SMW2). Figure out the right way to
-                        #   bound this loop so that we don't need the check:
-                        if x < 0 or y < 0:
-                            continue
-
-                        map_idx = x + y * 32
-                        if data_select:
-                            tile_idx = tile_map[map_idx]
-                        else:
-                            tile_idx = 0x80 + (((tile_map[map_idx]&0xFF)-128)&0xFF)
-                        bitmap = self.bg_tiles[tile_idx]
-                        surface.blit(bitmap, (
-                            (x*8+wx-7)*self.scale, 
-                            (y*8+wy)*self.scale
-                        ))
-
-            # Draw high-priority sprites
-            if self.vregs.sprite_enable:
-                scan_sprites = []
-                for sprite in self.vram_oam.sprites:
-                    if sprite.priority == 0 and scanline <= sprite.y <= self.height + 16:
-                        scan_sprites.append(sprite)
-                scan_sprites.sort(key=lambda spr: (-spr.x, -spr.idx))
-                for sprite in scan_sprites:
-                    bitmap = self.oam_tiles[sprite.idx]
-                    surface.blit(bitmap, (
-                        (sprite.x - 8) * self.scale, 
-                        (sprite.y - 16) * self.scale
-                    ))
-
-        if flip:
-            pygame.display.flip()
-
-    def ram_changed(self):
-        return (self.vregs.lcdc_changed or self.vram_tile.any_tile_changed or
-            self.vram_map_0.map_changed or self.vram_map_1.map_changed or
-            self.vram_oam.sprites_changed or self.vregs.bgp_changed or
-            self.vregs.obp0_changed or self.vregs.obp1_changed)
-
-    def clear_changed_flags(self):
-        self.vregs.lcdc_changed = False
-        self.vram_tile.any_tile_changed = False
-        self.vram_map_0.map_changed = False
-        self.vram_map_1.map_changed = False
-        self.vram_oam.sprites_changed = False
-        self.vregs.bgp_changed = False
-        self.vregs.obp0_changed = False
-        self.vregs.obp1_changed = False
-        for tile_idx in range(len(self.vram_tile.tiles_changed)):
-            self.vram_tile.tiles_changed[tile_idx] = False
+    def window_visible(self, ly):
+        # TODO: implement window state machine rules
+        regs = self.vregs
+        return regs.window_enable and regs.wy <= ly and regs.wx < self.width + 7
 
-    def advance(self, delta):
+    def present(self):
+        if self.frontend is not None:
+            self.frontend.present(self)
 
-        # TODO: implement window state machine rules
+    def next_frame(self):
+        self.skipped_frames += 1
+        if self.skipped_frames >= self.frameskip:
+            self.skipped_frames = 0
+        self.draw_frame = self.skipped_frames == 0
+        if self.pacer is not None:
+            self.draw_frame = self.pacer.v_blank(self.draw_frame)
+
+    def advance(self, delta):
+        # Note that delta is in master clock cycles, and mustn't go past
+        # next_event()
 
         # Handle OAM DMA
         if self.dma_active():
@@ -316,29 +313,29 @@ class VIDEO(object):
             if self.vregs.dma_base is not None:
                 # TODO: good for debugging, but delete eventually:
                 # print("dma clock", util.time_str(self.dma_clock))
-                self.dma_clock = self.T_dma - delta
+                self.dma_clock = self.C_dma - delta
                 self.vram_oam.dma(self.vregs.dma_base)
 
         if self.vregs.display_enable:
             self.enabled = True
 
             self.display_clock += delta
-            scan_clock = self.display_clock % self.T_scanline
+            scan_clock = self.display_clock % self.C_scanline
 
             # Wrap display clock if we've refreshed the screen
-            if self.display_clock >= self.T_refresh:
-                pygame.display.flip()
-                self.draw(flip=False)
+            if self.display_clock >= self.C_refresh:
                 self.frame += 1
-                self.display_clock -= self.T_refresh
-                self.window_y = 0
-                self.clear_changed_flags()
+                self.display_clock -= self.C_refresh
+                self.window_line = 0
 
             # Emulate display state machine
-            if self.display_clock >= self.T_scanline * self.height:
+            if self.display_clock >= self.C_scanline * self.height:
                 # V-Blank
                 if self.vregs.mode != 1:
                     self.vregs.mode = 1
+                    if self.draw_frame:
+                        self.present()
+                    self.next_frame()
 
                     self.vram_oam.bus_enabled = True
                     self.vram_tile.bus_enabled = True
@@ -353,7 +350,7 @@ class VIDEO(object):
                         IF_state |= 0x2
                     self.bus.write(0xFF0F, IF_state)
 
-            elif scan_clock <= self.T_mode2_edge:
+            elif scan_clock < self.C_mode2_edge:
                 # OAM
                 if self.vregs.mode != 2:
                     self.vregs.mode = 2
@@ -369,7 +366,7 @@ class VIDEO(object):
                         IF_state = self.bus.read(0xFF0F)
                         IF_state |= 0x2
                         self.bus.write(0xFF0F, IF_state)
-            elif scan_clock <= self.T_mode3_edge:
+            elif scan_clock < self.C_mode3_edge:
                 # OAM+VRAM
                 if self.vregs.mode != 3:
                     self.vregs.mode = 3
@@ -378,7 +375,7 @@ class VIDEO(object):
                     self.vram_tile.bus_enabled = False
                     self.vram_map_0.bus_enabled = False
                     self.vram_map_1.bus_enabled = False
-            elif scan_clock <= self.T_mode0_edge:
+            else:
                 # H-Blank
                 if self.vregs.mode != 0:
                     self.vregs.mode = 0
@@ -388,15 +385,11 @@ class VIDEO(object):
                     self.vram_map_0.bus_enabled = True
                     self.vram_map_1.bus_enabled = True
 
-                    # TODO: SMW2: window_y param is causing flashes to appear in status bar
-                    # TODO: SMW: window_y param is causing PAUSED text to not appear
-                    if self.ram_changed():
-                        # self.draw(int(self.display_clock / self.T_scanline), window_y, flip=False)
-                        self.draw(int(self.display_clock / self.T_scanline), 0, flip=False)
-                        self.clear_changed_flags()
-
-                    if self.vregs.window_enable:
-                        self.window_y += 1
+                    ly = self.display_clock // self.C_scanline
+                    if self.draw_frame:
+                        self.renderer.render_line(ly)
+                    if self.window_visible(ly):
+                        self.window_line += 1
 
                     if self.vregs.h_blank_int:
                         # Trigger an interrupt
@@ -407,7 +400,7 @@ class VIDEO(object):
 
 
             # Update LY and check if we should trigger the coincidence interrupt
-            cur_ly = int(self.display_clock / self.T_scanline)
+            cur_ly = self.display_clock // self.C_scanline
             if self.vregs.ly != cur_ly:
                 self.vregs.ly = cur_ly
             coincidence = self.vregs.ly == self.vregs.lyc
@@ -426,6 +419,7 @@ class VIDEO(object):
 
                 # Reset state machine
                 self.display_clock = 0
+                self.window_line = 0
                 
                 # Reset STAT
                 self.vregs.mode = 0
@@ -438,12 +432,15 @@ class VIDEO(object):
                 self.vram_map_0.bus_enabled = True
                 self.vram_map_1.bus_enabled = True
 
-                self.draw()
+                if self.draw_frame:
+                    self.present()
 
 class VIDEO_REGS(bus.BUS_OBJECT):
-    def __init__(self):
+    def __init__(self, video):
         super(VIDEO_REGS, self).__init__()
 
+        self.video = video
+
         # STAT flags
         self.mode = 0
         self.coincidence_flag = 0
@@ -563,7 +560,36 @@ class VIDEO_REGS(bus.BUS_OBJECT):
         else:
             raise Exception("video driver doesn't know WHAT the fuck to do")
 
+    def snapshot(self):
+        return (bytes(bytearray(self.bus_read(addr) for addr in VIDEO_REGS_READABLE)) +
+                VIDEO_REGS_STATE.pack(self))
+
+    def restore(self, data):
+        values = bytearray(data[:len(VIDEO_REGS_READABLE)])
+        for addr, value in zip(VIDEO_REGS_READABLE, values):
+            self.write_register(addr, value)
+        stat = values[1]
+        self.mode = stat & 0x3
+        self.coincidence_flag = (stat >> 2) & 0x1
+        VIDEO_REGS_STATE.unpack(self, data, len(VIDEO_REGS_READABLE))
+        # Have the renderer take a fresh look at everything
+        self.lcdc_changed = True
+        self.bgp_changed = True
+        self.obp0_changed = True
+        self.obp1_changed = True
+
     def bus_write(self, addr, value):
+        if addr in (0, 5, 6): # LCDC, LYC, DMA
+            # These change when things happen, so everything up to now has to
+            # happen under the old value, and the video needs to look at the
+            # new one once the current instruction is done
+            self.video.catch_up()
+            self.write_register(addr, value)
+            self.video.recheck()
+        else:
+            self.write_register(addr, value)
+
+    def write_register(self, addr, value):
         # TODO: should lcdc_changed just be regs_changed?
         if addr == 0: # FF40 - LCDC
             self.lcdc_changed = True
@@ -617,12 +643,30 @@ class VIDEO_TILE_RAM(bus.BUS_OBJECT):
         super(VIDEO_TILE_RAM, self).__init__()
         
         self.N_tiles = 384
-        self.tiles = [[0]*(8*8) for _ in range(self.N_tiles)]
+        # 16 bytes per tile, 2 per row: the low then the high bit of each
+        # pixel's colour number
+        self.vram = bytearray(16 * self.N_tiles)
+
+        # Tiles decoded to 64 colour numbers (row by row, left to right) when
+        # they're first asked for, or None until then
+        self.decoded = [None] * self.N_tiles
+
+        # For the renderer to clear once it's picked up the change
         self.tiles_changed = [True]*self.N_tiles
         self.any_tile_changed = True
 
+    def tile(self, tile_idx):
+        tile = self.decoded[tile_idx]
+        if tile is None:
+            vram = self.vram
+            base = tile_idx * 16
+            tile = bytearray().join([ROW_PIXELS[(vram[addr+1] << 8) | vram[addr]]
+                for addr in xrange(base, base + 16, 2)])
+            self.decoded[tile_idx] = tile
+        return tile
+
     def ascii_art(self, tile_idx):
-        tile = self.tiles[tile_idx]
+        tile = self.tile(tile_idx)
         for x in range(8):
             print("".join(map(str, tile[x*8:(x+1)*8])))
 
@@ -632,45 +676,42 @@ class VIDEO_TILE_RAM(bus.BUS_OBJECT):
             txt.append("TILES CHANGED")
         for tile_idx in range(self.N_tiles):
             txt.append("---Tile %d%s--------" % (tile_idx, "[CHANGED]" if self.tiles_changed[tile_idx] else ""))
-            tile = self.tiles[tile_idx]
+            tile = self.tile(tile_idx)
             for x in range(8):
                 txt.append("".join(map(str, tile[x*8:(x+1)*8])))
             txt.append("\n")
         return "\n".join(txt)
 
+    def bus_buffer(self):
+        # Reads come straight from VRAM, writes need to mark the tile
+        return (self.vram, 0)
+
     def bus_read(self, addr):
-        value = 0
-        tile_idx = addr / 16
-        pix_base = ((addr % 16) / 2) * 8
-        tile = self.tiles[tile_idx]
-        pix_bit = addr % 2
-        for pix_idx in xrange(pix_base, pix_base+8):
-            if pix_bit:
-                value |= (tile[pix_idx] & 0x2) << (pix_idx-pix_base)
-            else:
-                value |= (tile[pix_idx] & 0x1) << (pix_idx-pix_base)
-                tile[pix_idx] = (tile[pix_idx] & 0x1) | (value & 0x1)
-        if pix_bit:
-            value = value >> 1
-        return value
+        return self.vram[addr]
 
     def bus_write(self, addr, value):
-        tile_idx = addr / 16
-        pix_base = ((addr % 16) / 2) * 8
-        tile = self.tiles[tile_idx]
-        pix_bit = addr % 2
-        if pix_bit:
-            value = value << 1
-        for pix_idx in xrange(pix_base, pix_base+8):
-            if pix_bit:
-                tile[pix_idx] = (tile[pix_idx] & 0x1) | (value & 0x2)
-            else:
-                tile[pix_idx] = (tile[pix_idx] & 0x2) | (value & 0x1)
-            value = value >> 1
-
+        self.vram[addr] = value & 0xFF
+        tile_idx = addr >> 4
+        self.decoded[tile_idx] = None
         self.tiles_changed[tile_idx] = True
         self.any_tile_changed = True
 
+    def snapshot(self):
+        return bytes(self.vram)
+
+    def restore(self, data):
+        # Only tiles that actually differ get decoded again
+        vram = self.vram
+        if vram == data:
+            return
+        for tile_idx in xrange(self.N_tiles):
+            base = tile_idx * 16
+            if vram[base:base+16] != data[base:base+16]:
+                self.decoded[tile_idx] = None
+                self.tiles_changed[tile_idx] = True
+                self.any_tile_changed = True
+        vram[:] = data
+
 
 class VIDEO_MAP_RAM(bus.BUS_OBJECT):
     def __init__(self):
@@ -685,6 +726,15 @@ class VIDEO_MAP_RAM(bus.BUS_OBJECT):
         self.map[addr] = value
         self.map_changed = True
 
+    def snapshot(self):
+        return bytes(bytearray(self.map))
+
+    def restore(self, data):
+        tile_map = list(bytearray(data))
+        if tile_map != self.map:
+            self.map[:] = tile_map
+            self.map_changed = True
+
 
 class SPRITE(object):
     def __init__(self, idx):
@@ -760,3 +810,16 @@ class VIDEO_OAM(bus.BUS_OBJECT):
     def bus_write(self, addr, value):
         self.sprites_changed = True
         self.sprites[addr / 4].write(addr % 4, value)
+
+    def snapshot(self):
+        return bytes(bytearray(sprite.read(addr) for sprite in self.sprites for addr in range(4)))
+
+    def restore(self, data):
+        # Only sprites that actually differ get marked for re-rendering
+        data = bytearray(data)
+        for sprite in self.sprites:
+            base = sprite.idx * 4
+            for addr in range(4):
+                if sprite.read(addr) != data[base+addr]:
+                    sprite.write(addr, data[base+addr])
+                    self.sprites_changed = True
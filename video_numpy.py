@@ -0,0 +1,201 @@
+# NumPy version of video.LINE_RENDERER. Rather than drawing a line at a time,
+# it draws from the current line to the bottom of the screen in one go as if
+# nothing is going to change, and only draws again (from the line it's on)
+# once VRAM, OAM or the registers have been written. For the usual frame
+# where nothing changes mid-frame, that's one pass over the whole screen.
+
+import numpy
+
+import video as gb_video
+
+
+class NUMPY_RENDERER(object):
+    name = "numpy"
+
+    def __init__(self, video):
+        self.video = video
+        self.width = video.width
+        self.height = video.height
+
+        # Shares its memory with video.framebuffer, which only gets lines the
+        # PPU has got to. Lines drawn ahead wait in self.lines.
+        self.framebuffer = numpy.frombuffer(video.framebuffer, numpy.uint8).reshape(self.height, self.width)
+        self.lines = numpy.zeros((self.height, self.width), numpy.uint8)
+
+        # VRAM as (tile, y, byte), and the tiles decoded from it as
+        # (tile, y, x)
+        n_tiles = video.vram_tile.N_tiles
+        self.vram = numpy.frombuffer(video.vram_tile.vram, numpy.uint8).reshape(n_tiles, 8, 2)
+        self.tiles = numpy.zeros((n_tiles, 8, 8), numpy.uint8)
+
+        # Both tile maps as written, indexed (y, x)
+        self.maps = [numpy.zeros((32, 32), numpy.intp) for _ in range(2)]
+
+        # The full 256x256 picture of each tile map, or None if it needs
+        # redrawing
+        self.layers = [None, None]
+        self.map_data = None
+
+        self.columns = numpy.arange(self.width)
+
+        # Lines up to here have been drawn for the current state
+        self.drawn_to = 0
+        # Last line that saw a change
+        self.changed_line = None
+
+        # For lines that have to be drawn on their own
+        self.line_renderer = gb_video.LINE_RENDERER(video)
+
+        # Start off with everything dirty
+        for tile_idx in xrange(video.vram_tile.N_tiles):
+            video.vram_tile.tiles_changed[tile_idx] = True
+        video.vram_tile.any_tile_changed = True
+        video.vram_map_0.map_changed = True
+        video.vram_map_1.map_changed = True
+
+    def sync(self):
+        # Picks up any writes since the last call, and returns whether there
+        # were some
+        video = self.video
+        regs = video.vregs
+        changed = False
+
+        tile_ram = video.vram_tile
+        if tile_ram.any_tile_changed:
+            # Decode straight from VRAM, the bits of each row's two bytes
+            # being the low and high bits of its pixels
+            dirty = numpy.flatnonzero(tile_ram.tiles_changed)
+            bits = numpy.unpackbits(self.vram[dirty], axis=2)
+            self.tiles[dirty] = bits[:, :, :8] | (bits[:, :, 8:] << 1)
+            tile_ram.tiles_changed[:] = [False] * tile_ram.N_tiles
+            tile_ram.any_tile_changed = False
+            self.layers = [None, None]
+            changed = True
+
+        for map_select, map_ram in enumerate((video.vram_map_0, video.vram_map_1)):
+            if map_ram.map_changed:
+                self.maps[map_select] = numpy.array(map_ram.map, numpy.intp).reshape(32, 32)
+                map_ram.map_changed = False
+                self.layers[map_select] = None
+                changed = True
+
+        if regs.map_data != self.map_data:
+            self.map_data = regs.map_data
+            self.layers = [None, None]
+
+        if (regs.lcdc_changed or regs.bgp_changed or regs.obp0_changed or
+                regs.obp1_changed or video.vram_oam.sprites_changed):
+            regs.lcdc_changed = False
+            regs.bgp_changed = False
+            regs.obp0_changed = False
+            regs.obp1_changed = False
+            video.vram_oam.sprites_changed = False
+            changed = True
+
+        return changed
+
+    def layer(self, map_select):
+        # Colour numbers for the whole of a tile map, indexed (y, x)
+        layer = self.layers[map_select]
+        if layer is None:
+            tile_map = self.maps[map_select]
+            if not self.map_data:
+                # Tiles 0x80-0xFF are shared, 0x00-0x7F come from 0x9000
+                tile_map = (tile_map ^ 0x80) + 0x80
+            # (map y, map x, y, x) -> (map y, y, map x, x)
+            layer = self.tiles[tile_map].transpose(0, 2, 1, 3).reshape(256, 256)
+            self.layers[map_select] = layer
+        return layer
+
+    def render_line(self, ly):
+        if self.sync():
+            if self.changed_line == ly - 1:
+                # Changing every line (e.g. scroll effects), so drawing ahead
+                # would just be thrown away. For a single line, NumPy's
+                # overhead makes it slower than plain Python.
+                line = self.line_renderer.draw_line(ly)
+                self.lines[ly] = numpy.frombuffer(line, numpy.uint8)
+                self.drawn_to = ly + 1
+            else:
+                self.render_lines(ly, self.height)
+            self.changed_line = ly
+        elif ly == 0 or ly >= self.drawn_to:
+            # Earlier lines of the last frame may have been drawn under
+            # different state, so every frame gets drawn again at least once
+            self.render_lines(ly, self.height)
+        self.framebuffer[ly] = self.lines[ly]
+
+    def render_lines(self, first, end):
+        # Draws lines first to end-1, assuming nothing changes on the way
+        video = self.video
+        regs = video.vregs
+        width = self.width
+        n_lines = end - first
+        lines = numpy.arange(first, end)
+
+        # Background and window colour numbers, which sprites behind the
+        # background also need to see
+        if regs.bg_enable:
+            rows = (lines + regs.scy) & 0xFF
+            cols = (self.columns + regs.scx) & 0xFF
+            pixels = self.layer(regs.bg_map)[rows[:, None], cols]
+        else:
+            pixels = numpy.zeros((n_lines, width), numpy.uint8)
+
+        if video.window_visible(end - 1):
+            # The window is on from WY down, and counts its own lines
+            start = max(regs.wy - first, 0)
+            rows = video.window_line + numpy.arange(n_lines - start)
+            wx = regs.wx - 7
+            x = max(wx, 0)
+            cols = numpy.arange(x - wx, width - wx)
+            pixels[start:, x:] = self.layer(regs.window_map)[rows[:, None], cols]
+
+        shades = numpy.array(regs.bgp, numpy.uint8)[pixels]
+
+        if regs.sprite_enable:
+            height = 16 if regs.sprite_size else 8
+            sprites = video.vram_oam.sprites
+
+            # Row of each sprite on each line, indexed (line, sprite)
+            sprite_rows = lines[:, None] + 16 - numpy.array([sprite.y for sprite in sprites])
+            on_line = (sprite_rows >= 0) & (sprite_rows < height)
+            # Only the first 10 sprites in OAM that are on a line get drawn
+            on_line &= numpy.cumsum(on_line, axis=1) <= 10
+            visible = numpy.flatnonzero(on_line.any(axis=0))
+
+            # Lower X, then lower OAM index, ends up on top
+            scan_sprites = [sprites[idx] for idx in visible]
+            scan_sprites.sort(key=lambda spr: (-spr.x, -spr.idx))
+            for sprite in scan_sprites:
+                x = sprite.x - 8
+                x_start = max(x, 0)
+                x_end = min(x + 8, width)
+                if x_start >= x_end:
+                    continue
+
+                if height == 16:
+                    tile_idx = sprite.tile_idx & 0xFE
+                    tile = self.tiles[tile_idx:tile_idx+2].reshape(16, 8)
+                else:
+                    tile = self.tiles[sprite.tile_idx]
+                if sprite.v_flip:
+                    tile = tile[::-1]
+                if sprite.h_flip:
+                    tile = tile[:, ::-1]
+
+                line_idx = numpy.flatnonzero(on_line[:, sprite.idx])
+                sprite_pixels = tile[sprite_rows[line_idx, sprite.idx], x_start-x:x_end-x]
+
+                # Colour 0 is transparent, and low priority sprites only
+                # show through background colour 0
+                mask = sprite_pixels != 0
+                if sprite.priority:
+                    mask &= pixels[line_idx, x_start:x_end] == 0
+
+                palette = numpy.array(regs.obp1 if sprite.palette == 1 else regs.obp0, numpy.uint8)
+                shades[line_idx, x_start:x_end] = numpy.where(
+                    mask, palette[sprite_pixels], shades[line_idx, x_start:x_end])
+
+        self.lines[first:end] = shades
+        self.drawn_to = end